@@ -3,11 +3,31 @@
 
 from __future__ import annotations
 
+import asyncio
+import bisect
+import copy
+import hashlib
+import json
+import math
+import multiprocessing
 import os
-from dataclasses import dataclass
-from typing import List, Dict, Optional, Any
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, FrozenSet, Iterable, Iterator, Optional, Any, Set, Tuple
 
 import gradio as gr
+import httpx
 import PyPDF2
 
 try:
@@ -15,7 +35,10 @@ try:
 except ImportError:  # pragma: no cover - fallback for local runs
     userdata = None
 
-from openai import OpenAI
+from openai import AsyncOpenAI, BadRequestError, DefaultAsyncHttpxClient, NotFoundError, OpenAI
+from openai.types.responses import Response
+
+from pdf_worker import extract_page_range
 
 
 # --- OpenAI client bootstrap -------------------------------------------------
@@ -34,6 +57,28 @@ if api_key:
 
 client = OpenAI()
 MODEL_NAME = "gpt-5"
+# PAPER_STREAM=0 waits for the full response instead of streaming deltas
+STREAM_RESPONSES = os.getenv("PAPER_STREAM", "1") != "0"
+# Chained turns send only the new question; PAPER_DELTA_REQUESTS=0 resends everything
+DELTA_REQUESTS = os.getenv("PAPER_DELTA_REQUESTS", "1") != "0"
+
+# Async path: one event loop holds every in-flight request instead of one thread each
+USE_ASYNC_CLIENT = os.getenv("PAPER_ASYNC", "1") != "0"
+MAX_INFLIGHT_REQUESTS = int(os.getenv("PAPER_MAX_INFLIGHT", "32"))
+# 排隊等待的事件上限；超過時 Gradio 直接回覆「佇列已滿」
+QUEUE_MAX_SIZE = int(os.getenv("PAPER_QUEUE_MAX_SIZE", "128"))
+
+# Keep-alive pool sized to the semaphore so every request reuses a warm TLS connection
+async_client = AsyncOpenAI(
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=MAX_INFLIGHT_REQUESTS,
+            max_keepalive_connections=MAX_INFLIGHT_REQUESTS,
+            keepalive_expiry=120,
+        ),
+    ),
+)
+request_slots = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
 
 
 # --- Prompt scaffolding ------------------------------------------------------
@@ -44,12 +89,77 @@ SYSTEM_PROMPT = (
     "完整、實用的解答。"
 )
 
+SUMMARY_PROMPT = (
+    "把以下論文家教對話濃縮成 300 字以內的重點摘要，供助手接續教學使用。保留學生已經理解的概念、"
+    "仍有疑問的地方、提過的論文細節（章節、數字、術語）和學生的偏好；不要加入對話中沒有的內容。"
+)
+
+HISTORY_SUMMARY_TEMPLATE = "先前對話的摘要（較早的對話已濃縮，細節以此為準）：\n{summary}"
+
+# Built once per paper and sent byte-for-byte first, so the API's prompt cache
+# can reuse it across turns and across students reading the same PDF
+SYSTEM_MESSAGE = {"role": "developer", "content": SYSTEM_PROMPT}
+
+PAPER_PREFIX_TEMPLATE = (
+    "以下是使用者上傳的論文開頭，作為整體背景；之後會另外附上與每個問題最相關的段落：\n"
+    "{content}"
+)
+
 PDF_CONTEXT_TEMPLATE = (
-    "以下是使用者提供的論文內容 (檔名: {filename}, 版本: {version})，回答時務必引用此內容：\n"
+    "以下是使用者提供的論文中與目前問題最相關的段落 (檔名: {filename}, 版本: {version})，"
+    "回答時務必引用此內容：\n"
     "{content}"
 )
 
-MAX_PDF_CHARS = 15000  # 防止超量 token，提醒使用者分段提問
+PDF_PARTIAL_NOTE = "\n\n（論文仍在讀取中，目前只讀到第 1–{ready} 頁，共 {total} 頁；後面的內容還看不到）"
+
+# 閒置超過此秒數的 session 由 Gradio 刪除，釋放對話與 PDF 索引
+SESSION_IDLE_SECONDS = int(os.getenv("PAPER_SESSION_IDLE_SECONDS", "3600"))
+# 同時處理的請求數；Gradio 預設每個事件一次只跑一個
+CONCURRENCY_LIMIT = int(os.getenv("PAPER_CONCURRENCY_LIMIT", "16"))
+
+# 摘要加上逐字保留的歷史超過此值時，把較舊的對話交給便宜的模型濃縮
+HISTORY_TOKEN_BUDGET = int(os.getenv("PAPER_HISTORY_TOKENS", "4000"))
+HISTORY_KEEP_TURNS = int(os.getenv("PAPER_HISTORY_KEEP_TURNS", "3"))
+# previous_response_id 鏈累積的 token（論文開頭、歷次摘錄與對話）超過此值時，改送完整請求重新開一條鏈
+CHAIN_TOKEN_BUDGET = int(os.getenv("PAPER_CHAIN_TOKENS", "16000"))
+SUMMARY_MODEL = os.getenv("PAPER_SUMMARY_MODEL", "gpt-5-nano")
+
+# 每個檢索段落的字元上限；每次只注入最相關的幾段，不再截斷全文
+CHUNK_MAX_CHARS = 1200
+RETRIEVAL_TOP_K = int(os.getenv("PAPER_RETRIEVAL_TOP_K", "6"))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("PAPER_RETRIEVAL_TOKENS", "3000"))
+# 固定前綴放入的論文開頭 token 數（API 的 prompt cache 至少需要 1024 tokens 才會生效）
+PREFIX_TOKEN_BUDGET = int(os.getenv("PAPER_PREFIX_TOKENS", "2000"))
+GENERAL_CACHE_KEY = "paper-assistant"
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 頁數少於此值時逐頁提取；把頁面送到行程池再傳回來的成本比省下的時間還多
+PARALLEL_MIN_PAGES = 16
+PAGES_PER_SHARD = 8
+# 同時在背景讀取的 PDF 數；每份讀完第一批頁面就可以開始提問
+INGEST_WORKERS = int(os.getenv("PAPER_INGEST_WORKERS", "4"))
+
+# 提取邏輯或快取內容的格式改變時遞增，讓舊的快取失效（v2 起多存總頁數）
+EXTRACTOR_VERSION = 2
+PDF_CACHE_PATH = os.getenv(
+    "PAPER_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "paper_assistant", "pdf_text.sqlite3"),
+)
+PDF_CACHE_MAX_BYTES = int(os.getenv("PAPER_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+# 每個請求一行 JSON；設為空字串則不寫檔
+METRICS_LOG_PATH = os.getenv(
+    "PAPER_METRICS_LOG",
+    os.path.join(os.path.expanduser("~"), ".cache", "paper_assistant", "metrics.jsonl"),
+)
+# Prometheus 文字格式的 /metrics 端點；0 表示不啟動
+METRICS_PORT = int(os.getenv("PAPER_METRICS_PORT", "9464"))
+# 預設只在本機監聽：指標會透露使用量與模型設定；要讓其他機器抓取時再設成 0.0.0.0
+METRICS_HOST = os.getenv("PAPER_METRICS_HOST", "127.0.0.1")
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+QUANTILE_WINDOW = 1024
 
 
 # --- Stateful containers -----------------------------------------------------
@@ -57,55 +167,450 @@ MAX_PDF_CHARS = 15000  # 防止超量 token，提醒使用者分段提問
 @dataclass
 class PDFState:
     filename: Optional[str] = None
+    # 全文只在整篇讀完後組合一次；讀取中的狀態為 None
     content: Optional[str] = None
     version: int = 0
-
-    def context_message(self) -> Optional[Dict[str, str]]:
-        if not self.content or not self.filename:
+    chunks: List[Chunk] = field(default_factory=list)
+    index: Optional[BM25Index] = None
+    digest: str = ""
+    prefix_chunks: List[Chunk] = field(default_factory=list)
+    prefix_message: Optional[Dict[str, str]] = None
+    # 背景讀取時先發布前幾頁；pages_ready < page_count 表示還在讀
+    pages_ready: int = 0
+    page_count: int = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.pages_ready >= self.page_count
+
+    @property
+    def prompt_cache_key(self) -> str:
+        # 以內容雜湊命名：同一篇論文不論檔名、哪位學生上傳，都共用同一個快取
+        return f"paper-{self.digest[:16]}" if self.digest else GENERAL_CACHE_KEY
+
+    def excerpts(self, query: str = "") -> List[Chunk]:
+        if not self.chunks or not self.filename or self.index is None:
+            return []
+        return select_chunks(self.index, query, RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET,
+                             exclude=set(self.prefix_chunks))
+
+    def context_message(self, excerpts: List[Chunk]) -> Optional[Dict[str, str]]:
+        if not excerpts:
             return None
-        return {
-            "role": "user",
-            "content": PDF_CONTEXT_TEMPLATE.format(
-                filename=self.filename,
-                version=self.version,
-                content=self.content,
-            ),
-        }
+        content = PDF_CONTEXT_TEMPLATE.format(
+            filename=self.filename,
+            version=self.version,
+            content=format_chunks(excerpts),
+        )
+        if not self.complete:
+            content += PDF_PARTIAL_NOTE.format(ready=self.pages_ready, total=self.page_count)
+        return {"role": "user", "content": content}
 
 
-conversation_history: List[Dict[str, str]] = []
-last_response_id: Optional[str] = None
-pdf_state = PDFState()
+@dataclass
+class PendingSummary:
+    """A summary of the oldest turns, written in the background from a snapshot."""
+    history: List[Dict[str, str]]  # the conversation_history list the snapshot came from
+    folded: List[Dict[str, str]]
+    previous_summary: str
+    future: Future
+
+
+@dataclass
+class SessionState:
+    """Everything one browser session owns; kept in a gr.State, never shared."""
+    conversation_history: List[Dict[str, str]] = field(default_factory=list)
+    last_response_id: Optional[str] = None
+    pdf_state: PDFState = field(default_factory=PDFState)
+    # What the last_response_id chain already holds, so delta requests skip it
+    chained_pdf_version: int = 0
+    chained_chunks: Set[Chunk] = field(default_factory=set)
+    # Estimated tokens the chain holds: every input it was sent plus every reply
+    chained_tokens: int = 0
+    # Turns folded out of conversation_history live on only in this summary
+    history_summary: str = ""
+    pending_summary: Optional[PendingSummary] = None
+    # Held while a request thread changes the history, summary or chain
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # Id of the latest upload; older ingestion jobs stop publishing once it changes
+    ingest_job: int = 0
+
+
+def ensure_session(session: Optional[SessionState]) -> SessionState:
+    return session if session is not None else SessionState()
 
 
 # --- Helpers -----------------------------------------------------------------
 
-def extract_pdf_text(pdf_path: str) -> str:
+_extract_pool: Optional[ProcessPoolExecutor] = None
+_extract_pool_lock = threading.Lock()
+_extract_pool_disabled = False
+
+
+def _extraction_pool() -> Optional[ProcessPoolExecutor]:
+    """The shared extraction pool, started on first use; None where processes are unavailable.
+
+    Workers come from forkserver (spawn where it doesn't exist) rather than
+    fork, since forking this multithreaded server can deadlock the child.
+    Tasks name extract_page_range in the small pdf_worker module; a new
+    worker still re-runs the main script as __mp_main__ (the launch stays
+    behind its __name__ guard), but the pool lives as long as the app, so
+    that happens once per worker instead of on every upload.
+    """
+    global _extract_pool, _extract_pool_disabled
+    with _extract_pool_lock:
+        if _extract_pool is None and not _extract_pool_disabled:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            try:
+                _extract_pool = ProcessPoolExecutor(
+                    max_workers=os.cpu_count() or 1,
+                    mp_context=multiprocessing.get_context(method),
+                )
+            except (OSError, ImportError, NotImplementedError) as exc:
+                # 沙盒等不支援多行程的環境：之後一律逐頁提取
+                _extract_pool_disabled = True
+                print(f"⚠️ 無法建立 PDF 提取行程池，改用逐頁提取：{exc}")
+        return _extract_pool
+
+
+def _discard_extraction_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool so the next upload starts a fresh one."""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is pool:
+            _extract_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_pdf_pages(pdf_path: str, max_workers: Optional[int] = None) -> Iterator[Tuple[List[Tuple[int, str]], int]]:
+    """Yield (pages of one shard, total page count) shard by shard, in page order.
+
+    Shards are PAGES_PER_SHARD pages long and keep pages without text, so
+    callers can report progress and use the first pages before the rest
+    are read. Papers with at least PARALLEL_MIN_PAGES pages are extracted
+    on the shared process pool, at most max_workers shards at a time;
+    max_workers=1 forces the serial path.
+    """
     if not pdf_path:
         raise ValueError("未提供 PDF 檔案")
 
-    text_segments: List[str] = []
     try:
         with open(pdf_path, "rb") as handle:
-            pdf_reader = PyPDF2.PdfReader(handle)
-            if not pdf_reader.pages:
-                raise ValueError("PDF 中沒有可用頁面")
-
-            for index, page in enumerate(pdf_reader.pages, start=1):
-                page_text = page.extract_text() or ""
-                if page_text.strip():
-                    text_segments.append(f"\n--- Page {index} ---\n{page_text.strip()}")
+            page_count = len(PyPDF2.PdfReader(handle).pages)
+        if not page_count:
+            raise ValueError("PDF 中沒有可用頁面")
+
+        workers = min(max_workers or os.cpu_count() or 1, -(-page_count // PAGES_PER_SHARD))
+        done = 0
+        pool = _extraction_pool() if page_count >= PARALLEL_MIN_PAGES and workers > 1 else None
+        if pool is not None:
+            starts = iter(range(0, page_count, PAGES_PER_SHARD))
+            pending: deque[Future] = deque()
+
+            def submit_next() -> None:
+                start = next(starts, None)
+                if start is not None:
+                    pending.append(pool.submit(
+                        extract_page_range, pdf_path, start, min(start + PAGES_PER_SHARD, page_count),
+                    ))
+
+            try:
+                for _ in range(workers):
+                    submit_next()
+                # 一次只排 workers 段，其他上傳也能分到行程；依提交順序取回，頁碼自然保持順序
+                while pending:
+                    shard = pending.popleft().result()
+                    submit_next()
+                    yield shard, page_count
+                    done += len(shard)
+            except (BrokenProcessPool, OSError) as exc:
+                # 行程池壞掉時從還沒讀的頁面改用逐頁提取；真正的 PDF 錯誤會在逐頁提取時再次拋出
+                print(f"⚠️ PDF 提取行程池失敗，從第 {done + 1} 頁起改用逐頁提取：{exc}")
+                if isinstance(exc, BrokenProcessPool):
+                    _discard_extraction_pool(pool)
+            finally:
+                # 呼叫端提早關閉產生器（例如被新的上傳取代）時，不再讀剩下的頁面
+                for future in pending:
+                    future.cancel()
+        for start in range(done, page_count, PAGES_PER_SHARD):
+            yield extract_page_range(pdf_path, start, min(start + PAGES_PER_SHARD, page_count)), page_count
 
     except Exception as exc:  # PyPDF2 raises many custom exceptions
         raise ValueError(f"PDF 讀取失敗: {exc}") from exc
 
-    if not text_segments:
+
+def extract_pdf_pages(pdf_path: str, max_workers: Optional[int] = None) -> List[Tuple[int, str]]:
+    """Return (page number, text) for every page with text, in page order."""
+    return [
+        (number, text)
+        for shard, _ in iter_pdf_pages(pdf_path, max_workers)
+        for number, text in shard
+        if text
+    ]
+
+
+def format_pdf_pages(pages: List[Tuple[int, str]]) -> str:
+    if not pages:
         raise ValueError("PDF 中沒有可讀取的文字內容")
 
-    combined = "".join(text_segments)
-    if len(combined) > MAX_PDF_CHARS:
-        combined = combined[:MAX_PDF_CHARS] + "\n\n... (內容過長，已截斷。請分段提問以獲得完整解說。)"
-    return combined
+    return "".join(f"\n--- Page {number} ---\n{text}" for number, text in pages)
+
+
+def extract_pdf_text(pdf_path: str, max_workers: Optional[int] = None) -> str:
+    return format_pdf_pages(extract_pdf_pages(pdf_path, max_workers))
+
+
+# --- Extracted-text cache ----------------------------------------------------
+
+def pdf_sha256(pdf_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PDFTextCache:
+    """SQLite store of extracted pages keyed by PDF hash and extractor version.
+
+    Entries are zlib-compressed JSON holding the pages with text and the
+    PDF's real page count (trailing pages may be images only); the least
+    recently used ones are evicted once the total exceeds max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # Gradio 在多個執行緒呼叫 handler，每次操作各開一條連線
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def key_for(digest: str) -> str:
+        return f"{digest}:v{EXTRACTOR_VERSION}"
+
+    def get(self, key: str) -> Optional[Tuple[List[Tuple[int, str]], int]]:
+        """(pages with text, page count) for key, or None on a miss."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE pages SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        entry = json.loads(zlib.decompress(row[0]))
+        return [tuple(page) for page in entry["pages"]], entry["page_count"]
+
+    def put(self, key: str, pages: List[Tuple[int, str]], page_count: int) -> None:
+        entry = {"page_count": page_count, "pages": pages}
+        data = zlib.compress(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (key, data, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            for old_key, size in conn.execute("SELECT key, size FROM pages ORDER BY last_used").fetchall():
+                if total <= self.max_bytes or old_key == key:
+                    break
+                conn.execute("DELETE FROM pages WHERE key = ?", (old_key,))
+                total -= size
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        rate = f"{self.hits / lookups:.0%}" if lookups else "-"
+        return f"命中 {self.hits} / 未命中 {self.misses}，命中率 {rate}"
+
+
+pdf_cache = PDFTextCache(PDF_CACHE_PATH, PDF_CACHE_MAX_BYTES)
+
+
+# --- Chunk retrieval ---------------------------------------------------------
+
+_NAMED_SECTION = (
+    r"(?i:abstract|introduction|related work|background|preliminaries|method(?:s|ology)?|approach"
+    r"|experiments?|evaluation|results|discussion|limitations|conclusions?|references"
+    r"|acknowledge?ments?|appendix)"
+)
+# "3.2 Training Setup", "IV. RESULTS" 或單獨一行的章節名稱
+_HEADING = re.compile(
+    rf"^(?:(?:\d{{1,2}}(?:\.\d{{1,2}})*\.?|[IVX]+\.)\s+[A-Z][^.!?]{{0,70}}|{_NAMED_SECTION}:?)$"
+)
+_WORD = re.compile(r"[a-z0-9]+")
+_CJK_RUN = re.compile(r"[\u3400-\u9fff]+")
+
+
+@dataclass(frozen=True)
+class Chunk:
+    page: int
+    section: str
+    text: str
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words plus CJK character bigrams, so Chinese text needs no segmenter."""
+    lowered = text.lower()
+    tokens = _WORD.findall(lowered)
+    for run in _CJK_RUN.findall(lowered):
+        tokens.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough tokenizer-free estimate: one token per CJK character, four characters otherwise."""
+    cjk = sum(len(run) for run in _CJK_RUN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def chunk_pages(pages: List[Tuple[int, str]], max_chars: int = CHUNK_MAX_CHARS, section: str = "") -> List[Chunk]:
+    """Split pages into chunks that never cross a page or section boundary.
+
+    section is the heading in force before the first page, so a paper
+    chunked shard by shard gets the same chunks as when chunked at once.
+    """
+    chunks: List[Chunk] = []
+    for number, text in pages:
+        buffer: List[str] = []
+        size = 0
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            is_heading = _HEADING.match(line) is not None
+            if buffer and (is_heading or size + len(line) > max_chars):
+                chunks.append(Chunk(number, section, "\n".join(buffer)))
+                buffer, size = [], 0
+            if is_heading:
+                section = line
+            # PyPDF2 偶爾把整頁吐成一行
+            for start in range(0, len(line), max_chars):
+                piece = line[start:start + max_chars]
+                if buffer and size + len(piece) > max_chars:
+                    chunks.append(Chunk(number, section, "\n".join(buffer)))
+                    buffer, size = [], 0
+                buffer.append(piece)
+                size += len(piece) + 1
+        if buffer:
+            chunks.append(Chunk(number, section, "\n".join(buffer)))
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over an inverted index of chunk tokens.
+
+    add() indexes more chunks without touching earlier ones. search()
+    only sees the first len(self.chunks) chunks and scores them exactly
+    as an index built from those alone, so a snapshot() handed to chat
+    stays valid while the rest of the paper is added behind it.
+    """
+
+    def __init__(self, chunks: Iterable[Chunk] = ()):
+        self.chunks: List[Chunk] = []
+        # 每個詞的 postings 依段落編號遞增，search 只取快照看得到的前段
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: List[int] = []
+        self.length_sums: List[int] = [0]  # length_sums[n] = sum(lengths[:n])
+        self.add(chunks)
+
+    def add(self, chunks: Iterable[Chunk]) -> None:
+        for chunk in chunks:
+            chunk_id = len(self.lengths)
+            counts = Counter(tokenize(f"{chunk.section}\n{chunk.text}"))
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, []).append((chunk_id, frequency))
+            self.lengths.append(sum(counts.values()))
+            self.length_sums.append(self.length_sums[-1] + self.lengths[-1])
+            # 最後才加入段落，快照看到的段落一定已經建好索引
+            self.chunks.append(chunk)
+
+    def snapshot(self) -> BM25Index:
+        """A view of the chunks indexed so far that shares the postings; don't add() to it."""
+        view = copy.copy(self)
+        view.chunks = list(self.chunks)
+        return view
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = defaultdict(float)
+        total = len(self.chunks)
+        if not total:
+            return []
+        average_length = self.length_sums[total] / total or 1.0
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            visible = bisect.bisect_left(postings, (total,))
+            if not visible:
+                continue
+            idf = math.log(1 + (total - visible + 0.5) / (visible + 0.5))
+            for chunk_id, frequency in postings[:visible]:
+                norm = frequency + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk_id] / average_length)
+                scores[chunk_id] += idf * frequency * (BM25_K1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+
+def select_chunks(index: BM25Index, query: str, top_k: int, token_budget: int,
+                  exclude: Set[Chunk] = frozenset()) -> List[Chunk]:
+    """Best-scoring chunks that fit the token budget, returned in reading order.
+
+    Chunks in exclude (already in the paper prefix) are skipped without
+    using up any of the top_k slots.
+    """
+    ranked = [
+        chunk_id for chunk_id, _ in index.search(query, top_k + len(exclude))
+        if index.chunks[chunk_id] not in exclude
+    ][:top_k]
+    if not ranked:
+        # 問題和論文沒有共同字詞（例如用中文問英文論文）時，提供論文開頭
+        ranked = [
+            chunk_id for chunk_id in range(min(top_k, len(index.chunks)))
+            if index.chunks[chunk_id] not in exclude
+        ]
+
+    selected: List[int] = []
+    used = 0
+    for chunk_id in ranked:
+        cost = estimate_tokens(index.chunks[chunk_id].text)
+        if used + cost > token_budget:
+            continue
+        selected.append(chunk_id)
+        used += cost
+    return [index.chunks[chunk_id] for chunk_id in sorted(selected)]
+
+
+def format_chunks(chunks: List[Chunk]) -> str:
+    return "\n\n".join(
+        f"[第 {chunk.page} 頁{' · ' + chunk.section if chunk.section else ''}]\n{chunk.text}"
+        for chunk in chunks
+    )
+
+
+def paper_prefix(chunks: List[Chunk]) -> Tuple[List[Chunk], Optional[Dict[str, str]]]:
+    """The paper's opening chunks up to PREFIX_TOKEN_BUDGET and the message that carries them.
+
+    Depends only on the text, never on filename or session, so every
+    student who uploads the same paper sends identical bytes.
+    """
+    selected: List[Chunk] = []
+    used = 0
+    for chunk in chunks:
+        cost = estimate_tokens(chunk.text)
+        if selected and used + cost > PREFIX_TOKEN_BUDGET:
+            break
+        selected.append(chunk)
+        used += cost
+    if not selected:
+        return [], None
+    return selected, {"role": "user", "content": PAPER_PREFIX_TEMPLATE.format(content=format_chunks(selected))}
 
 
 def summarise_outputs(response: Any) -> str:
@@ -127,90 +632,1054 @@ def ensure_history(history: Optional[List[List[str]]]) -> List[List[str]]:
     return list(history) if history else []
 
 
-# --- Core chat logic ---------------------------------------------------------
+# --- History compaction ------------------------------------------------------
 
-def chat_with_paper(message: str, history: Optional[List[List[str]]]):
-    global conversation_history, last_response_id
+# 摘要在背景執行，不佔用回答的時間
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
 
-    history = ensure_history(history)
-    user_message = (message or "").strip()
-    if not user_message:
-        return history
 
-    messages: List[Dict[str, str]] = [{"role": "developer", "content": SYSTEM_PROMPT}]
+def history_tokens(session: SessionState) -> int:
+    """Tokens a full request resends as history; CHAIN_TOKEN_BUDGET bounds the chain itself."""
+    return estimate_tokens(session.history_summary) + sum(
+        estimate_tokens(message["content"]) for message in session.conversation_history
+    )
+
+
+def messages_to_fold(session: SessionState) -> int:
+    """How many of the oldest messages to fold into the summary (0 when under budget).
+
+    Folds down to half the budget so compaction runs every few turns, not
+    every turn, and always keeps the last HISTORY_KEEP_TURNS turns verbatim.
+    """
+    total = history_tokens(session)
+    if total <= HISTORY_TOKEN_BUDGET:
+        return 0
+    history = session.conversation_history
+    limit = len(history) - 2 * HISTORY_KEEP_TURNS
+    count = 0
+    while count < limit and total > HISTORY_TOKEN_BUDGET // 2:
+        total -= sum(estimate_tokens(message["content"]) for message in history[count:count + 2])
+        count += 2
+    return count
+
+
+def summarise_history(previous_summary: str, messages: List[Dict[str, str]]) -> str:
+    transcript = "\n".join(
+        f"{'學生' if message['role'] == 'user' else '助手'}：{message['content']}" for message in messages
+    )
+    if previous_summary:
+        transcript = f"先前的摘要：\n{previous_summary}\n\n接續的對話：\n{transcript}"
+    response = client.responses.create(
+        model=SUMMARY_MODEL,
+        input=[
+            {"role": "developer", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        reasoning={"effort": "minimal"},
+        text={"verbosity": "low"},
+    )
+    return summarise_outputs(response)
+
 
-    pdf_context = pdf_state.context_message()
+def _apply_history_summary(session: SessionState) -> None:
+    """Fold a finished background summary into the session; the caller holds session.lock."""
+    pending = session.pending_summary
+    if pending is None or not pending.future.done():
+        return
+    session.pending_summary = None
+    try:
+        summary = pending.future.result()
+    except Exception as exc:
+        print(f"⚠️ 對話摘要失敗，暫時保留完整歷史：{exc}")
+        return
+    # 摘要期間對話被清除，或歷史已不再以快照開頭，這份摘要就作廢
+    history = session.conversation_history
+    if (not summary or history is not pending.history
+            or session.history_summary != pending.previous_summary
+            or history[:len(pending.folded)] != pending.folded):
+        return
+    del history[:len(pending.folded)]
+    session.history_summary = summary
+    # 伺服器端的鏈仍帶著完整舊對話；下一輪改送摘要 + 近期對話，重新開始一條短鏈
+    session.last_response_id = None
+    print(f"🗜️ 已把 {len(pending.folded) // 2} 輪舊對話濃縮成摘要，歷史剩約 {history_tokens(session):,} tokens")
+
+
+def apply_history_summary(session: SessionState) -> None:
+    """Apply a summary that finished since the last turn, before this turn reads the history."""
+    with session.lock:
+        _apply_history_summary(session)
+
+
+def maybe_compact_history(session: SessionState) -> None:
+    """Apply a finished summary, then start a new one once the history exceeds HISTORY_TOKEN_BUDGET.
+
+    Runs on the request thread after a turn is recorded. Only the model
+    call happens in the background; the summary is applied by a later
+    call under session.lock, and only if the history still starts with
+    the turns it summarised.
+    """
+    with session.lock:
+        _apply_history_summary(session)
+        if session.pending_summary is not None:
+            return
+        count = messages_to_fold(session)
+        if not count:
+            return
+        folded = session.conversation_history[:count]
+        session.pending_summary = PendingSummary(
+            history=session.conversation_history,
+            folded=folded,
+            previous_summary=session.history_summary,
+            future=summary_executor.submit(summarise_history, session.history_summary, folded),
+        )
+
+
+# --- Metrics -----------------------------------------------------------------
+
+@dataclass
+class RequestMetrics:
+    """Stage timings and labels for one chat turn or upload."""
+    kind: str
+    started: float = field(default_factory=time.perf_counter)
+    stages_ms: Dict[str, float] = field(default_factory=dict)
+    labels: Dict[str, Any] = field(default_factory=dict)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            # 重複的階段（例如背景讀取時每批頁面都重建索引）累加起來
+            self.stages_ms[name] = self.stages_ms.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+
+def usage_breakdown(usage: Any) -> Dict[str, int]:
+    if usage is None:
+        return {}
+    breakdown = {
+        "input": getattr(usage, "input_tokens", None),
+        "cached": getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None),
+        "output": getattr(usage, "output_tokens", None),
+        "reasoning": getattr(getattr(usage, "output_tokens_details", None), "reasoning_tokens", None),
+    }
+    return {kind: count for kind, count in breakdown.items() if count is not None}
+
+
+class LatencyHistogram:
+    """Cumulative buckets for Prometheus plus a sliding window for exact p50/p95/p99."""
+
+    def __init__(self) -> None:
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.recent: deque = deque(maxlen=QUANTILE_WINDOW)
+
+    def observe(self, seconds: float) -> None:
+        for position, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[position] += 1
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    """Per-stage latency histograms and request/token counters, shared by every session."""
+
+    def __init__(self, log_path: str) -> None:
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self.latency: Dict[Tuple[str, str], LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.requests: Counter = Counter()
+        self.tokens: Counter = Counter()
+        if log_path:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+
+    def record(self, request: RequestMetrics, outcome: str, usage: Any = None,
+               error: Optional[Exception] = None) -> Dict[str, Any]:
+        request.stages_ms["total"] = (time.perf_counter() - request.started) * 1000
+        tokens = usage_breakdown(usage)
+        entry = {
+            "ts": round(time.time(), 3),
+            "kind": request.kind,
+            "outcome": outcome,
+            **request.labels,
+            "stages_ms": {name: round(ms, 1) for name, ms in request.stages_ms.items()},
+            "tokens": tokens,
+        }
+        if error is not None:
+            entry["error"] = f"{type(error).__name__}: {error}"
+
+        with self._lock:
+            for name, ms in request.stages_ms.items():
+                self.latency[(request.kind, name)].observe(ms / 1000)
+            self.requests[(request.kind, outcome, request.labels.get("mode", ""))] += 1
+            self.tokens.update(tokens)
+            if self.log_path:
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as handle:
+                        handle.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                except OSError as exc:
+                    print(f"⚠️ 無法寫入指標記錄：{exc}")
+        return entry
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = [
+            "# HELP paper_assistant_stage_seconds Time spent in each stage of a request.",
+            "# TYPE paper_assistant_stage_seconds histogram",
+        ]
+        with self._lock:
+            latency = sorted(self.latency.items())
+            for (kind, stage), histogram in latency:
+                for bound, count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                    lines.append(f"paper_assistant_stage_seconds_bucket{_labels(kind=kind, stage=stage, le=bound)} {count}")
+                lines.append(f"paper_assistant_stage_seconds_bucket{_labels(kind=kind, stage=stage, le='+Inf')} {histogram.count}")
+                lines.append(f"paper_assistant_stage_seconds_sum{_labels(kind=kind, stage=stage)} {histogram.total:.6f}")
+                lines.append(f"paper_assistant_stage_seconds_count{_labels(kind=kind, stage=stage)} {histogram.count}")
+
+            lines += [
+                f"# HELP paper_assistant_stage_seconds_recent Stage latency quantiles over the last {QUANTILE_WINDOW} requests.",
+                "# TYPE paper_assistant_stage_seconds_recent summary",
+            ]
+            for (kind, stage), histogram in latency:
+                for q in (0.5, 0.95, 0.99):
+                    lines.append(f"paper_assistant_stage_seconds_recent{_labels(kind=kind, stage=stage, quantile=q)} "
+                                 f"{histogram.quantile(q):.6f}")
+                lines.append(f"paper_assistant_stage_seconds_recent_sum{_labels(kind=kind, stage=stage)} {sum(histogram.recent):.6f}")
+                lines.append(f"paper_assistant_stage_seconds_recent_count{_labels(kind=kind, stage=stage)} {len(histogram.recent)}")
+
+            lines += [
+                "# HELP paper_assistant_requests_total Requests by kind, outcome and request mode.",
+                "# TYPE paper_assistant_requests_total counter",
+            ]
+            for (kind, outcome, mode), count in sorted(self.requests.items()):
+                lines.append(f"paper_assistant_requests_total{_labels(kind=kind, outcome=outcome, mode=mode)} {count}")
+
+            lines += [
+                "# HELP paper_assistant_tokens_total Tokens reported in response.usage.",
+                "# TYPE paper_assistant_tokens_total counter",
+            ]
+            for kind, count in sorted(self.tokens.items()):
+                lines.append(f"paper_assistant_tokens_total{_labels(kind=kind)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(METRICS_LOG_PATH)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass  # 不要讓每次抓取都印在 Gradio 的 log 裡
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics on its own port next to the Gradio app, on loopback unless host says otherwise."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as exc:
+        print(f"⚠️ 指標端點無法啟動（{host}:{port}）：{exc}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"📈 指標端點：http://{host}:{port}/metrics")
+    return server
+
+
+# --- Turn routing ------------------------------------------------------------
+
+# PAPER_ROUTER=0 sends every turn with the standard profile
+ADAPTIVE_ROUTING = os.getenv("PAPER_ROUTER", "1") != "0"
+# 寒暄與查找型問題改用的小模型；設成空字串就一律用 MODEL_NAME
+ROUTER_SMALL_MODEL = os.getenv("PAPER_ROUTER_SMALL_MODEL", "gpt-5-mini") or MODEL_NAME
+AUTO_ROUTE = "auto"
+QUICK_MAX_CHARS = 60
+DEEP_MIN_CHARS = 200
+
+# 英文關鍵字用 (?<![a-z]) 而不是 \b：中文字也算 \w，「請問table 2」之間沒有 \b
+
+SMALL_TALK_PATTERN = re.compile(
+    r"^(?:hi|hello|hey|thanks|thank you|thx|ok|okay|got it|cool|great|"
+    r"你好|您好|哈囉|嗨|早安|午安|晚安|謝謝(?:你|您)?|感謝|好的|了解|懂了|明白了|收到|掰掰|再見)[\W_]*$",
+    re.IGNORECASE,
+)
+LOOKUP_PATTERN = re.compile(
+    r"(?<![a-z])(?:figure|fig|table|equation|eq|page|section|appendix|which|where|who|when|how many|how much|"
+    r"dataset|author)s?(?![a-z])|"
+    r"圖\s*\d|表\s*\d|第\s*\d+\s*[頁節章]|哪[一些]?[頁節章個篇年]|在哪|幾[頁個位年]|多少|是誰|什麼時候|作者|資料集",
+    re.IGNORECASE,
+)
+DEEP_PATTERN = re.compile(
+    r"(?<![a-z])(?:why|critique|limitation|weakness|assumption|compar|trade-?off|evaluat|assess|justif|"
+    r"deriv|prove|proof|methodolog|validity)|"
+    r"為什麼|為何|批判|評論|評估|限制|缺點|弱點|假設|比較|差異|取捨|推導|證明|合理|方法論|有效性",
+    re.IGNORECASE,
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    """Model, reasoning effort and verbosity for one turn, and why they were picked."""
+    name: str
+    model: str
+    effort: str
+    verbosity: str
+    use_pdf: bool = True
+    reason: str = ""
+
+
+ROUTES = {
+    "chat": Route("chat", ROUTER_SMALL_MODEL, "minimal", "low", use_pdf=False),
+    "quick": Route("quick", ROUTER_SMALL_MODEL, "low", "low"),
+    "standard": Route("standard", MODEL_NAME, "medium", "medium"),
+    "deep": Route("deep", MODEL_NAME, "high", "medium"),
+}
+ROUTE_CHOICES = [("自動判斷", AUTO_ROUTE), ("快速", "quick"), ("標準", "standard"), ("深入", "deep")]
+
+
+def route_question(user_message: str, override: Optional[str] = AUTO_ROUTE) -> Route:
+    """Pick a route from the question alone; no model call, so it costs microseconds."""
+    if override and override != AUTO_ROUTE:
+        return replace(ROUTES[override], reason="使用者指定")
+    if not ADAPTIVE_ROUTING:
+        return replace(ROUTES["standard"], reason="路由關閉")
+
+    text = user_message.strip()
+    if SMALL_TALK_PATTERN.match(text):
+        # 寒暄不需要論文段落，也不需要推理
+        return replace(ROUTES["chat"], reason="寒暄")
+    if len(text) >= DEEP_MIN_CHARS:
+        return replace(ROUTES["deep"], reason="長問題")
+    if DEEP_PATTERN.search(text):
+        return replace(ROUTES["deep"], reason="分析、比較或推導")
+    if len(text) <= QUICK_MAX_CHARS and LOOKUP_PATTERN.search(text):
+        return replace(ROUTES["quick"], reason="查找型短問題")
+    return replace(ROUTES["standard"], reason="一般說明")
+
+
+# --- Answer cache ------------------------------------------------------------
+
+# Reuse answers to repeated questions about the same paper; PAPER_ANSWER_CACHE=0 disables
+ANSWER_CACHE_ENABLED = os.getenv("PAPER_ANSWER_CACHE", "1") != "0"
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("PAPER_ANSWER_CACHE_TTL", str(6 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("PAPER_ANSWER_CACHE_SIZE", "512"))
+# 字元 bigram 的 Jaccard 相似度門檻；1 表示只接受正規化後完全相同的問題
+ANSWER_CACHE_SIMILARITY = float(os.getenv("PAPER_ANSWER_CACHE_SIMILARITY", "0.8"))
+
+# 指向前文的追問（「剛剛那個」「再解釋一次」）答案取決於對話內容，不能共用
+FOLLOW_UP_PATTERN = re.compile(
+    r"(?<![a-z])(?:it|that|this one|above|previous|earlier|you said|again|more|continue|elaborate)(?![a-z])|"
+    r"剛剛|剛才|上面|前面|你說|你剛|那個|這個|它|他們|再解釋|再說|繼續|還有呢|舉個例|換個|為什麼呢",
+    re.IGNORECASE,
+)
+
+
+def normalize_question(text: str) -> str:
+    """NFKC folds full-width forms; then keep only letters and digits, lower-cased."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] in "LN")
+
+
+def char_bigrams(text: str) -> FrozenSet[str]:
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1)) or frozenset([text])
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    bigrams: FrozenSet[str]
+    numbers: Tuple[str, ...]
+    expires_at: float
+
+
+class AnswerCache:
+    """LRU + TTL cache of answers, scoped by (paper digest, route).
+
+    Lookups try the normalized question first, then the most similar
+    question in the same scope by character-bigram Jaccard similarity.
+    Numbers must match exactly, so "表 2" never answers "表 3".
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self._entries: OrderedDict = OrderedDict()  # (scope, normalized question) -> CachedAnswer
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, scope: Tuple[str, str], question: str) -> Optional[Tuple[str, float]]:
+        """(answer, similarity) for a fresh entry in this scope, or None."""
+        normalized = normalize_question(question)
+        bigrams = char_bigrams(normalized)
+        numbers = tuple(re.findall(r"\d+", normalized))
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry.expires_at <= now]:
+                del self._entries[key]
+
+            best_key, best_score = None, 0.0
+            if (scope, normalized) in self._entries:
+                best_key, best_score = (scope, normalized), 1.0
+            elif self.similarity < 1:
+                for key, entry in self._entries.items():
+                    if key[0] != scope or entry.numbers != numbers:
+                        continue
+                    score = len(bigrams & entry.bigrams) / len(bigrams | entry.bigrams)
+                    if score > best_score:
+                        best_key, best_score = key, score
+
+            if best_key is None or best_score < self.similarity:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            return self._entries[best_key].answer, best_score
+
+    def store(self, scope: Tuple[str, str], question: str, answer: str) -> None:
+        normalized = normalize_question(question)
+        entry = CachedAnswer(answer, char_bigrams(normalized), tuple(re.findall(r"\d+", normalized)),
+                             time.monotonic() + self.ttl_seconds)
+        with self._lock:
+            self._entries[(scope, normalized)] = entry
+            self._entries.move_to_end((scope, normalized))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def hit_rate(self) -> str:
+        lookups = self.hits + self.misses
+        return f"{self.hits / lookups:.0%}" if lookups else "—"
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIMILARITY)
+
+
+def answer_cache_scope(session: SessionState, route: Route, user_message: str) -> Optional[Tuple[str, str]]:
+    """Cache scope (paper hash, route) for a question whose answer can be shared, else None.
+
+    Only answers about an uploaded, fully read paper are shared. Besides
+    the first turn, a later question counts as context-free when it
+    doesn't match FOLLOW_UP_PATTERN; that heuristic is the whole test,
+    so a follow-up phrased without any of its cue words is still cached.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    # 沒有上傳論文時是一般聊天，答案不該給其他學生
+    if not session.pdf_state.digest:
+        return None
+    first_turn = not session.conversation_history and not session.history_summary
+    if not first_turn and FOLLOW_UP_PATTERN.search(user_message):
+        return None
+    # 同一位學生再問一次，代表上次的答案沒有幫上忙，不要原封不動再給一次
+    asked = {normalize_question(message["content"]) for message in session.conversation_history
+             if message["role"] == "user"}
+    if normalize_question(user_message) in asked:
+        return None
+    # 論文還沒讀完時的答案只根據部分內容，不能給之後的人
+    if not session.pdf_state.complete:
+        return None
+    return session.pdf_state.digest, route.name
+
+
+# --- Background PDF ingestion ------------------------------------------------
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="pdf-ingest")
+
+
+def progress_bar(done: int, total: int, width: int = 10) -> str:
+    filled = width * done // total if total else width
+    return "▓" * filled + "░" * (width - filled)
+
+
+class IngestJob:
+    """One uploaded PDF read on ingest_executor: hash, cache lookup, extraction, chunking, indexing.
+
+    Status notes go to a queue that upload_pdf relays to the UI. A PDFState
+    is published to the session as soon as the first shard is indexed and
+    again after every later shard, so chat answers from the pages read so
+    far while the rest of the paper is extracted. Each shard is chunked
+    and added to one growing index, so reading a paper costs the same as
+    indexing it once.
+    """
+
+    def __init__(self, pdf_path: str, session: SessionState):
+        self.pdf_path = pdf_path
+        self.filename = os.path.basename(pdf_path)
+        self.session = session
+        session.ingest_job += 1
+        self.job_id = session.ingest_job
+        self.version = session.pdf_state.version + 1
+        self.request = RequestMetrics("upload")
+        self.notes: "queue.Queue[Optional[str]]" = queue.Queue()  # None marks the end
+        self.status = ""
+        self.ready = threading.Event()  # 第一批頁面可以提問了，或讀取失敗
+        self.done = threading.Event()
+        self.prefix: Optional[Tuple[List[Chunk], Optional[Dict[str, str]]]] = None
+        self.index = BM25Index()
+        self.page_texts: List[str] = []
+
+    @property
+    def superseded(self) -> bool:
+        """A newer upload in the same session took over."""
+        return self.session.ingest_job != self.job_id
+
+    def report(self, note: str) -> None:
+        self.status = note
+        self.notes.put(note)
+
+    def wait(self, timeout: Optional[float] = None) -> str:
+        """Block until the whole paper is read; returns the final status note."""
+        self.done.wait(timeout)
+        return self.status
+
+    def publish(self, new_pages: List[Tuple[int, str]], digest: str, pages_ready: int,
+                page_count: int) -> Optional[PDFState]:
+        """Index the newly read pages and hand everything read so far to the session.
+
+        Returns None while there is no text yet or once a newer upload has
+        taken over.
+        """
+        if new_pages:
+            # 上一批最後的章節標題延續到這一批
+            section = self.index.chunks[-1].section if self.index.chunks else ""
+            with self.request.stage("pdf_chunk"):
+                chunks = chunk_pages(new_pages, section=section)
+            if self.prefix is None:
+                # 前綴只取第一批頁面，後面補上的頁面不會改變它；快取命中時算出的也一樣
+                self.prefix = paper_prefix([chunk for chunk in chunks if chunk.page <= PAGES_PER_SHARD])
+            with self.request.stage("pdf_index"):
+                self.index.add(chunks)
+            self.page_texts.append(format_pdf_pages(new_pages))
+        if not self.index.chunks:
+            return None
+        index = self.index.snapshot()
+        pdf_state = PDFState(
+            filename=self.filename,
+            content="".join(self.page_texts) if pages_ready >= page_count else None,
+            version=self.version,
+            chunks=index.chunks,
+            index=index,
+            digest=digest,
+            prefix_chunks=self.prefix[0],
+            prefix_message=self.prefix[1],
+            pages_ready=pages_ready,
+            page_count=page_count,
+        )
+        if self.superseded:
+            return None
+        self.session.pdf_state = pdf_state
+        if not self.ready.is_set():
+            self.request.stages_ms["first_pages"] = (time.perf_counter() - self.request.started) * 1000
+            self.ready.set()
+        return pdf_state
+
+    def run(self) -> None:
+        outcome, error = "ok", None
+        try:
+            self._ingest()
+        except Exception as exc:  # 背景工作的例外沒有人接，一律轉成狀態訊息
+            outcome, error = "error", exc
+            if self.superseded:
+                pass
+            elif self.ready.is_set():
+                # 已發布的頁面保留，仍然可以提問
+                self.report(f"⚠️ {self.filename} 只讀到第 {self.session.pdf_state.pages_ready} 頁：{exc}")
+            else:
+                # 保持狀態一致；保留版本號，下一份 PDF 仍會是新版本
+                self.session.pdf_state = PDFState(version=self.session.pdf_state.version)
+                self.report(f"❌ {exc}")
+        finally:
+            if outcome == "ok" and self.superseded:
+                outcome = "superseded"
+            metrics.record(self.request, outcome, error=error)
+            self.ready.set()
+            self.done.set()
+            self.notes.put(None)
+
+    def _ingest(self) -> None:
+        request = self.request
+        self.report(f"⏳ 正在讀取 {self.filename}：計算檔案雜湊…")
+        with request.stage("pdf_hash"):
+            try:
+                digest = pdf_sha256(self.pdf_path)
+            except OSError as exc:
+                raise ValueError(f"PDF 讀取失敗: {exc}") from exc
+
+        self.report(f"⏳ 正在讀取 {self.filename}：查詢文字快取…")
+        key = PDFTextCache.key_for(digest)
+        with request.stage("cache_lookup"):
+            cached = pdf_cache.get(key)
+        cache_hit = cached is not None
+
+        if cache_hit:
+            pages, page_count = cached
+            pdf_state = self.publish(pages, digest, page_count, page_count)
+        else:
+            self.report(f"⏳ 正在讀取 {self.filename}：提取第一批頁面…")
+            pages, pdf_state = [], None
+            shards = iter_pdf_pages(self.pdf_path)
+            while True:
+                with request.stage("pdf_extract"):
+                    shard, total = next(shards, ([], 0))
+                if not shard:
+                    break
+                page_count = total
+                if self.superseded:
+                    shards.close()
+                    return
+                new_pages = [(number, text) for number, text in shard if text]
+                pages.extend(new_pages)
+                pages_ready = shard[-1][0]
+                pdf_state = self.publish(new_pages, digest, pages_ready, page_count) or pdf_state
+                if pages_ready < page_count:
+                    ask = ("💬 已讀到的頁面可以先提問，其餘頁面讀完後會自動補上。" if pdf_state
+                           else "（前面幾頁沒有文字，繼續往下讀）")
+                    self.report(
+                        f"⏳ 正在讀取 {self.filename}\n"
+                        f"{progress_bar(pages_ready, page_count)} 第 {pages_ready} / {page_count} 頁\n\n{ask}"
+                    )
+            if not pages:
+                raise ValueError("PDF 中沒有可讀取的文字內容")
+            pdf_cache.put(key, pages, page_count)
+        if pdf_state is None or self.superseded:  # 被新的上傳取代
+            return
+
+        request.labels.update(pages=page_count, chunks=len(pdf_state.chunks), cache_hit=cache_hit)
+        read_ms = sum(request.stages_ms.get(stage, 0.0) for stage in ("pdf_hash", "cache_lookup", "pdf_extract"))
+        self.report(
+            "✅ PDF 上傳成功！\n\n"
+            f"📄 檔名：{pdf_state.filename}\n"
+            f"📄 版本：{pdf_state.version}\n"
+            f"📄 頁面數：{page_count}\n"
+            f"🔤 文字長度：約 {len(pdf_state.content):,} 字元\n"
+            f"🧩 檢索段落：{len(pdf_state.chunks)} 段（開頭 {len(pdf_state.prefix_chunks)} 段固定附上，"
+            f"每次提問再加最相關的 {RETRIEVAL_TOP_K} 段）\n"
+            f"🗂️ 提示快取鍵：{pdf_state.prompt_cache_key}\n"
+            f"⚡ 文字快取：{'命中' if cache_hit else '未命中'}（讀取 {read_ms:,.0f} ms，"
+            f"{request.stages_ms['first_pages']:,.0f} ms 後即可提問）\n"
+            f"📊 快取統計：{pdf_cache.stats()}\n\n"
+            "💬 你可以直接提問，我會依據最新的 PDF 回答。"
+        )
+
+
+def start_ingest(pdf_path: str, session: SessionState) -> IngestJob:
+    """Queue a PDF for background ingestion; earlier jobs of this session stop publishing."""
+    job = IngestJob(pdf_path, session)
+    ingest_executor.submit(job.run)
+    return job
+
+
+# --- Core chat logic ---------------------------------------------------------
+
+@dataclass
+class TurnRequest:
+    payload: Dict[str, Any]
+    delta: bool
+    pdf_version: int
+    excerpts: List[Chunk]
+    route: Route
+
+
+def build_request(session: SessionState, user_message: str, full: bool = False,
+                  route: Optional[Route] = None) -> TurnRequest:
+    """Request for one turn.
+
+    Messages run from most to least stable so the prompt cache covers as
+    much as possible: system prompt, paper prefix (fixed per paper),
+    history summary, history (append-only), then this question's
+    excerpts and the question itself.
+
+    With a previous_response_id the server already holds all of that, so
+    a delta request carries only excerpts the chain has not seen plus the
+    new question. full=True drops the chain and resends everything; so
+    does a chain that has grown past CHAIN_TOKEN_BUDGET, since excerpts
+    and paper prefixes pile up in it even after the history is summarised.
+    route (default: route_question) sets model, effort and verbosity, and
+    whether this question gets excerpts at all.
+    """
+    route = route or route_question(user_message)
+    pdf_state = session.pdf_state
+    chain = None if full else session.last_response_id
+    if chain and session.chained_tokens > CHAIN_TOKEN_BUDGET:
+        print(f"🔗 鏈已累積約 {session.chained_tokens:,} tokens，改送完整請求重新開始")
+        chain = None
+    delta = DELTA_REQUESTS and chain is not None
+    # 新的鏈，或鏈裡還是上一份 PDF：論文開頭要（重新）送一次
+    new_paper = not delta or pdf_state.version != session.chained_pdf_version
+
+    excerpts = pdf_state.excerpts(user_message) if route.use_pdf else []
+    if not new_paper:
+        excerpts = [chunk for chunk in excerpts if chunk not in session.chained_chunks]
+
+    messages: List[Dict[str, str]] = []
+    if not delta:
+        messages.append(SYSTEM_MESSAGE)
+    if new_paper and pdf_state.prefix_message:
+        messages.append(pdf_state.prefix_message)
+    if not delta:
+        if session.history_summary:
+            messages.append({
+                "role": "developer",
+                "content": HISTORY_SUMMARY_TEMPLATE.format(summary=session.history_summary),
+            })
+        messages.extend(session.conversation_history)
+
+    pdf_context = pdf_state.context_message(excerpts)
     if pdf_context:
         messages.append(pdf_context)
-
-    messages.extend(conversation_history)
     messages.append({"role": "user", "content": user_message})
 
     request_payload = {
-        "model": MODEL_NAME,
+        "model": route.model,
         "input": messages,
-        "reasoning": {"effort": "medium"},
-        "text": {"verbosity": "medium"},
+        "reasoning": {"effort": route.effort},
+        "text": {"verbosity": route.verbosity},
+        "prompt_cache_key": pdf_state.prompt_cache_key,
     }
-    if last_response_id:
-        request_payload["previous_response_id"] = last_response_id
+    if chain:
+        request_payload["previous_response_id"] = chain
+    sent = (pdf_state.prefix_chunks if new_paper else []) + excerpts
+    return TurnRequest(request_payload, delta, pdf_state.version, sent, route)
 
-    try:
-        response = client.responses.create(**request_payload)
-        assistant_reply = summarise_outputs(response)
-        if not assistant_reply:
-            assistant_reply = "⚠️ 模型未回傳文字，可再試一次或調整問題。"
 
-        conversation_history.append({"role": "user", "content": user_message})
-        conversation_history.append({"role": "assistant", "content": assistant_reply})
-        last_response_id = getattr(response, "id", None)
+def chain_lost(exc: Exception, turn: TurnRequest) -> bool:
+    """The previous_response_id expired, was deleted or was never stored."""
+    if "previous_response_id" not in turn.payload:
+        return False
+    if getattr(exc, "code", None) == "previous_response_not_found":
+        return True
+    return isinstance(exc, (BadRequestError, NotFoundError)) and "previous response" in str(exc).lower()
 
-        history.append([user_message, assistant_reply])
-        return history
 
+def create_response(session: SessionState, user_message: str, turn: TurnRequest,
+                    **kwargs: Any) -> Tuple[TurnRequest, Any]:
+    try:
+        return turn, client.responses.create(**turn.payload, **kwargs)
     except Exception as exc:
-        error_message = f"❌ 發生錯誤：{exc}\n\n請檢查網路連線與 API 設定後再試一次。"
-        history.append([user_message, error_message])
-        return history
+        if not chain_lost(exc, turn):
+            raise
+        print("🔗 previous_response_id 已失效，改送完整對話")
+        turn = build_request(session, user_message, full=True, route=turn.route)
+        return turn, client.responses.create(**turn.payload, **kwargs)
 
 
-def upload_pdf(pdf_file: Optional[str]):
-    global pdf_state
+async def create_response_async(session: SessionState, user_message: str, turn: TurnRequest,
+                                **kwargs: Any) -> Tuple[TurnRequest, Any]:
+    try:
+        return turn, await async_client.responses.create(**turn.payload, **kwargs)
+    except Exception as exc:
+        if not chain_lost(exc, turn):
+            raise
+        print("🔗 previous_response_id 已失效，改送完整對話")
+        turn = build_request(session, user_message, full=True, route=turn.route)
+        return turn, await async_client.responses.create(**turn.payload, **kwargs)
 
-    if pdf_file is None:
-        return "❌ 請選擇 PDF 檔案"
 
-    try:
-        content = extract_pdf_text(pdf_file)
-    except ValueError as exc:
-        pdf_state = PDFState()  # 保持狀態一致
-        return f"❌ {exc}"
-
-    pdf_state = PDFState(
-        filename=os.path.basename(pdf_file),
-        content=content,
-        version=pdf_state.version + 1,
-    )
+@dataclass
+class StreamProgress:
+    started: float
+    partial_reply: str = ""
+    response: Any = None
+    first_token_ms: Optional[float] = None
+
+    def apply(self, event: Any) -> bool:
+        """Fold one Responses stream event in; True when the visible text grew."""
+        if event.type == "response.output_text.delta":
+            if self.first_token_ms is None:
+                self.first_token_ms = (time.perf_counter() - self.started) * 1000
+            self.partial_reply += event.delta
+            return True
+        if event.type == "response.completed":
+            # openai SDK 在多執行緒同時冷啟動時，偶爾把 event.response 留成未轉型的 dict
+            response = event.response
+            self.response = Response.model_validate(response) if isinstance(response, dict) else response
+        elif event.type == "response.failed":
+            raise RuntimeError(getattr(event.response.error, "message", "模型回應失敗"))
+        elif event.type == "error":
+            raise RuntimeError(event.message)
+        return False
+
+    def reply(self) -> str:
+        if self.response is None:
+            raise RuntimeError("串流中斷，未收到完整回應")
+        return self.partial_reply or summarise_outputs(self.response)
 
-    page_count = content.count("--- Page") or "?"
-    char_count = len(content)
 
-    note = (
-        "✅ PDF 上傳成功！\n\n"
-        f"📄 檔名：{pdf_state.filename}\n"
-        f"📄 版本：{pdf_state.version}\n"
-        f"📄 頁面數：約 {page_count}\n"
-        f"🔤 文字長度：約 {char_count:,} 字元\n\n"
-        "💬 你可以直接提問，我會依據最新的 PDF 回答。"
+@dataclass
+class PromptCacheStats:
+    """Billed vs. cached input tokens across every session since startup."""
+    input_tokens: int = 0
+    cached_tokens: int = 0
+
+    def record(self, usage: Any) -> Tuple[Optional[int], Optional[int]]:
+        billed = getattr(usage, "input_tokens", None)
+        cached = getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None)
+        if billed:
+            self.input_tokens += billed
+            self.cached_tokens += cached or 0
+        return billed, cached
+
+    def hit_rate(self) -> str:
+        if not self.input_tokens:
+            return "—"
+        return f"{self.cached_tokens / self.input_tokens:.0%}"
+
+
+prompt_cache_stats = PromptCacheStats()
+
+
+def record_turn(session: SessionState, turn: TurnRequest, user_message: str,
+                assistant_reply: str, response: Any, progress: StreamProgress) -> str:
+    if not assistant_reply:
+        assistant_reply = "⚠️ 模型未回傳文字，可再試一次或調整問題。"
+
+    route = turn.route
+    print(f"🧭 路由 {route.name}（{route.reason}）：{route.model}，effort {route.effort}，verbosity {route.verbosity}")
+
+    total_ms = (time.perf_counter() - progress.started) * 1000
+    if progress.first_token_ms is not None:
+        print(f"⏱️ 首字延遲 {progress.first_token_ms:,.0f} ms，完整回應 {total_ms:,.0f} ms")
+
+    # 本輪實際送出的 token（本地估算）、API 計費的輸入 token（含 previous_response_id 鏈）與其中命中快取的部分
+    sent_tokens = sum(estimate_tokens(message["content"]) for message in turn.payload["input"])
+    billed_tokens, cached_tokens = prompt_cache_stats.record(getattr(response, "usage", None))
+    billed = f"{billed_tokens:,}" if billed_tokens is not None else "?"
+    cached = f"{cached_tokens:,}" if cached_tokens is not None else "?"
+    print(f"📥 輸入 token：送出約 {sent_tokens:,}，計費 {billed}，快取 {cached}，"
+          f"累計快取率 {prompt_cache_stats.hit_rate()}（{'delta' if turn.delta else '完整'}請求）")
+
+    with session.lock:
+        session.conversation_history.append({"role": "user", "content": user_message})
+        session.conversation_history.append({"role": "assistant", "content": assistant_reply})
+        session.last_response_id = getattr(response, "id", None)
+
+        if not turn.delta or turn.pdf_version != session.chained_pdf_version:
+            session.chained_chunks = set()
+        session.chained_chunks.update(turn.excerpts)
+        session.chained_pdf_version = turn.pdf_version
+        carried = session.chained_tokens if "previous_response_id" in turn.payload else 0
+        session.chained_tokens = carried + sent_tokens + estimate_tokens(assistant_reply)
+
+    maybe_compact_history(session)
+    return assistant_reply
+
+
+def observe_turn(request: RequestMetrics, turn: TurnRequest, progress: Optional[StreamProgress],
+                 response: Any = None, error: Optional[Exception] = None) -> None:
+    if progress is not None:
+        if progress.first_token_ms is not None:
+            request.stages_ms["first_token"] = progress.first_token_ms
+        request.stages_ms["response"] = (time.perf_counter() - progress.started) * 1000
+    request.labels.update(
+        mode="delta" if turn.delta else "full",
+        route=turn.route.name,
+        model=turn.payload["model"],
+        stream=STREAM_RESPONSES,
     )
-    return note
+    metrics.record(request, "error" if error else "ok", getattr(response, "usage", None), error)
+
+
+def answer_from_cache(session: SessionState, request: RequestMetrics, route: Route,
+                      scope: Optional[Tuple[str, str]], user_message: str) -> Optional[str]:
+    """Cached answer for this question, recorded in the session like a normal turn; None on a miss."""
+    if scope is None:
+        return None
+    with request.stage("cache_lookup"):
+        hit = answer_cache.lookup(scope, user_message)
+    if hit is None:
+        return None
+
+    answer, similarity = hit
+    print(f"💾 答案快取命中（相似度 {similarity:.2f}），累計命中率 {answer_cache.hit_rate()}")
+    with session.lock:
+        session.conversation_history.append({"role": "user", "content": user_message})
+        session.conversation_history.append({"role": "assistant", "content": answer})
+        # 伺服器端的鏈裡沒有這一輪，下一輪改送完整對話
+        session.last_response_id = None
+    maybe_compact_history(session)
+    request.labels.update(mode="cache", route=route.name, model=route.model, stream=STREAM_RESPONSES)
+    metrics.record(request, "cache_hit")
+    return answer
+
+
+def error_reply(exc: Exception) -> str:
+    return f"❌ 發生錯誤：{exc}\n\n請檢查網路連線與 API 設定後再試一次。"
+
+
+def chat_with_paper(message: str, history: Optional[List[List[str]]],
+                    session: Optional[SessionState] = None, answer_mode: str = AUTO_ROUTE):
+    """Generator: yields (history, session) as text deltas arrive.
+
+    The session's conversation_history and last_response_id are only
+    updated once the response completes, so a dropped stream leaves no
+    half-finished turn. answer_mode overrides the route picked by
+    route_question.
+    """
+    history = ensure_history(history)
+    session = ensure_session(session)
+    user_message = (message or "").strip()
+    if not user_message:
+        yield history, session
+        return
+
+    apply_history_summary(session)
+    request = RequestMetrics("chat")
+    route = route_question(user_message, answer_mode)
+    scope = answer_cache_scope(session, route, user_message)
+    cached = answer_from_cache(session, request, route, scope, user_message)
+    if cached is not None:
+        history.append([user_message, cached])
+        yield history, session
+        return
+
+    with request.stage("build_request"):
+        turn = build_request(session, user_message, route=route)
+    history.append([user_message, ""])
+    yield history, session
+
+    progress = None
+    try:
+        progress = StreamProgress(started=time.perf_counter())
+        if STREAM_RESPONSES:
+            turn, stream = create_response(session, user_message, turn, stream=True)
+            for event in stream:
+                if progress.apply(event):
+                    history[-1] = [user_message, progress.partial_reply]
+                    yield history, session
+            assistant_reply = progress.reply()
+            response = progress.response
+        else:
+            turn, response = create_response(session, user_message, turn)
+            assistant_reply = summarise_outputs(response)
+
+        assistant_reply = record_turn(session, turn, user_message, assistant_reply, response, progress)
+        observe_turn(request, turn, progress, response)
+        if scope is not None and assistant_reply.strip() and not assistant_reply.startswith("⚠️"):
+            answer_cache.store(scope, user_message, assistant_reply)
+        history[-1] = [user_message, assistant_reply]
+        yield history, session
+
+    except Exception as exc:
+        observe_turn(request, turn, progress, error=exc)
+        history[-1] = [user_message, error_reply(exc)]
+        yield history, session
+
+
+async def chat_with_paper_async(message: str, history: Optional[List[List[str]]],
+                                session: Optional[SessionState] = None, answer_mode: str = AUTO_ROUTE):
+    """Async twin of chat_with_paper on AsyncOpenAI.
 
+    Runs on Gradio's event loop instead of a worker thread; at most
+    MAX_INFLIGHT_REQUESTS calls are open at once and the rest wait on
+    the semaphore.
+    """
+    history = ensure_history(history)
+    session = ensure_session(session)
+    user_message = (message or "").strip()
+    if not user_message:
+        yield history, session
+        return
+
+    apply_history_summary(session)
+    request = RequestMetrics("chat")
+    route = route_question(user_message, answer_mode)
+    scope = answer_cache_scope(session, route, user_message)
+    # 快取命中不需要排隊等 API
+    cached = answer_from_cache(session, request, route, scope, user_message)
+    if cached is not None:
+        history.append([user_message, cached])
+        yield history, session
+        return
+
+    with request.stage("build_request"):
+        turn = build_request(session, user_message, route=route)
+    history.append([user_message, "⏳ 目前提問的人比較多，排隊中⋯" if request_slots.locked() else ""])
+    yield history, session
+
+    progress = None
+    try:
+        waiting_since = time.perf_counter()
+        async with request_slots:
+            request.stages_ms["queue_wait"] = (time.perf_counter() - waiting_since) * 1000
+            progress = StreamProgress(started=time.perf_counter())
+            if STREAM_RESPONSES:
+                turn, stream = await create_response_async(session, user_message, turn, stream=True)
+                async for event in stream:
+                    if progress.apply(event):
+                        history[-1] = [user_message, progress.partial_reply]
+                        yield history, session
+                assistant_reply = progress.reply()
+                response = progress.response
+            else:
+                turn, response = await create_response_async(session, user_message, turn)
+                assistant_reply = summarise_outputs(response)
+
+        assistant_reply = record_turn(session, turn, user_message, assistant_reply, response, progress)
+        observe_turn(request, turn, progress, response)
+        if scope is not None and assistant_reply.strip() and not assistant_reply.startswith("⚠️"):
+            answer_cache.store(scope, user_message, assistant_reply)
+        history[-1] = [user_message, assistant_reply]
+        yield history, session
+
+    except Exception as exc:
+        observe_turn(request, turn, progress, error=exc)
+        history[-1] = [user_message, error_reply(exc)]
+        yield history, session
 
-def clear_conversation():
-    global conversation_history, last_response_id
-    conversation_history = []
-    last_response_id = None
-    return [], "🔄 對話已清除！PDF 設定保持不變。"
+
+def upload_pdf(pdf_file: Optional[str], session: Optional[SessionState] = None):
+    """Read a PDF in the background and stream each stage to the upload status box.
+
+    Yields (status, session); chat can start from the first indexed pages
+    while the rest of the paper is still being extracted.
+    """
+    session = ensure_session(session)
+
+    if pdf_file is None:
+        yield "❌ 請選擇 PDF 檔案", session
+        return
+
+    job = start_ingest(pdf_file, session)
+    for note in iter(job.notes.get, None):
+        if job.superseded:
+            return  # 狀態欄交給新上傳的 PDF
+        yield note, session
+
+
+def clear_conversation(session: Optional[SessionState] = None):
+    session = ensure_session(session)
+    with session.lock:
+        session.conversation_history = []
+        session.last_response_id = None
+        session.chained_chunks = set()
+        session.chained_tokens = 0
+        session.history_summary = ""
+        # 還在背景進行的摘要屬於舊對話，完成後直接丟棄
+        session.pending_summary = None
+    return [], "🔄 對話已清除！PDF 設定保持不變。", session
 
 
 # --- Gradio UI ---------------------------------------------------------------
@@ -255,22 +1724,40 @@ with gr.Blocks(title="論文閱讀助手 (Fixed)", theme=gr.themes.Soft()) as de
             with gr.Row():
                 submit_btn = gr.Button("📤 送出", variant="primary")
                 clear_btn = gr.Button("🔄 清除對話")
+                answer_mode = gr.Dropdown(
+                    choices=ROUTE_CHOICES,
+                    value=AUTO_ROUTE,
+                    label="回答模式",
+                    info="自動判斷會依問題決定推理強度與回答長度",
+                )
+
+    # 每個瀏覽器分頁各自一份，第一次事件時由 ensure_session 建立；
+    # 每次事件回傳 session 會重設閒置計時
+    session_state = gr.State(None, time_to_live=SESSION_IDLE_SECONDS)
+
+    # "multiple"：讀取中重新上傳時不必等上一份讀完，舊的工作會自動讓位
+    pdf_upload.change(upload_pdf, inputs=[pdf_upload, session_state], outputs=[upload_status, session_state],
+                      trigger_mode="multiple")
 
-    pdf_upload.change(upload_pdf, inputs=pdf_upload, outputs=upload_status)
+    # The async handler is bounded by request_slots, not by Gradio's worker limit
+    chat_handler = chat_with_paper_async if USE_ASYNC_CLIENT else chat_with_paper
+    chat_concurrency = None if USE_ASYNC_CLIENT else "default"
 
     submit_btn.click(
-        fn=chat_with_paper,
-        inputs=[msg_input, chatbot],
-        outputs=chatbot,
+        fn=chat_handler,
+        inputs=[msg_input, chatbot, session_state, answer_mode],
+        outputs=[chatbot, session_state],
+        concurrency_limit=chat_concurrency,
     ).then(lambda: "", outputs=msg_input)
 
     msg_input.submit(
-        fn=chat_with_paper,
-        inputs=[msg_input, chatbot],
-        outputs=chatbot,
+        fn=chat_handler,
+        inputs=[msg_input, chatbot, session_state, answer_mode],
+        outputs=[chatbot, session_state],
+        concurrency_limit=chat_concurrency,
     ).then(lambda: "", outputs=msg_input)
 
-    clear_btn.click(fn=clear_conversation, outputs=[chatbot, upload_status])
+    clear_btn.click(fn=clear_conversation, inputs=session_state, outputs=[chatbot, upload_status, session_state])
 
     gr.Markdown(
         """
@@ -278,11 +1765,14 @@ with gr.Blocks(title="論文閱讀助手 (Fixed)", theme=gr.themes.Soft()) as de
 ### 使用建議
 
 - 首次提問可先請我用一句話概述論文。
-- 如果文字過長被截斷，請嘗試分章節提問。
+- 問題越具體（提到章節、圖表或關鍵字），我找到的論文段落就越準確。
 - 重新上傳 PDF 後，直接提問即可，我會參考最新版本。
+- 大型論文不必等全部讀完：狀態欄顯示前幾頁已讀好後就可以開始提問。
         """
     )
 
 
 if __name__ == "__main__":
+    start_metrics_server()
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT, max_size=QUEUE_MAX_SIZE)
     demo.launch(share=True, debug=True)
@@ -0,0 +1,18 @@
+"""PDF page extraction for the paper assistant's worker processes.
+
+Kept apart from paper_assistant_fixed so unpickling the task in a worker
+imports only PyPDF2, not Gradio, the OpenAI client and the rest of the app.
+"""
+from typing import List, Tuple
+
+import PyPDF2
+
+
+def extract_page_range(pdf_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """Extract pages [start, stop) as (page number, text); each call opens its own reader."""
+    with open(pdf_path, "rb") as handle:
+        pdf_reader = PyPDF2.PdfReader(handle)
+        return [
+            (index + 1, (pdf_reader.pages[index].extract_text() or "").strip())
+            for index in range(start, stop)
+        ]
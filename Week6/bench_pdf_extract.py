@@ -0,0 +1,100 @@
+"""
+Benchmark serial vs. parallel PDF text extraction in the paper assistant
+Generates synthetic text-heavy PDFs of increasing page count and times
+extract_pdf_pages with one worker and with the shared process pool
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Importing the assistant builds an OpenAI client; no request is ever sent
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test-mock-key')
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'Codex'))
+
+from paper_assistant_fixed import extract_pdf_pages  # noqa: E402
+
+
+PAGE_COUNTS = [8, 16, 32, 64, 128]
+LINES_PER_PAGE = 70  # about one column of a conference paper
+
+WORDS = ("model attention layer training loss dataset baseline results we propose method "
+         "transformer gradient benchmark accuracy evaluation experiment section figure table").split()
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def write_synthetic_pdf(path, pages, seed=0):
+    """Write a minimal valid PDF with LINES_PER_PAGE lines of Helvetica text per page"""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page ids are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for number in range(1, pages + 1):
+        lines = [f"Page {number}"] + [' '.join(rng.choice(WORDS) for _ in range(14))
+                                      for _ in range(LINES_PER_PAGE)]
+        stream = "BT /F1 9 Tf 11 TL 50 800 Td " + ' '.join(f"({_escape(line)}) Tj T*" for line in lines) + " ET"
+        stream = stream.encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        page_ids.append(len(objects))
+    kids = ' '.join(f"{page_id} 0 R" for page_id in page_ids).encode('ascii')
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    body = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for object_id, content in enumerate(objects, start=1):
+        offsets.append(len(body))
+        body += b"%d 0 obj\n%s\nendobj\n" % (object_id, content)
+    xref = len(body)
+    body += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    body += b''.join(b"%010d 00000 n \n" % offset for offset in offsets)
+    body += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    Path(path).write_bytes(body)
+
+
+def best_time(pdf_path, max_workers, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        pages = extract_pdf_pages(pdf_path, max_workers=max_workers)
+        times.append(time.perf_counter() - started)
+    return min(times), pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serial vs. parallel PDF text extraction")
+    parser.add_argument('--pages', type=int, action='append',
+                        help="page count to test (repeatable; default: 8 16 32 64 128)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="shards in flight on the shared process pool (default: CPU count)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement (default: 3)")
+    args = parser.parse_args()
+
+    print(f"🧪 PDF extraction: serial vs. {args.workers or os.cpu_count()} workers "
+          f"(best of {args.repeat})")
+    print(f"  {'pages':>6} {'serial':>10} {'parallel':>10} {'speed-up':>9}")
+    with tempfile.TemporaryDirectory(prefix='bench-pdf-') as workdir:
+        for pages in args.pages or PAGE_COUNTS:
+            pdf_path = os.path.join(workdir, f"paper_{pages}.pdf")
+            write_synthetic_pdf(pdf_path, pages)
+            serial, serial_pages = best_time(pdf_path, 1, args.repeat)
+            parallel, parallel_pages = best_time(pdf_path, args.workers, args.repeat)
+            if serial_pages != parallel_pages:
+                print(f"  ❌ {pages} pages: parallel extraction returned different text")
+                sys.exit(1)
+            print(f"  {pages:>6} {serial * 1000:>8.0f}ms {parallel * 1000:>8.0f}ms {serial / parallel:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
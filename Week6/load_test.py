@@ -0,0 +1,190 @@
+"""
+Load-test the paper assistant's chat handlers against the local mock API
+Starts mock_responses_server in-process (or uses --base-url), then lets N
+simulated students upload the same paper and ask a few questions each
+through chat_with_paper_async (or chat_with_paper with --sync, on a thread
+pool the size of Gradio's concurrency limit). Like the UI, students start
+asking as soon as the first pages are indexed. Reports throughput and
+p50/p95/p99 of the time until the paper can be asked about, to first
+token and of whole answers.
+
+    uv run python load_test.py --students 100 --turns 4 --ttft-ms 800
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from mock_responses_server import add_config_arguments, config_from_args, serve
+
+QUESTIONS = [
+    "這篇論文的主要貢獻是什麼？",
+    "可以用簡單的例子解釋注意力機制嗎？",
+    "實驗用了哪些資料集？",
+    "作者和哪些 baseline 比較？結果如何？",
+    "這個方法有什麼限制？",
+    "What problem does the paper try to solve?",
+    "Explain the training setup in plain words.",
+    "Figure 1 在第幾頁？",
+    "為什麼這個方法比 RNN 好？",
+    "謝謝！",
+]
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return "    -      -      -"
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return f"{pick(0.5):>6.0f} {pick(0.95):>6.0f} {pick(0.99):>6.0f}"
+
+
+class Results:
+    def __init__(self):
+        self.pdf_ready = []
+        self.first_token = []
+        self.answer = []
+        self.routes = []
+        self.errors = []
+
+
+def drive_sync_turn(assistant, question, history, session, submitted):
+    """One chat_with_paper call on a pool thread; latencies count from submission, queueing included"""
+    first = None
+    for history, session in assistant.chat_with_paper(question, history, session):
+        if first is None and history and history[-1][1]:
+            first = time.perf_counter() - submitted
+    return history, session, first, time.perf_counter() - submitted
+
+
+async def drive_async_turn(assistant, question, history, session):
+    started = time.perf_counter()
+    first = None
+    async for history, session in assistant.chat_with_paper_async(question, history, session):
+        reply = history[-1][1] if history else ""
+        if first is None and reply and not reply.startswith("⏳"):
+            first = time.perf_counter() - started
+    return history, session, first, time.perf_counter() - started
+
+
+async def student(number, assistant, args, pdf_path, pool, results):
+    rng = random.Random(number)
+    await asyncio.sleep(rng.uniform(0, args.ramp_s))
+    session = assistant.SessionState()
+    history = []
+    if pdf_path:
+        started = time.perf_counter()
+        job = assistant.start_ingest(pdf_path, session)
+        await asyncio.to_thread(job.ready.wait)
+        if job.status.startswith("❌"):
+            results.errors.append(job.status)
+            return
+        results.pdf_ready.append(time.perf_counter() - started)
+
+    loop = asyncio.get_running_loop()
+    for _ in range(args.turns):
+        question = rng.choice(QUESTIONS)
+        if pool is None:
+            history, session, first, total = await drive_async_turn(assistant, question, history, session)
+        else:
+            history, session, first, total = await loop.run_in_executor(
+                pool, drive_sync_turn, assistant, question, history, session, time.perf_counter())
+        reply = history[-1][1]
+        if reply.startswith("❌"):
+            results.errors.append(reply.splitlines()[0])
+        else:
+            results.first_token.append(first if first is not None else total)
+            results.answer.append(total)
+            results.routes.append(assistant.route_question(question).name)
+        await asyncio.sleep(rng.uniform(0, 2 * args.think_ms / 1000))
+
+
+async def run(assistant, args, pdf_path):
+    results = Results()
+    pool = ThreadPoolExecutor(max_workers=assistant.CONCURRENCY_LIMIT) if args.sync else None
+    started = time.perf_counter()
+    await asyncio.gather(*(student(number, assistant, args, pdf_path, pool, results)
+                           for number in range(args.students)))
+    if pool is not None:
+        pool.shutdown()
+    return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the chat handlers against a mock Responses API")
+    parser.add_argument('--students', type=int, default=50, help="concurrent simulated students (default: 50)")
+    parser.add_argument('--turns', type=int, default=3, help="questions per student (default: 3)")
+    parser.add_argument('--think-ms', type=float, default=500, help="mean pause between questions (default: 500)")
+    parser.add_argument('--ramp-s', type=float, default=2, help="spread student arrivals over this many seconds")
+    parser.add_argument('--pages', type=int, default=12, help="pages of the uploaded paper; 0 = no PDF (default: 12)")
+    parser.add_argument('--sync', action='store_true', help="drive chat_with_paper instead of the async handler")
+    parser.add_argument('--max-inflight', type=int, default=None, help="override PAPER_MAX_INFLIGHT")
+    parser.add_argument('--verbose', action='store_true', help="keep the assistant's per-turn log lines")
+    parser.add_argument('--base-url', default=None,
+                        help="use an already running mock instead of starting one, e.g. http://127.0.0.1:8765/v1")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    if args.base_url is None:
+        server = serve(0, config_from_args(args))
+        args.base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    workdir = tempfile.TemporaryDirectory(prefix='load-test-')
+    # The assistant reads its settings at import time, so they go in before the import
+    os.environ['OPENAI_BASE_URL'] = args.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-test-mock-key')
+    os.environ['PAPER_METRICS_LOG'] = ''
+    os.environ['PAPER_CACHE_PATH'] = os.path.join(workdir.name, 'cache.sqlite3')
+    if args.max_inflight:
+        os.environ['PAPER_MAX_INFLIGHT'] = str(args.max_inflight)
+    sys.path.insert(0, str(Path(__file__).resolve().parent / 'Codex'))
+    import paper_assistant_fixed as assistant
+    from bench_pdf_extract import write_synthetic_pdf
+
+    pdf_path = None
+    if args.pages:
+        pdf_path = os.path.join(workdir.name, 'paper.pdf')
+        write_synthetic_pdf(pdf_path, args.pages)
+
+    handler = (f"chat_with_paper on {assistant.CONCURRENCY_LIMIT} threads" if args.sync
+               else f"chat_with_paper_async, {assistant.MAX_INFLIGHT_REQUESTS} in flight")
+    print(f"🧪 Load test: {args.students} students × {args.turns} turns, {handler}")
+    print(f"   API: {args.base_url}")
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        results, elapsed = asyncio.run(run(assistant, args, pdf_path))
+    workdir.cleanup()
+
+    done = len(results.answer)
+    print(f"  turns        {done} ok / {len(results.errors)} errors in {elapsed:.1f}s "
+          f"→ {done / elapsed:.1f} turns/s")
+    print(f"  {'latency ms':<12} {'p50':>6} {'p95':>6} {'p99':>6}")
+    if results.pdf_ready:
+        print(f"  {'pdf ready':<12} {percentiles(results.pdf_ready)}")
+    print(f"  {'first token':<12} {percentiles(results.first_token)}")
+    print(f"  {'full answer':<12} {percentiles(results.answer)}")
+    for route in assistant.ROUTES:
+        answers = [total for name, total in zip(results.routes, results.answer) if name == route]
+        if answers:
+            print(f"  {'  ' + route:<12} {percentiles(answers)}  ({len(answers)} turns, full answer)")
+    tokens = assistant.metrics.tokens
+    if tokens.get("input"):
+        print(f"  tokens       input {tokens['input']:,} (cached {tokens['cached'] / tokens['input']:.0%}), "
+              f"output {tokens['output']:,}")
+    cache = assistant.answer_cache
+    if cache.hits + cache.misses:
+        print(f"  answer cache {cache.hits} hits / {cache.hits + cache.misses} lookups ({cache.hit_rate()})")
+    for error in sorted(set(results.errors))[:5]:
+        print(f"  ❌ {error}")
+    if results.errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
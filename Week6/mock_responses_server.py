@@ -0,0 +1,280 @@
+"""
+Local stand-in for the OpenAI Responses API, for offline load tests
+Implements the part of POST /v1/responses the paper assistant uses: plain
+and streamed (SSE) responses, previous_response_id chains and usage with
+cached / reasoning tokens. Latency and answer length are drawn from
+configurable log-normal distributions.
+
+    uv run python mock_responses_server.py --port 8765 --ttft-ms 800
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 uv run python Codex/paper_assistant_fixed.py
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+WORDS = ("這篇 論文 提出 一種 新的 方法 ， 用 注意力 機制 取代 遞迴 結構 。 想像 你 在 讀 一本書 ，"
+         " 每個 字 都 可以 直接 看到 其他 所有 字 。 你 覺得 這樣 做 有 什麼 好處 ？").split()
+MAX_STORED_RESPONSES = 100_000
+CACHE_MIN_TOKENS = 1024  # 和真正的 API 一樣：前綴至少 1024 tokens 才會快取，之後以 128 為單位
+CACHE_BLOCK_TOKENS = 128
+# Time to first token and reasoning tokens relative to reasoning.effort = "medium"
+EFFORT_SCALE = {"minimal": 0.1, "low": 0.4, "medium": 1.0, "high": 2.5}
+# Answer length relative to text.verbosity = "medium"
+VERBOSITY_SCALE = {"low": 0.4, "medium": 1.0, "high": 1.8}
+
+
+@dataclass
+class MockConfig:
+    ttft_ms: float = 800           # median time to first token at medium effort
+    ttft_sigma: float = 0.5        # log-normal spread of the time to first token
+    tokens_per_second: float = 80  # streaming speed once the first token is out
+    output_tokens: int = 250       # median answer length at medium verbosity
+    output_sigma: float = 0.4
+    reasoning_ratio: float = 1.0   # reasoning tokens per output token
+    error_rate: float = 0.0        # share of requests answered with HTTP 500
+    seed: Optional[int] = None
+
+
+def estimate_tokens(text):
+    return max(1, len(text.encode('utf-8')) // 4)
+
+
+def _message_tokens(messages):
+    return [estimate_tokens(json.dumps(message, ensure_ascii=False, sort_keys=True)) for message in messages]
+
+
+class MockState:
+    """Stored responses (for previous_response_id) and the last prompt seen per cache key"""
+
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.responses = OrderedDict()  # id -> tokens held by the chain up to and including it
+        self.prompts = {}               # prompt_cache_key -> (messages, per-message tokens)
+
+    def sample(self, effort_scale, length_scale):
+        with self.lock:
+            ttft = effort_scale * self.config.ttft_ms / 1000 * math.exp(self.rng.gauss(0, self.config.ttft_sigma))
+            median = length_scale * self.config.output_tokens
+            output = max(1, int(median * math.exp(self.rng.gauss(0, self.config.output_sigma))))
+            failed = self.rng.random() < self.config.error_rate
+        return ttft, output, failed
+
+    def chain_tokens(self, response_id):
+        with self.lock:
+            if response_id not in self.responses:
+                return None
+            self.responses.move_to_end(response_id)
+            return self.responses[response_id]
+
+    def cached_tokens(self, cache_key, messages, chained):
+        """Chained context counts as cached; otherwise the common prefix with the last prompt under this key"""
+        tokens = _message_tokens(messages)
+        with self.lock:
+            previous, previous_tokens = self.prompts.get(cache_key, ([], []))
+            self.prompts[cache_key] = (messages, tokens)
+        common = chained
+        if not chained:
+            for old, new, count in zip(previous, messages, tokens):
+                if old != new:
+                    break
+                common += count
+        if common < CACHE_MIN_TOKENS:
+            return 0, sum(tokens)
+        return common // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS, sum(tokens)
+
+    def store(self, chain_total):
+        with self.lock:
+            response_id = f"resp_mock_{next(self.ids)}"
+            self.responses[response_id] = chain_total
+            while len(self.responses) > MAX_STORED_RESPONSES:
+                self.responses.popitem(last=False)
+        return response_id
+
+
+def _response_object(response_id, body, text, usage):
+    return {
+        "id": response_id,
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": "completed",
+        "model": body.get("model", "gpt-5"),
+        "previous_response_id": body.get("previous_response_id"),
+        "error": None,
+        "incomplete_details": None,
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "reasoning": body.get("reasoning"),
+        "text": body.get("text"),
+        "output": [{
+            "type": "message",
+            "id": f"msg_{response_id}",
+            "status": "completed",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "usage": usage,
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_event(self, sequence, event):
+        event["sequence_number"] = sequence
+        data = json.dumps(event, ensure_ascii=False)
+        self._send_chunk(f"event: {event['type']}\ndata: {data}\n\n".encode('utf-8'))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.rstrip("/") != "/v1/responses":
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        state = self.state
+        chained = 0
+        previous_id = body.get("previous_response_id")
+        if previous_id:
+            chained = state.chain_tokens(previous_id)
+            if chained is None:
+                self._send_json(400, {"error": {
+                    "message": f"Previous response with id '{previous_id}' not found.",
+                    "type": "invalid_request_error",
+                    "param": "previous_response_id",
+                    "code": "previous_response_not_found",
+                }})
+                return
+
+        effort_scale = EFFORT_SCALE.get((body.get("reasoning") or {}).get("effort", "medium"), 1.0)
+        length_scale = VERBOSITY_SCALE.get((body.get("text") or {}).get("verbosity", "medium"), 1.0)
+        ttft, output_tokens, failed = state.sample(effort_scale, length_scale)
+        if failed:
+            time.sleep(ttft)
+            self._send_json(500, {"error": {"message": "The server had an error while processing your request.",
+                                            "type": "server_error"}})
+            return
+
+        messages = body.get("input") or []
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+        cached, new_tokens = state.cached_tokens(body.get("prompt_cache_key"), messages, chained)
+        reasoning = int(output_tokens * state.config.reasoning_ratio * effort_scale)
+        usage = {
+            "input_tokens": chained + new_tokens,
+            "input_tokens_details": {"cached_tokens": cached, "cache_write_tokens": 0},
+            "output_tokens": output_tokens + reasoning,
+            "output_tokens_details": {"reasoning_tokens": reasoning},
+            "total_tokens": chained + new_tokens + output_tokens + reasoning,
+        }
+        with state.lock:
+            words = [state.rng.choice(WORDS) for _ in range(output_tokens)]
+        text = ''.join(words)
+        response_id = state.store(chained + new_tokens + output_tokens)
+        response = _response_object(response_id, body, text, usage)
+
+        if not body.get("stream"):
+            time.sleep(ttft + output_tokens / state.config.tokens_per_second)
+            self._send_json(200, response)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sequence = itertools.count()
+        try:
+            self._send_event(next(sequence), {"type": "response.created",
+                                              "response": {**response, "status": "in_progress", "output": []}})
+            time.sleep(ttft)
+            for word in words:
+                self._send_event(next(sequence), {
+                    "type": "response.output_text.delta", "item_id": f"msg_{response_id}",
+                    "output_index": 0, "content_index": 0, "delta": word, "logprobs": [],
+                })
+                time.sleep(1 / state.config.tokens_per_second)
+            self._send_event(next(sequence), {"type": "response.completed", "response": response})
+            self._send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 使用者中途離開
+
+
+def serve(port=0, config=None, host="127.0.0.1"):
+    """Start the mock on a daemon thread; returns the server (server.server_port is the bound port)"""
+    handler = type("BoundMockHandler", (MockHandler,), {"state": MockState(config or MockConfig())})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-responses", daemon=True).start()
+    return server
+
+
+def add_config_arguments(parser):
+    defaults = MockConfig()
+    parser.add_argument('--ttft-ms', type=float, default=defaults.ttft_ms,
+                        help=f"median time to first token in ms at medium effort (default: {defaults.ttft_ms:g})")
+    parser.add_argument('--ttft-sigma', type=float, default=defaults.ttft_sigma,
+                        help=f"log-normal spread of the time to first token (default: {defaults.ttft_sigma:g})")
+    parser.add_argument('--tokens-per-second', type=float, default=defaults.tokens_per_second,
+                        help=f"streaming speed (default: {defaults.tokens_per_second:g})")
+    parser.add_argument('--output-tokens', type=int, default=defaults.output_tokens,
+                        help=f"median answer length in tokens at medium verbosity (default: {defaults.output_tokens})")
+    parser.add_argument('--output-sigma', type=float, default=defaults.output_sigma,
+                        help=f"log-normal spread of the answer length (default: {defaults.output_sigma:g})")
+    parser.add_argument('--reasoning-ratio', type=float, default=defaults.reasoning_ratio,
+                        help=f"reasoning tokens per output token at medium effort (default: {defaults.reasoning_ratio:g})")
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate,
+                        help="share of requests answered with HTTP 500 (default: 0)")
+    parser.add_argument('--seed', type=int, default=None, help="random seed for reproducible runs")
+
+
+def config_from_args(args):
+    return MockConfig(ttft_ms=args.ttft_ms, ttft_sigma=args.ttft_sigma, tokens_per_second=args.tokens_per_second,
+                      output_tokens=args.output_tokens, output_sigma=args.output_sigma,
+                      reasoning_ratio=args.reasoning_ratio, error_rate=args.error_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI Responses API for load tests")
+    parser.add_argument('--host', default="127.0.0.1", help="address to bind (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="port to listen on (default: 8765)")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = serve(args.port, config_from_args(args), args.host)
+    print(f"🧪 Mock Responses API on http://{args.host}:{server.server_port}/v1")
+    print(f"   export OPENAI_BASE_URL=http://{args.host}:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Python script generated from: Week6/論文閱讀助手.md
-Generated on: 1760867432.7444682
+Source SHA-256: e45dbf9d0bde3f133e793f632e44e29b44d60fadc08b6967a830cf2b2bc41d3b
 Note: Colab-specific commands (!pip, %magic) have been commented out
 """
 
@@ -13,70 +13,486 @@ import os
 api_key = userdata.get('OpenAI')
 os.environ['OPENAI_API_KEY'] = api_key
 
-from openai import OpenAI
+from openai import AsyncOpenAI, BadRequestError, DefaultAsyncHttpxClient, NotFoundError, OpenAI
+from openai.types.responses import Response
 import gradio as gr
+import httpx
 import PyPDF2
-from dataclasses import dataclass
-from typing import List, Dict, Optional, Any
+import asyncio
+import bisect
+import copy
+import hashlib
+import json
+import math
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, FrozenSet, Iterable, Iterator, Optional, Any, Set, Tuple
 
 client = OpenAI()
 MODEL_NAME = "gpt-5"
 
-def extract_pdf_text(pdf_path: str) -> str:
+# 串流輸出：回答一邊產生一邊顯示（設為 False 則等完整回應後才顯示）
+STREAM_RESPONSES = True
+
+# Delta 請求：接續 previous_response_id 時只送新問題（設為 False 則每次重送完整對話）
+DELTA_REQUESTS = True
+
+# 非同步模式：所有請求在同一個 event loop 上等待，不必一個請求佔一條 thread
+USE_ASYNC_CLIENT = True
+# 同時送出的 API 請求上限，超過的在 semaphore 前排隊
+MAX_INFLIGHT_REQUESTS = 32
+# Gradio 佇列最多容納的等待事件數，超過時直接回覆「佇列已滿」
+QUEUE_MAX_SIZE = 128
+
+# 非同步 client：連線池大小和請求上限一致，每個請求都能重用已建立的 TLS 連線
+async_client = AsyncOpenAI(
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=MAX_INFLIGHT_REQUESTS,
+            max_keepalive_connections=MAX_INFLIGHT_REQUESTS,
+            keepalive_expiry=120,
+        ),
+    ),
+)
+request_slots = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+
+# 頁數少於此值時逐頁提取
+PARALLEL_MIN_PAGES = 16
+PAGES_PER_SHARD = 8
+
+# 所有上傳共用的提取 thread pool，不必每份 PDF 都重開一個
+extract_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="pdf-extract")
+
+
+def _extract_page_range(pdf_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
     """
-    從上傳的 PDF 檔案中提取文字內容
+    提取第 start 到 stop-1 頁（0 起算）的文字
+
+    每次呼叫各自開啟 PDF，不同 thread 不會共用同一個 PdfReader。
+
+    Returns:
+        [(頁碼, 文字), ...]，頁碼從 1 起算
+    """
+    with open(pdf_path, "rb") as handle:
+        pdf_reader = PyPDF2.PdfReader(handle)
+        # 注意：page.extract_text() 可能回傳 None，需要處理
+        return [
+            (index + 1, (pdf_reader.pages[index].extract_text() or "").strip())
+            for index in range(start, stop)
+        ]
+
+
+def iter_pdf_pages(pdf_path: str, max_workers: Optional[int] = None) -> Iterator[Tuple[List[Tuple[int, str]], int]]:
+    """
+    依頁碼順序，一段一段地提取 PDF 文字
 
-    這個函數會：
-    1. 逐頁讀取 PDF 內容
-    2. 過濾掉空白頁面
-    3. 標記頁碼方便定位
-    4. 限制最大長度避免超過 Token 限制
+    每段 PAGES_PER_SHARD 頁，包含沒有文字的頁面，呼叫端可以據此回報進度。
+    頁數達到 PARALLEL_MIN_PAGES 時交給 extract_executor 平行提取，
+    同時最多 max_workers 段；max_workers=1 可強制逐頁提取。
 
     Args:
         pdf_path: PDF 檔案路徑
+        max_workers: 同時提取的段數上限（預設為 CPU 核心數）
 
-    Returns:
-        str: 提取的文字內容
+    Yields:
+        ([(頁碼, 文字), ...], 總頁數)
 
     Raises:
-        ValueError: 當 PDF 無法讀取或內容為空時
+        ValueError: 當 PDF 無法讀取時
     """
     if not pdf_path:
         raise ValueError("未提供 PDF 檔案")
 
-    text_segments: List[str] = []
-
     try:
         with open(pdf_path, "rb") as handle:
-            pdf_reader = PyPDF2.PdfReader(handle)
+            page_count = len(PyPDF2.PdfReader(handle).pages)
+
+        if not page_count:
+            raise ValueError("PDF 中沒有可用頁面")
+
+        workers = min(max_workers or os.cpu_count() or 1, -(-page_count // PAGES_PER_SHARD))
+        done = 0
+
+        if page_count >= PARALLEL_MIN_PAGES and workers > 1:
+            starts = iter(range(0, page_count, PAGES_PER_SHARD))
+            pending: deque[Future] = deque()
+
+            def submit_next() -> None:
+                start = next(starts, None)
+                if start is not None:
+                    pending.append(extract_executor.submit(
+                        _extract_page_range, pdf_path, start, min(start + PAGES_PER_SHARD, page_count),
+                    ))
+
+            try:
+                # 一次只排 workers 段，其他上傳也能分到 thread；依提交順序取回，頁碼自然保持順序
+                for _ in range(workers):
+                    submit_next()
+                while pending:
+                    shard = pending.popleft().result()
+                    submit_next()
+                    yield shard, page_count
+                    done += len(shard)
+            except RuntimeError as exc:
+                # 程式結束時 pool 已關閉：從還沒讀的頁面改用逐頁提取
+                print(f"⚠️ PDF 提取 thread pool 無法使用，從第 {done + 1} 頁起改用逐頁提取：{exc}")
+            finally:
+                # 呼叫端提早關閉產生器（例如被新的上傳取代）時，不再讀剩下的頁面
+                for future in pending:
+                    future.cancel()
+
+        for start in range(done, page_count, PAGES_PER_SHARD):
+            yield _extract_page_range(pdf_path, start, min(start + PAGES_PER_SHARD, page_count)), page_count
 
-            if not pdf_reader.pages:
-                raise ValueError("PDF 中沒有可用頁面")
+    except Exception as exc:
+        raise ValueError(f"PDF 讀取失敗: {exc}") from exc
 
-            # 逐頁提取文字
-            for index, page in enumerate(pdf_reader.pages, start=1):
-                # 注意：page.extract_text() 可能回傳 None，需要處理
-                page_text = page.extract_text() or ""
 
-                # 只加入有內容的頁面
-                if page_text.strip():
-                    text_segments.append(f"\n--- Page {index} ---\n{page_text.strip()}")
+def extract_pdf_pages(pdf_path: str, max_workers: Optional[int] = None) -> List[Tuple[int, str]]:
+    """
+    一次提取每一頁的文字，依頁碼排序並過濾掉空白頁面
 
-    except Exception as exc:
-        raise ValueError(f"PDF 讀取失敗: {exc}") from exc
+    Args:
+        pdf_path: PDF 檔案路徑
+        max_workers: 同時提取的段數上限（預設為 CPU 核心數）
 
-    if not text_segments:
+    Returns:
+        [(頁碼, 文字), ...]
+
+    Raises:
+        ValueError: 當 PDF 無法讀取時
+    """
+    # 只保留有內容的頁面
+    return [
+        (number, text)
+        for shard, _ in iter_pdf_pages(pdf_path, max_workers)
+        for number, text in shard
+        if text
+    ]
+
+
+def format_pdf_pages(pages: List[Tuple[int, str]]) -> str:
+    """
+    把各頁文字組合成要交給模型的內容
+
+    每頁前面標記頁碼方便定位。全文不再截斷，
+    提問時由檢索索引（5.2 節）挑出相關段落注入。
+
+    Args:
+        pages: extract_pdf_pages 的結果
+
+    Returns:
+        str: 組合後的文字內容
+
+    Raises:
+        ValueError: 當內容為空時
+    """
+    if not pages:
         raise ValueError("PDF 中沒有可讀取的文字內容")
 
     # 合併所有頁面
-    combined = "".join(text_segments)
+    return "".join(f"\n--- Page {number} ---\n{text}" for number, text in pages)
+
+
+def extract_pdf_text(pdf_path: str, max_workers: Optional[int] = None) -> str:
+    """
+    從上傳的 PDF 檔案中提取文字內容
+
+    Args:
+        pdf_path: PDF 檔案路徑
+        max_workers: 平行提取時同時提取的段數上限
+
+    Returns:
+        str: 提取的文字內容
+
+    Raises:
+        ValueError: 當 PDF 無法讀取或內容為空時
+    """
+    return format_pdf_pages(extract_pdf_pages(pdf_path, max_workers))
+
+# 提取邏輯或快取內容的格式改變時遞增，讓舊的快取失效（v2 起多存總頁數）
+EXTRACTOR_VERSION = 2
+PDF_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "paper_assistant", "pdf_text.sqlite3")
+PDF_CACHE_MAX_BYTES = 200 * 1024 * 1024  # 200 MB
+
+
+def pdf_sha256(pdf_path: str) -> str:
+    """計算 PDF 檔案內容的 SHA-256（分塊讀取，不會一次載入整個檔案）"""
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PDFTextCache:
+    """
+    以 SQLite 儲存提取結果的快取
+
+    每篇論文存成一筆壓縮過的 JSON（{"page_count": 總頁數, "pages": [[頁碼, 文字], ...]}），
+    並記錄最後使用時間，總大小超過上限時從最久沒用的開始刪除。
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # Gradio 在多個執行緒呼叫 handler，每次操作各開一條連線
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def key_for(digest: str) -> str:
+        return f"{digest}:v{EXTRACTOR_VERSION}"
+
+    def get(self, key: str) -> Optional[Tuple[List[Tuple[int, str]], int]]:
+        """取出快取的 (頁面, 總頁數)，並更新最後使用時間；沒有則回傳 None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE pages SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        entry = json.loads(zlib.decompress(row[0]))
+        return [tuple(page) for page in entry["pages"]], entry["page_count"]
+
+    def put(self, key: str, pages: List[Tuple[int, str]], page_count: int) -> None:
+        """存入頁面和總頁數，超過容量時淘汰最久沒用的項目（不會淘汰剛存入的這筆）"""
+        entry = {"page_count": page_count, "pages": pages}
+        data = zlib.compress(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (key, data, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            for old_key, size in conn.execute("SELECT key, size FROM pages ORDER BY last_used").fetchall():
+                if total <= self.max_bytes or old_key == key:
+                    break
+                conn.execute("DELETE FROM pages WHERE key = ?", (old_key,))
+                total -= size
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        rate = f"{self.hits / lookups:.0%}" if lookups else "-"
+        return f"命中 {self.hits} / 未命中 {self.misses}，命中率 {rate}"
+
+
+pdf_cache = PDFTextCache(PDF_CACHE_PATH, PDF_CACHE_MAX_BYTES)
+
+
+CHUNK_MAX_CHARS = 1200         # 每段的字元上限
+RETRIEVAL_TOP_K = 6            # 每次提問最多注入幾段
+RETRIEVAL_TOKEN_BUDGET = 3000  # 注入段落的 token 上限（估計值）
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_NAMED_SECTION = (
+    r"(?i:abstract|introduction|related work|background|preliminaries|method(?:s|ology)?|approach"
+    r"|experiments?|evaluation|results|discussion|limitations|conclusions?|references"
+    r"|acknowledge?ments?|appendix)"
+)
+# "3.2 Training Setup", "IV. RESULTS" 或單獨一行的章節名稱
+_HEADING = re.compile(
+    rf"^(?:(?:\d{{1,2}}(?:\.\d{{1,2}})*\.?|[IVX]+\.)\s+[A-Z][^.!?]{{0,70}}|{_NAMED_SECTION}:?)$"
+)
+_WORD = re.compile(r"[a-z0-9]+")
+_CJK_RUN = re.compile(r"[\u3400-\u9fff]+")
+
+
+@dataclass(frozen=True)
+class Chunk:
+    """一段可檢索的論文內容（frozen：可以放進 set，記錄哪些段落已送過）"""
+    page: int      # 所在頁碼
+    section: str   # 所屬章節標題（找不到時為空字串）
+    text: str
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    把文字切成檢索用的詞彙
+
+    英文：轉小寫後的單字與數字
+    中文：相鄰兩字一組（「注意力機制」→ 注意、意力、力機、機制），不需要斷詞套件
+    """
+    lowered = text.lower()
+    tokens = _WORD.findall(lowered)
+    for run in _CJK_RUN.findall(lowered):
+        tokens.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數：中文一字約一個 token，其他約四個字元一個 token"""
+    cjk = sum(len(run) for run in _CJK_RUN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def chunk_pages(pages: List[Tuple[int, str]], max_chars: int = CHUNK_MAX_CHARS,
+                section: str = "") -> List[Chunk]:
+    """
+    依頁面與章節把全文切成段落
+
+    遇到章節標題或累積超過 max_chars 就開始新的一段；
+    段落不會跨頁，方便回答時引用頁碼。
+
+    Args:
+        pages: [(頁碼, 文字), ...]
+        max_chars: 每段最多幾個字元
+        section: 第一頁之前的章節標題；一批一批切時傳入上一批最後的章節，結果和整篇一起切相同
+    """
+    chunks: List[Chunk] = []
+
+    for number, text in pages:
+        buffer: List[str] = []
+        size = 0
+
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+
+            is_heading = _HEADING.match(line) is not None
+            if buffer and (is_heading or size + len(line) > max_chars):
+                chunks.append(Chunk(number, section, "\n".join(buffer)))
+                buffer, size = [], 0
+            if is_heading:
+                section = line
+
+            # PyPDF2 偶爾把整頁吐成一行，太長的行再切開
+            for start in range(0, len(line), max_chars):
+                piece = line[start:start + max_chars]
+                if buffer and size + len(piece) > max_chars:
+                    chunks.append(Chunk(number, section, "\n".join(buffer)))
+                    buffer, size = [], 0
+                buffer.append(piece)
+                size += len(piece) + 1
+
+        if buffer:
+            chunks.append(Chunk(number, section, "\n".join(buffer)))
+
+    return chunks
+
+
+class BM25Index:
+    """
+    BM25 檢索索引
+
+    倒排索引：詞彙 → [(段落編號, 出現次數), ...]
+    查詢時只需要看問題裡出現的詞彙，不必掃過整篇論文。
 
-    # 防止超過 Token 限制（約 15000 字元）
-    MAX_PDF_CHARS = 15000
-    if len(combined) > MAX_PDF_CHARS:
-        combined = combined[:MAX_PDF_CHARS] + "\n\n... (內容過長，已截斷。請分段提問以獲得完整解說。)"
+    背景讀取時每讀完一批就 add() 新的段落，舊的段落不用重建。
+    search() 只看前 len(self.chunks) 個段落，分數和只用這些段落建的索引完全相同，
+    所以交給對話的 snapshot() 在後面繼續加入段落時仍然有效。
+    """
 
-    return combined
+    def __init__(self, chunks: Iterable[Chunk] = ()):
+        self.chunks: List[Chunk] = []
+        # 每個詞的 postings 依段落編號遞增，search 只取快照看得到的前段
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: List[int] = []
+        self.length_sums: List[int] = [0]  # length_sums[n] = sum(lengths[:n])
+        self.add(chunks)
+
+    def add(self, chunks: Iterable[Chunk]) -> None:
+        """把新的段落接在後面建索引"""
+        for chunk in chunks:
+            chunk_id = len(self.lengths)
+            # 章節標題也納入索引，問「實驗結果」時比較容易找到 Results 章節
+            counts = Counter(tokenize(f"{chunk.section}\n{chunk.text}"))
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, []).append((chunk_id, frequency))
+            self.lengths.append(sum(counts.values()))
+            self.length_sums.append(self.length_sums[-1] + self.lengths[-1])
+            # 最後才加入段落，快照看到的段落一定已經建好索引
+            self.chunks.append(chunk)
+
+    def snapshot(self) -> "BM25Index":
+        """目前已建好索引的段落的唯讀視圖（和原索引共用 postings，不要再對它 add）"""
+        view = copy.copy(self)
+        view.chunks = list(self.chunks)
+        return view
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """回傳分數最高的 top_k 個 (段落編號, 分數)"""
+        scores: Dict[int, float] = defaultdict(float)
+        total = len(self.chunks)
+        if not total:
+            return []
+        average_length = self.length_sums[total] / total or 1.0
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            # 快照之後才加入的段落不算
+            visible = bisect.bisect_left(postings, (total,))
+            if not visible:
+                continue
+            # 越少段落出現的詞越有鑑別力
+            idf = math.log(1 + (total - visible + 0.5) / (visible + 0.5))
+            for chunk_id, frequency in postings[:visible]:
+                norm = frequency + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk_id] / average_length)
+                scores[chunk_id] += idf * frequency * (BM25_K1 + 1) / norm
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+
+def select_chunks(index: BM25Index, query: str, top_k: int, token_budget: int,
+                  exclude: Set[Chunk] = frozenset()) -> List[Chunk]:
+    """
+    挑出最相關、且總量不超過 token_budget 的段落，依閱讀順序回傳
+
+    exclude 裡的段落（已經在固定前綴裡）直接跳過，不佔 top_k 的名額
+    """
+    ranked = [
+        chunk_id for chunk_id, _ in index.search(query, top_k + len(exclude))
+        if index.chunks[chunk_id] not in exclude
+    ][:top_k]
+    if not ranked:
+        # 問題和論文沒有共同字詞（例如用中文問英文論文）時，提供論文開頭
+        ranked = [
+            chunk_id for chunk_id in range(min(top_k, len(index.chunks)))
+            if index.chunks[chunk_id] not in exclude
+        ]
+
+    selected: List[int] = []
+    used = 0
+    for chunk_id in ranked:
+        cost = estimate_tokens(index.chunks[chunk_id].text)
+        if used + cost > token_budget:
+            continue
+        selected.append(chunk_id)
+        used += cost
+
+    return [index.chunks[chunk_id] for chunk_id in sorted(selected)]
+
+
+def format_chunks(chunks: List[Chunk]) -> str:
+    """每段前面標註頁碼與章節，方便模型引用"""
+    return "\n\n".join(
+        f"[第 {chunk.page} 頁{' · ' + chunk.section if chunk.section else ''}]\n{chunk.text}"
+        for chunk in chunks
+    )
 
 SYSTEM_PROMPT = """你是一位專業的論文閱讀助手，專門幫助學生理解學術論文。
 
@@ -138,10 +554,84 @@ WELCOME_MESSAGE = """👋 嗨！我是你的**論文閱讀助手 & AI 對話夥
 準備好了嗎？開始你的探索之旅吧！ 🚀✨"""
 
 PDF_CONTEXT_TEMPLATE = (
-    "以下是使用者提供的論文內容 (檔名: {filename}, 版本: {version})，回答時務必引用此內容：\n"
+    "以下是使用者提供的論文中與目前問題最相關的段落 (檔名: {filename}, 版本: {version})，"
+    "回答時務必引用此內容：\n"
     "{content}"
 )
 
+# 論文還在背景讀取時附在段落後面，讓模型知道後面的頁面還看不到
+PDF_PARTIAL_NOTE = "\n\n（論文仍在讀取中，目前只讀到第 1–{ready} 頁，共 {total} 頁；後面的內容還看不到）"
+
+# 固定前綴放入的論文開頭 token 數（prompt cache 至少需要 1024 tokens 才會生效）
+PREFIX_TOKEN_BUDGET = 2000
+# 沒有 PDF 時的快取鍵
+GENERAL_CACHE_KEY = "paper-assistant"
+
+# 建好一次，每個請求都放同一個物件
+SYSTEM_MESSAGE = {"role": "developer", "content": SYSTEM_PROMPT}
+
+PAPER_PREFIX_TEMPLATE = (
+    "以下是使用者上傳的論文開頭，作為整體背景；之後會另外附上與每個問題最相關的段落：\n"
+    "{content}"
+)
+
+
+def paper_prefix(chunks: List[Chunk]) -> Tuple[List[Chunk], Optional[Dict[str, str]]]:
+    """
+    取論文開頭的段落（不超過 PREFIX_TOKEN_BUDGET）做成固定前綴
+
+    只依論文內容決定，不含檔名或 session 資訊，
+    所以每位上傳同一篇論文的同學送出的位元組完全相同。
+
+    Args:
+        chunks: 切好的論文段落（閱讀順序）
+
+    Returns:
+        tuple: (放進前綴的段落, 前綴訊息；沒有段落時為 None)
+    """
+    selected: List[Chunk] = []
+    used = 0
+    for chunk in chunks:
+        cost = estimate_tokens(chunk.text)
+        if selected and used + cost > PREFIX_TOKEN_BUDGET:
+            break
+        selected.append(chunk)
+        used += cost
+
+    if not selected:
+        return [], None
+    return selected, {"role": "user", "content": PAPER_PREFIX_TEMPLATE.format(content=format_chunks(selected))}
+
+
+@dataclass
+class PromptCacheStats:
+    """從啟動到現在，所有 session 的計費輸入 token 與命中快取的 token"""
+    input_tokens: int = 0
+    cached_tokens: int = 0
+
+    def record(self, usage: Any) -> Tuple[Optional[int], Optional[int]]:
+        """
+        記錄一次回應的 usage
+
+        Returns:
+            tuple: (計費輸入 token, 命中快取的 token)；API 沒回傳時為 None
+        """
+        billed = getattr(usage, "input_tokens", None)
+        cached = getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None)
+        if billed:
+            self.input_tokens += billed
+            self.cached_tokens += cached or 0
+        return billed, cached
+
+    def hit_rate(self) -> str:
+        """累計快取命中率"""
+        if not self.input_tokens:
+            return "—"
+        return f"{self.cached_tokens / self.input_tokens:.0%}"
+
+
+prompt_cache_stats = PromptCacheStats()
+
 @dataclass
 class PDFState:
     """
@@ -149,40 +639,135 @@ class PDFState:
 
     Attributes:
         filename: PDF 檔名
-        content: 提取的文字內容
+        content: 提取的完整文字內容（整篇讀完後才組合一次，讀取中為 None）
         version: PDF 版本號（每次上傳新 PDF 會遞增）
+        chunks: 切好的檢索段落
+        index: 段落的 BM25 索引
+        digest: PDF 的 SHA-256（決定提示快取鍵）
+        prefix_chunks: 放在固定前綴裡的論文開頭段落
+        prefix_message: 固定前綴訊息（上傳時建好一次，之後每輪原封不動送出）
+        pages_ready: 已經讀好的頁數（背景讀取時會一批一批增加）
+        page_count: PDF 總頁數
     """
     filename: Optional[str] = None
     content: Optional[str] = None
     version: int = 0
+    chunks: List[Chunk] = field(default_factory=list)
+    index: Optional[BM25Index] = None
+    digest: str = ""
+    prefix_chunks: List[Chunk] = field(default_factory=list)
+    prefix_message: Optional[Dict[str, str]] = None
+    pages_ready: int = 0
+    page_count: int = 0
+
+    @property
+    def complete(self) -> bool:
+        """整篇論文都讀完了（沒有 PDF 時也算）"""
+        return self.pages_ready >= self.page_count
+
+    @property
+    def prompt_cache_key(self) -> str:
+        """以內容雜湊命名：同一篇論文不論檔名、哪位學生上傳，都共用同一個快取"""
+        return f"paper-{self.digest[:16]}" if self.digest else GENERAL_CACHE_KEY
+
+    def excerpts(self, query: str = "") -> List[Chunk]:
+        """
+        找出和 query 最相關的段落
+
+        Args:
+            query: 使用者目前的問題
+
+        Returns:
+            List[Chunk]: 依閱讀順序排列的段落，沒有 PDF 時為空列表
+        """
+        if not self.chunks or not self.filename or self.index is None:
+            return []
+        # 固定前綴已經有的段落不用再放一次
+        return select_chunks(self.index, query, RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET,
+                             exclude=set(self.prefix_chunks))
 
-    def context_message(self) -> Optional[Dict[str, str]]:
+    def context_message(self, excerpts: List[Chunk]) -> Optional[Dict[str, str]]:
         """
-        產生包含 PDF 內容的訊息物件
+        產生包含論文段落的訊息物件
 
-        這個訊息會在每次 API 呼叫時插入，確保模型知道當前的 PDF 內容。
-        使用版本號可以讓模型區分不同的 PDF。
+        只放入和問題最相關的段落，而不是整篇論文。
+        使用版本號可以讓模型區分不同的 PDF；論文還沒讀完時，
+        加註目前讀到第幾頁。
+
+        Args:
+            excerpts: 要放入的段落（由 excerpts() 取得）
 
         Returns:
-            包含 PDF 內容的 user 訊息，如果沒有 PDF 則回傳 None
+            包含論文段落的 user 訊息，沒有段落時回傳 None
         """
-        if not self.content or not self.filename:
+        if not excerpts:
             return None
 
-        return {
-            "role": "user",
-            "content": PDF_CONTEXT_TEMPLATE.format(
-                filename=self.filename,
-                version=self.version,
-                content=self.content,
-            ),
-        }
+        content = PDF_CONTEXT_TEMPLATE.format(
+            filename=self.filename,
+            version=self.version,
+            content=format_chunks(excerpts),
+        )
+        if not self.complete:
+            content += PDF_PARTIAL_NOTE.format(ready=self.pages_ready, total=self.page_count)
+        return {"role": "user", "content": content}
+
+
+@dataclass
+class PendingSummary:
+    """
+    背景執行緒正在寫的對話摘要（見 8.1）
 
+    Attributes:
+        history: 取快照時的 conversation_history 列表（清除對話會換成新列表）
+        folded: 快照：要濃縮的最舊幾則訊息
+        previous_summary: 取快照時的摘要
+        future: summary_executor 上的摘要工作
+    """
+    history: List[Dict[str, str]]
+    folded: List[Dict[str, str]]
+    previous_summary: str
+    future: Future
 
-# 全域狀態變數
-conversation_history: List[Dict[str, str]] = []  # 儲存對話歷史（user 和 assistant 訊息）
-last_response_id: Optional[str] = None  # Response API 的 previous_response_id
-pdf_state = PDFState()  # PDF 狀態
+
+@dataclass
+class SessionState:
+    """
+    單一使用者（瀏覽器分頁）的所有狀態
+
+    Attributes:
+        conversation_history: 儲存對話歷史（user 和 assistant 訊息）
+        last_response_id: Response API 的 previous_response_id
+        pdf_state: 這位使用者上傳的 PDF
+        chained_pdf_version: previous_response_id 鏈裡的 PDF 版本
+        chained_chunks: 已經送進鏈裡的段落（delta 請求不重送）
+        chained_tokens: 鏈裡累積的估計 token 數（送過的所有輸入加上所有回答）
+        history_summary: 較早對話的摘要（已從 conversation_history 移除）
+        pending_summary: 背景進行中的摘要，由處理請求的執行緒套用
+        lock: 處理請求的執行緒修改歷史、摘要或鏈時持有
+        ingest_job: 最近一次上傳的編號（較舊的背景讀取看到編號變了就停止）
+    """
+    conversation_history: List[Dict[str, str]] = field(default_factory=list)
+    last_response_id: Optional[str] = None
+    pdf_state: PDFState = field(default_factory=PDFState)
+    chained_pdf_version: int = 0
+    chained_chunks: Set[Chunk] = field(default_factory=set)
+    chained_tokens: int = 0
+    history_summary: str = ""
+    pending_summary: Optional[PendingSummary] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    ingest_job: int = 0
+
+
+def ensure_session(session: Optional[SessionState]) -> SessionState:
+    """直接呼叫 handler（例如測試）時沒有 gr.State，就建立新的 session"""
+    return session if session is not None else SessionState()
+
+
+# 閒置超過此秒數的 session 由 Gradio 刪除，釋放對話與 PDF 索引
+SESSION_IDLE_SECONDS = 60 * 60
+# 同時處理的請求數（Gradio 預設每個事件一次只處理一個請求）
+CONCURRENCY_LIMIT = 16
 
 def summarise_outputs(response: Any) -> str:
     """
@@ -231,165 +816,1321 @@ def ensure_history(history: Optional[List[List[str]]]) -> List[List[str]]:
     """
     return list(history) if history else []
 
-def chat_with_paper(message: str, history: Optional[List[List[str]]]):
+# 摘要 + 逐字保留的歷史超過此 token 數時開始濃縮
+HISTORY_TOKEN_BUDGET = 4000
+# 至少逐字保留最近幾輪（一輪 = 一問一答）
+HISTORY_KEEP_TURNS = 3
+# previous_response_id 鏈累積的 token（論文開頭、歷次段落與對話）超過此值時，改送完整請求重新開一條鏈
+CHAIN_TOKEN_BUDGET = 16000
+# 負責寫摘要的便宜模型
+SUMMARY_MODEL = "gpt-5-nano"
+
+SUMMARY_PROMPT = (
+    "把以下論文家教對話濃縮成 300 字以內的重點摘要，供助手接續教學使用。保留學生已經理解的概念、"
+    "仍有疑問的地方、提過的論文細節（章節、數字、術語）和學生的偏好；不要加入對話中沒有的內容。"
+)
+
+HISTORY_SUMMARY_TEMPLATE = "先前對話的摘要（較早的對話已濃縮，細節以此為準）：\n{summary}"
+
+# 摘要在背景執行，不佔用回答的時間
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+
+def history_tokens(session: SessionState) -> int:
     """
-    處理使用者訊息並產生回應
+    摘要加上逐字歷史的估計 token 數，也就是完整請求要重送的歷史
 
-    **重要改進**（相較於原本的實作）：
-    1. ✅ 正確儲存 user 和 assistant 訊息到 conversation_history
-    2. ✅ 每次呼叫都重新注入 PDF 內容（支援重新上傳）
-    3. ✅ 使用 previous_response_id 維護 Response API 的狀態
-    4. ✅ 處理 history=None 的邊界情況
-    5. ✅ 處理空白輸出的情況
+    鏈裡還累積了論文開頭與每一輪的段落，這部分由 CHAIN_TOKEN_BUDGET 限制（見 build_request）。
+    """
+    return estimate_tokens(session.history_summary) + sum(
+        estimate_tokens(message["content"]) for message in session.conversation_history
+    )
 
-    支援兩種模式：
-    1. 有 PDF：論文閱讀助手模式
-    2. 無 PDF：一般 AI 助手模式
+
+def messages_to_fold(session: SessionState) -> int:
+    """
+    計算要把最舊的幾則訊息濃縮進摘要
+
+    一次濃縮到預算的一半，這樣不會每一輪都要重新摘要；
+    最近 HISTORY_KEEP_TURNS 輪永遠逐字保留。
 
     Args:
-        message: 使用者當前輸入
-        history: Gradio 聊天歷史 [[user_msg, bot_msg], ...]
+        session: 這位使用者的 SessionState
 
     Returns:
-        list: 更新後的 Gradio 歷史記錄（必須是 list of lists 格式）
+        int: 要濃縮的訊息數（未超過預算時為 0）
     """
-    global conversation_history, last_response_id
+    total = history_tokens(session)
+    if total <= HISTORY_TOKEN_BUDGET:
+        return 0
 
-    # 確保 history 是有效的列表
-    history = ensure_history(history)
+    history = session.conversation_history
+    limit = len(history) - 2 * HISTORY_KEEP_TURNS
+    count = 0
+    while count < limit and total > HISTORY_TOKEN_BUDGET // 2:
+        total -= sum(estimate_tokens(message["content"]) for message in history[count:count + 2])
+        count += 2
+    return count
 
-    # 過濾空白訊息
-    user_message = (message or "").strip()
-    if not user_message:
-        return history
 
-    # === 步驟 1: 建構訊息陣列 ===
-    messages: List[Dict[str, str]] = [
-        {"role": "developer", "content": SYSTEM_PROMPT}
-    ]
+def summarise_history(previous_summary: str, messages: List[Dict[str, str]]) -> str:
+    """
+    用便宜的模型把舊摘要和較早的對話合併成新摘要
+
+    Args:
+        previous_summary: 目前的摘要（可能是空字串）
+        messages: 要濃縮的對話訊息
+
+    Returns:
+        str: 新的摘要
+    """
+    transcript = "\n".join(
+        f"{'學生' if message['role'] == 'user' else '助手'}：{message['content']}" for message in messages
+    )
+    if previous_summary:
+        transcript = f"先前的摘要：\n{previous_summary}\n\n接續的對話：\n{transcript}"
+
+    response = client.responses.create(
+        model=SUMMARY_MODEL,
+        input=[
+            {"role": "developer", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        reasoning={"effort": "minimal"},
+        text={"verbosity": "low"},
+    )
+    return summarise_outputs(response)
+
+
+def _apply_history_summary(session: SessionState) -> None:
+    """把背景完成的摘要套用到 session；呼叫端必須持有 session.lock"""
+    pending = session.pending_summary
+    if pending is None or not pending.future.done():
+        return
+    session.pending_summary = None
+
+    try:
+        summary = pending.future.result()
+    except Exception as exc:
+        # 摘要失敗不影響對話，之後會再試
+        print(f"⚠️ 對話摘要失敗，暫時保留完整歷史：{exc}")
+        return
+
+    # 摘要期間對話被清除，或歷史已不再以快照開頭，這份摘要就作廢
+    history = session.conversation_history
+    if (not summary or history is not pending.history
+            or session.history_summary != pending.previous_summary
+            or history[:len(pending.folded)] != pending.folded):
+        return
 
-    # === 步驟 2: 如果有 PDF，注入 PDF 內容 ===
-    # 注意：每次都重新注入，這樣重新上傳 PDF 時模型會知道
-    pdf_context = pdf_state.context_message()
+    # 快照之後新增的對話留在原處，只移除已濃縮的部分
+    del history[:len(pending.folded)]
+    session.history_summary = summary
+
+    # 伺服器端的 previous_response_id 鏈仍帶著完整舊對話；
+    # 下一輪改送「摘要 + 近期對話」，重新開始一條短鏈
+    session.last_response_id = None
+    print(f"🗜️ 已把 {len(pending.folded) // 2} 輪舊對話濃縮成摘要，歷史剩約 {history_tokens(session):,} tokens")
+
+
+def apply_history_summary(session: SessionState) -> None:
+    """每一輪開始讀取歷史前，先套用上一輪之後完成的摘要"""
+    with session.lock:
+        _apply_history_summary(session)
+
+
+def maybe_compact_history(session: SessionState) -> None:
+    """
+    套用已完成的摘要；歷史仍超過 HISTORY_TOKEN_BUDGET 時，排一個新的背景摘要
+
+    在處理請求的執行緒上、記錄完一輪之後呼叫。背景只負責呼叫模型，
+    結果由之後的呼叫在 session.lock 內套用。
+
+    Args:
+        session: 這位使用者的 SessionState
+    """
+    with session.lock:
+        _apply_history_summary(session)
+        if session.pending_summary is not None:
+            return
+
+        count = messages_to_fold(session)
+        if not count:
+            return
+
+        # 對最舊的訊息取快照，交給背景執行緒摘要
+        folded = session.conversation_history[:count]
+        session.pending_summary = PendingSummary(
+            history=session.conversation_history,
+            folded=folded,
+            previous_summary=session.history_summary,
+            future=summary_executor.submit(summarise_history, session.history_summary, folded),
+        )
+
+# 每個請求一行 JSON；設為空字串則不寫檔
+METRICS_LOG_PATH = "paper_assistant_metrics.jsonl"
+# Prometheus /metrics 端點的 port；0 表示不啟動（Colab 上可以直接 print(metrics.render())）
+METRICS_PORT = 9464
+# 端點監聽的位址；預設只接受本機連線
+METRICS_HOST = "127.0.0.1"
+# 延遲直方圖的區間上限（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+# p50 / p95 / p99 以最近幾筆計算
+QUANTILE_WINDOW = 1024
+
+
+@dataclass
+class RequestMetrics:
+    """一次提問或上傳的各階段耗時（毫秒）與標籤"""
+    kind: str                                                  # "chat" 或 "upload"
+    started: float = field(default_factory=time.perf_counter)
+    stages_ms: Dict[str, float] = field(default_factory=dict)
+    labels: Dict[str, Any] = field(default_factory=dict)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """用 with request.stage("名稱"): 包住要計時的程式碼；同名的階段重複出現時累加"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages_ms[name] = self.stages_ms.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+
+def usage_breakdown(usage: Any) -> Dict[str, int]:
+    """把 response.usage 攤平成 {input, cached, output, reasoning}"""
+    if usage is None:
+        return {}
+    breakdown = {
+        "input": getattr(usage, "input_tokens", None),
+        "cached": getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None),
+        "output": getattr(usage, "output_tokens", None),
+        "reasoning": getattr(getattr(usage, "output_tokens_details", None), "reasoning_tokens", None),
+    }
+    return {kind: count for kind, count in breakdown.items() if count is not None}
+
+
+class LatencyHistogram:
+    """
+    延遲直方圖
+
+    - 累計的區間計數給 Prometheus 用（可以在 Prometheus 端算 histogram_quantile）
+    - 另外保留最近 QUANTILE_WINDOW 筆，直接算出精確的 p50 / p95 / p99
+    """
+
+    def __init__(self) -> None:
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.recent: deque = deque(maxlen=QUANTILE_WINDOW)
+
+    def observe(self, seconds: float) -> None:
+        for position, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[position] += 1
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _labels(**labels: Any) -> str:
+    """Prometheus 標籤格式：{kind="chat",stage="response"}"""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    """所有 session 共用的延遲直方圖與請求 / token 計數"""
+
+    def __init__(self, log_path: str) -> None:
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self.latency: Dict[Tuple[str, str], LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.requests: Counter = Counter()
+        self.tokens: Counter = Counter()
+        if log_path:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+
+    def record(self, request: RequestMetrics, outcome: str, usage: Any = None,
+               error: Optional[Exception] = None) -> Dict[str, Any]:
+        """
+        記錄一個完成（或失敗）的請求，並寫一行 JSONL
+
+        Args:
+            request: 這個請求的 RequestMetrics
+            outcome: "ok" 或 "error"
+            usage: response.usage（沒有時為 None）
+            error: 失敗原因
+
+        Returns:
+            Dict: 寫進 JSONL 的那一筆記錄
+        """
+        request.stages_ms["total"] = (time.perf_counter() - request.started) * 1000
+        tokens = usage_breakdown(usage)
+        entry = {
+            "ts": round(time.time(), 3),
+            "kind": request.kind,
+            "outcome": outcome,
+            **request.labels,
+            "stages_ms": {name: round(ms, 1) for name, ms in request.stages_ms.items()},
+            "tokens": tokens,
+        }
+        if error is not None:
+            entry["error"] = f"{type(error).__name__}: {error}"
+
+        # 多位使用者同時更新，要上鎖
+        with self._lock:
+            for name, ms in request.stages_ms.items():
+                self.latency[(request.kind, name)].observe(ms / 1000)
+            self.requests[(request.kind, outcome, request.labels.get("mode", ""))] += 1
+            self.tokens.update(tokens)
+            if self.log_path:
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as handle:
+                        handle.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                except OSError as exc:
+                    print(f"⚠️ 無法寫入指標記錄：{exc}")
+        return entry
+
+    def render(self) -> str:
+        """輸出 Prometheus 文字格式"""
+        lines = [
+            "# HELP paper_assistant_stage_seconds Time spent in each stage of a request.",
+            "# TYPE paper_assistant_stage_seconds histogram",
+        ]
+        with self._lock:
+            latency = sorted(self.latency.items())
+            for (kind, stage), histogram in latency:
+                for bound, count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                    lines.append(f"paper_assistant_stage_seconds_bucket{_labels(kind=kind, stage=stage, le=bound)} {count}")
+                lines.append(f"paper_assistant_stage_seconds_bucket{_labels(kind=kind, stage=stage, le='+Inf')} {histogram.count}")
+                lines.append(f"paper_assistant_stage_seconds_sum{_labels(kind=kind, stage=stage)} {histogram.total:.6f}")
+                lines.append(f"paper_assistant_stage_seconds_count{_labels(kind=kind, stage=stage)} {histogram.count}")
+
+            lines += [
+                f"# HELP paper_assistant_stage_seconds_recent Stage latency quantiles over the last {QUANTILE_WINDOW} requests.",
+                "# TYPE paper_assistant_stage_seconds_recent summary",
+            ]
+            for (kind, stage), histogram in latency:
+                for q in (0.5, 0.95, 0.99):
+                    lines.append(f"paper_assistant_stage_seconds_recent{_labels(kind=kind, stage=stage, quantile=q)} "
+                                 f"{histogram.quantile(q):.6f}")
+                lines.append(f"paper_assistant_stage_seconds_recent_sum{_labels(kind=kind, stage=stage)} {sum(histogram.recent):.6f}")
+                lines.append(f"paper_assistant_stage_seconds_recent_count{_labels(kind=kind, stage=stage)} {len(histogram.recent)}")
+
+            lines += [
+                "# HELP paper_assistant_requests_total Requests by kind, outcome and request mode.",
+                "# TYPE paper_assistant_requests_total counter",
+            ]
+            for (kind, outcome, mode), count in sorted(self.requests.items()):
+                lines.append(f"paper_assistant_requests_total{_labels(kind=kind, outcome=outcome, mode=mode)} {count}")
+
+            lines += [
+                "# HELP paper_assistant_tokens_total Tokens reported in response.usage.",
+                "# TYPE paper_assistant_tokens_total counter",
+            ]
+            for kind, count in sorted(self.tokens.items()):
+                lines.append(f"paper_assistant_tokens_total{_labels(kind=kind)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(METRICS_LOG_PATH)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """只回應 GET /metrics"""
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass  # 不要讓每次抓取都印在 Gradio 的 log 裡
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """
+    在背景執行緒啟動 /metrics 端點（和 Gradio 使用不同的 port）
+
+    Args:
+        port: 監聽的 port；0 表示不啟動
+        host: 監聽的位址；預設 127.0.0.1，只有本機抓得到
+
+    Returns:
+        ThreadingHTTPServer；port 為 0 或已被佔用時回傳 None
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as exc:
+        print(f"⚠️ 指標端點無法啟動（{host}:{port}）：{exc}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"📈 指標端點：http://{host}:{port}/metrics")
+    return server
+
+# False：每個問題都用 standard 路由
+ADAPTIVE_ROUTING = True
+# 寒暄與查找型問題改用的小模型；設成 MODEL_NAME 就不換模型
+ROUTER_SMALL_MODEL = "gpt-5-mini"
+AUTO_ROUTE = "auto"
+# 查找型問題的長度上限；超過這個長度的問題一律當成需要深入分析
+QUICK_MAX_CHARS = 60
+DEEP_MIN_CHARS = 200
+
+# 英文關鍵字用 (?<![a-z]) 而不是 \b：中文字也算 \w，「請問table 2」之間沒有 \b
+SMALL_TALK_PATTERN = re.compile(
+    r"^(?:hi|hello|hey|thanks|thank you|thx|ok|okay|got it|cool|great|"
+    r"你好|您好|哈囉|嗨|早安|午安|晚安|謝謝(?:你|您)?|感謝|好的|了解|懂了|明白了|收到|掰掰|再見)[\W_]*$",
+    re.IGNORECASE,
+)
+LOOKUP_PATTERN = re.compile(
+    r"(?<![a-z])(?:figure|fig|table|equation|eq|page|section|appendix|which|where|who|when|how many|how much|"
+    r"dataset|author)s?(?![a-z])|"
+    r"圖\s*\d|表\s*\d|第\s*\d+\s*[頁節章]|哪[一些]?[頁節章個篇年]|在哪|幾[頁個位年]|多少|是誰|什麼時候|作者|資料集",
+    re.IGNORECASE,
+)
+DEEP_PATTERN = re.compile(
+    r"(?<![a-z])(?:why|critique|limitation|weakness|assumption|compar|trade-?off|evaluat|assess|justif|"
+    r"deriv|prove|proof|methodolog|validity)|"
+    r"為什麼|為何|批判|評論|評估|限制|缺點|弱點|假設|比較|差異|取捨|推導|證明|合理|方法論|有效性",
+    re.IGNORECASE,
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    """一輪對話使用的模型、推理強度與回答長度，以及選擇的理由"""
+    name: str
+    model: str
+    effort: str               # reasoning.effort
+    verbosity: str            # text.verbosity
+    use_pdf: bool = True      # 是否附上論文段落
+    reason: str = ""
+
+
+ROUTES = {
+    "chat": Route("chat", ROUTER_SMALL_MODEL, "minimal", "low", use_pdf=False),
+    "quick": Route("quick", ROUTER_SMALL_MODEL, "low", "low"),
+    "standard": Route("standard", MODEL_NAME, "medium", "medium"),
+    "deep": Route("deep", MODEL_NAME, "high", "medium"),
+}
+# 介面「回答模式」下拉選單的選項：(顯示文字, 路由名稱)
+ROUTE_CHOICES = [("自動判斷", AUTO_ROUTE), ("快速", "quick"), ("標準", "standard"), ("深入", "deep")]
+
+
+def route_question(user_message: str, override: Optional[str] = AUTO_ROUTE) -> Route:
+    """
+    依問題決定這一輪的路由（只用規則判斷，不呼叫模型）
+
+    Args:
+        user_message: 使用者的問題
+        override: 使用者在「回答模式」選的路由；AUTO_ROUTE 表示自動判斷
+
+    Returns:
+        Route: 這一輪要用的設定（reason 說明為什麼選它）
+    """
+    if override and override != AUTO_ROUTE:
+        return replace(ROUTES[override], reason="使用者指定")
+    if not ADAPTIVE_ROUTING:
+        return replace(ROUTES["standard"], reason="路由關閉")
+
+    text = user_message.strip()
+    # 寒暄不需要論文段落，也不需要推理
+    if SMALL_TALK_PATTERN.match(text):
+        return replace(ROUTES["chat"], reason="寒暄")
+    # 分析類的判斷放在查找類前面：「為什麼表 2 的結果比較好」屬於分析
+    if len(text) >= DEEP_MIN_CHARS:
+        return replace(ROUTES["deep"], reason="長問題")
+    if DEEP_PATTERN.search(text):
+        return replace(ROUTES["deep"], reason="分析、比較或推導")
+    if len(text) <= QUICK_MAX_CHARS and LOOKUP_PATTERN.search(text):
+        return replace(ROUTES["quick"], reason="查找型短問題")
+    return replace(ROUTES["standard"], reason="一般說明")
+
+
+# 試試看
+for question in ["謝謝！", "Figure 3 在第幾頁？", "這篇論文的主要貢獻是什麼？", "為什麼要除以根號 dk？"]:
+    route = route_question(question)
+    print(f"{question} → {route.name}（{route.reason}）")
+
+ANSWER_CACHE_ENABLED = True
+# 答案保留 6 小時（論文內容不變，但提示詞或模型可能調整）
+ANSWER_CACHE_TTL_SECONDS = 6 * 3600
+ANSWER_CACHE_MAX_ENTRIES = 512
+# 字元 bigram 的 Jaccard 相似度門檻；1 表示只接受正規化後完全相同的問題
+ANSWER_CACHE_SIMILARITY = 0.8
+
+# 指向前文的追問（「剛剛那個」「再解釋一次」）答案取決於對話內容，不能共用
+FOLLOW_UP_PATTERN = re.compile(
+    r"(?<![a-z])(?:it|that|this one|above|previous|earlier|you said|again|more|continue|elaborate)(?![a-z])|"
+    r"剛剛|剛才|上面|前面|你說|你剛|那個|這個|它|他們|再解釋|再說|繼續|還有呢|舉個例|換個|為什麼呢",
+    re.IGNORECASE,
+)
+
+
+def normalize_question(text: str) -> str:
+    """
+    正規化問題：全形轉半形（NFKC）、英文轉小寫，只保留文字與數字
+
+    Returns:
+        str: 例如「這篇論文的主要貢獻是什麼？」→「這篇論文的主要貢獻是什麼」
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] in "LN")
+
+
+def char_bigrams(text: str) -> FrozenSet[str]:
+    """相鄰兩個字元一組，用來計算問題之間的相似度"""
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1)) or frozenset([text])
+
+
+@dataclass
+class CachedAnswer:
+    """快取裡的一筆答案"""
+    answer: str
+    bigrams: FrozenSet[str]
+    numbers: Tuple[str, ...]   # 問題裡出現的數字，必須完全相同才能共用
+    expires_at: float          # time.monotonic() 的到期時間
+
+
+class AnswerCache:
+    """
+    以（論文雜湊, 路由）為範圍的答案快取：先找正規化後完全相同的問題，
+    再找同範圍內最相似的問題；過期的答案作廢，滿了就淘汰最久沒用到的
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self._entries: OrderedDict = OrderedDict()  # (範圍, 正規化問題) -> CachedAnswer，越後面越新
+        self._lock = threading.Lock()  # 同步版本的多個 worker thread 會同時存取
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, scope: Tuple[str, str], question: str) -> Optional[Tuple[str, float]]:
+        """
+        查詢快取
+
+        Returns:
+            (答案, 相似度)；沒有夠相似的問題時回傳 None
+        """
+        normalized = normalize_question(question)
+        bigrams = char_bigrams(normalized)
+        numbers = tuple(re.findall(r"\d+", normalized))
+        now = time.monotonic()
+        with self._lock:
+            # 先清掉過期的答案
+            for key in [key for key, entry in self._entries.items() if entry.expires_at <= now]:
+                del self._entries[key]
+
+            best_key, best_score = None, 0.0
+            if (scope, normalized) in self._entries:
+                best_key, best_score = (scope, normalized), 1.0
+            elif self.similarity < 1:
+                for key, entry in self._entries.items():
+                    if key[0] != scope or entry.numbers != numbers:
+                        continue
+                    score = len(bigrams & entry.bigrams) / len(bigrams | entry.bigrams)
+                    if score > best_score:
+                        best_key, best_score = key, score
+
+            if best_key is None or best_score < self.similarity:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            return self._entries[best_key].answer, best_score
+
+    def store(self, scope: Tuple[str, str], question: str, answer: str) -> None:
+        """存入一筆答案；超過容量時淘汰最久沒用到的"""
+        normalized = normalize_question(question)
+        entry = CachedAnswer(answer, char_bigrams(normalized), tuple(re.findall(r"\d+", normalized)),
+                             time.monotonic() + self.ttl_seconds)
+        with self._lock:
+            self._entries[(scope, normalized)] = entry
+            self._entries.move_to_end((scope, normalized))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def hit_rate(self) -> str:
+        """累計命中率（還沒查詢過時顯示 —）"""
+        lookups = self.hits + self.misses
+        return f"{self.hits / lookups:.0%}" if lookups else "—"
+
+
+# 全域共用：同一篇論文的答案可以給所有同學使用
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIMILARITY)
+
+
+def answer_cache_scope(session: SessionState, route: Route, user_message: str) -> Optional[Tuple[str, str]]:
+    """
+    判斷這個問題能不能使用答案快取
+
+    只有已上傳、而且整篇讀完的論文才共用答案。第一輪以外的提問，
+    只要沒有符合 FOLLOW_UP_PATTERN 就算「和對話內容無關」；這是唯一的判斷，
+    沒用到這些字眼的追問仍然會用快取。
+
+    Returns:
+        (論文雜湊, 路由名稱)；沒有論文、或答案取決於這段對話內容時回傳 None
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    # 沒有上傳論文時是一般聊天，答案不該給其他同學
+    if not session.pdf_state.digest:
+        return None
+    first_turn = not session.conversation_history and not session.history_summary
+    if not first_turn and FOLLOW_UP_PATTERN.search(user_message):
+        return None
+    # 同一位同學再問一次，代表上次的答案沒有幫上忙，不要原封不動再給一次
+    asked = {normalize_question(message["content"]) for message in session.conversation_history
+             if message["role"] == "user"}
+    if normalize_question(user_message) in asked:
+        return None
+    # 論文還沒讀完時的答案只根據部分內容（見 8.5），不能給之後的同學
+    if not session.pdf_state.complete:
+        return None
+    return session.pdf_state.digest, route.name
+
+# 同時在背景讀取的 PDF 數
+INGEST_WORKERS = 4
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="pdf-ingest")
+
+
+def progress_bar(done: int, total: int, width: int = 10) -> str:
+    """文字進度條，例如 ▓▓▓░░░░░░░"""
+    filled = width * done // total if total else width
+    return "▓" * filled + "░" * (width - filled)
+
+
+class IngestJob:
+    """
+    一份上傳的 PDF 的背景讀取工作：雜湊 → 查快取 → 逐段提取 → 切段 → 建索引
+
+    狀態訊息放進 notes 佇列，由 upload_pdf 轉給介面；第一段頁面建好索引
+    就把 PDFState 交給 session，之後每讀完一段再更新一次。每段只切新的頁面、
+    接到同一個索引後面，整篇讀完的成本和一次建好索引相同。
+
+    Attributes:
+        notes: 狀態訊息佇列（None 表示結束）
+        status: 最新的狀態訊息
+        ready: 第一段頁面可以提問了（或讀取失敗）
+        done: 整篇讀完（或失敗、被新的上傳取代）
+        index: 逐段加入段落的 BM25 索引
+        page_texts: 每段頁面排版好的文字，讀完後組成全文
+    """
+
+    def __init__(self, pdf_path: str, session: SessionState):
+        self.pdf_path = pdf_path
+        self.filename = os.path.basename(pdf_path)
+        self.session = session
+        session.ingest_job += 1
+        self.job_id = session.ingest_job
+        self.version = session.pdf_state.version + 1
+        self.request = RequestMetrics("upload")
+        self.notes: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.status = ""
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.prefix: Optional[Tuple[List[Chunk], Optional[Dict[str, str]]]] = None
+        self.index = BM25Index()
+        self.page_texts: List[str] = []
+
+    @property
+    def superseded(self) -> bool:
+        """同一位使用者又上傳了新的 PDF"""
+        return self.session.ingest_job != self.job_id
+
+    def report(self, note: str) -> None:
+        self.status = note
+        self.notes.put(note)
+
+    def wait(self, timeout: Optional[float] = None) -> str:
+        """等整篇讀完，回傳最後的狀態訊息"""
+        self.done.wait(timeout)
+        return self.status
+
+    def publish(self, new_pages: List[Tuple[int, str]], digest: str, pages_ready: int,
+                page_count: int) -> Optional[PDFState]:
+        """
+        把新讀到的頁面加進索引，再把目前讀好的全部交給 session
+
+        Args:
+            new_pages: 這一段有文字的頁面（快取命中時是整篇）
+
+        Returns:
+            新的 PDFState；還沒有任何文字、或已被新的上傳取代時回傳 None
+        """
+        if new_pages:
+            # 上一段最後的章節標題延續到這一段
+            section = self.index.chunks[-1].section if self.index.chunks else ""
+            with self.request.stage("pdf_chunk"):
+                chunks = chunk_pages(new_pages, section=section)
+            if self.prefix is None:
+                # 前綴只取第一段頁面，後面補上的頁面不會改變它；快取命中時算出的也一樣
+                self.prefix = paper_prefix([chunk for chunk in chunks if chunk.page <= PAGES_PER_SHARD])
+            with self.request.stage("pdf_index"):
+                self.index.add(chunks)
+            self.page_texts.append(format_pdf_pages(new_pages))
+        if not self.index.chunks:
+            return None
+
+        index = self.index.snapshot()
+        pdf_state = PDFState(
+            filename=self.filename,
+            content="".join(self.page_texts) if pages_ready >= page_count else None,
+            version=self.version,
+            chunks=index.chunks,
+            index=index,
+            digest=digest,
+            prefix_chunks=self.prefix[0],
+            prefix_message=self.prefix[1],
+            pages_ready=pages_ready,
+            page_count=page_count,
+        )
+        if self.superseded:
+            return None
+        # 整個物件一次換掉，同時在回答的執行緒不會看到一半的狀態
+        self.session.pdf_state = pdf_state
+        if not self.ready.is_set():
+            self.request.stages_ms["first_pages"] = (time.perf_counter() - self.request.started) * 1000
+            self.ready.set()
+        return pdf_state
+
+    def run(self) -> None:
+        """在 ingest_executor 上執行；例外一律轉成狀態訊息（背景工作的例外沒有人接）"""
+        outcome, error = "ok", None
+        try:
+            self._ingest()
+        except Exception as exc:
+            outcome, error = "error", exc
+            if self.superseded:
+                pass
+            elif self.ready.is_set():
+                # 已經讀到的頁面保留，仍然可以提問
+                self.report(f"⚠️ {self.filename} 只讀到第 {self.session.pdf_state.pages_ready} 頁：{exc}")
+            else:
+                # 重置 PDF 狀態（保留版本號，下一份 PDF 仍是新版本）
+                self.session.pdf_state = PDFState(version=self.session.pdf_state.version)
+                self.report(f"❌ {exc}")
+        finally:
+            if outcome == "ok" and self.superseded:
+                outcome = "superseded"
+            metrics.record(self.request, outcome, error=error)
+            self.ready.set()
+            self.done.set()
+            self.notes.put(None)
+
+    def _ingest(self) -> None:
+        request = self.request
+        self.report(f"⏳ 正在讀取 {self.filename}：計算檔案雜湊…")
+        with request.stage("pdf_hash"):
+            try:
+                digest = pdf_sha256(self.pdf_path)
+            except OSError as exc:
+                raise ValueError(f"PDF 讀取失敗: {exc}") from exc
+
+        self.report(f"⏳ 正在讀取 {self.filename}：查詢文字快取…")
+        key = PDFTextCache.key_for(digest)
+        with request.stage("cache_lookup"):
+            cached = pdf_cache.get(key)
+        cache_hit = cached is not None
+
+        if cache_hit:
+            # 快取只存有文字的頁面，總頁數另外存（最後幾頁可能只有圖片）
+            pages, page_count = cached
+            pdf_state = self.publish(pages, digest, page_count, page_count)
+        else:
+            self.report(f"⏳ 正在讀取 {self.filename}：提取第一批頁面…")
+            pages, pdf_state = [], None
+            shards = iter_pdf_pages(self.pdf_path)
+            while True:
+                with request.stage("pdf_extract"):
+                    shard, total = next(shards, ([], 0))
+                if not shard:
+                    break
+                page_count = total
+                if self.superseded:
+                    shards.close()
+                    return
+                new_pages = [(number, text) for number, text in shard if text]
+                pages.extend(new_pages)
+                pages_ready = shard[-1][0]
+                pdf_state = self.publish(new_pages, digest, pages_ready, page_count) or pdf_state
+                if pages_ready < page_count:
+                    ask = ("💬 已讀到的頁面可以先提問，其餘頁面讀完後會自動補上。" if pdf_state
+                           else "（前面幾頁沒有文字，繼續往下讀）")
+                    self.report(
+                        f"⏳ 正在讀取 {self.filename}\n"
+                        f"{progress_bar(pages_ready, page_count)} 第 {pages_ready} / {page_count} 頁\n\n{ask}"
+                    )
+            if not pages:
+                raise ValueError("PDF 中沒有可讀取的文字內容")
+            pdf_cache.put(key, pages, page_count)
+        if pdf_state is None or self.superseded:
+            return
+
+        request.labels.update(pages=page_count, chunks=len(pdf_state.chunks), cache_hit=cache_hit)
+        read_ms = sum(request.stages_ms.get(stage, 0.0) for stage in ("pdf_hash", "cache_lookup", "pdf_extract"))
+
+        # 產生友善的成功訊息
+        self.report(
+            "✅ PDF 上傳成功！\n\n"
+            f"📄 檔名：{pdf_state.filename}\n"
+            f"📄 版本：{pdf_state.version}\n"
+            f"📄 頁面數：{page_count}\n"
+            f"🔤 文字長度：約 {len(pdf_state.content):,} 字元\n"
+            f"🧩 檢索段落：{len(pdf_state.chunks)} 段（開頭 {len(pdf_state.prefix_chunks)} 段固定附上，"
+            f"每次提問再加最相關的 {RETRIEVAL_TOP_K} 段）\n"
+            f"🗂️ 提示快取鍵：{pdf_state.prompt_cache_key}\n"
+            f"⚡ 文字快取：{'命中' if cache_hit else '未命中'}（讀取 {read_ms:,.0f} ms，"
+            f"{request.stages_ms['first_pages']:,.0f} ms 後即可提問）\n"
+            f"📊 快取統計：{pdf_cache.stats()}\n\n"
+            "💬 你可以直接提問，我會依據最新的 PDF 回答。"
+        )
+
+
+def start_ingest(pdf_path: str, session: SessionState) -> IngestJob:
+    """
+    開始在背景讀取 PDF；這位使用者之前還沒讀完的工作會停止更新狀態
+
+    Returns:
+        IngestJob：可以用 job.ready.wait() 等第一段頁面、job.wait() 等整篇讀完
+    """
+    job = IngestJob(pdf_path, session)
+    ingest_executor.submit(job.run)
+    return job
+
+@dataclass
+class TurnRequest:
+    """一輪對話要送出的請求，以及收到回應後要記進 session 的資訊"""
+    payload: Dict[str, Any]   # 傳給 client.responses.create(**payload) 的參數
+    delta: bool               # 是否只送新內容（接續 previous_response_id）
+    pdf_version: int          # 建構請求時的 PDF 版本
+    excerpts: List[Chunk]     # 這次送出的論文段落
+    route: Route              # 這一輪的模型、推理強度與回答長度（見 8.3）
+
+
+def build_request(session: SessionState, user_message: str, full: bool = False,
+                  route: Optional[Route] = None) -> TurnRequest:
+    """
+    組出送給 Response API 的請求內容
+
+    訊息依「越穩定越前面」排列，讓提示快取涵蓋越多越好（見 6.1）：
+    system prompt → 論文開頭（固定前綴）→ 對話摘要 → 對話歷史 → 相關段落 → 問題
+
+    有 previous_response_id 時，伺服器端已經保存了這些內容。如果每次還把
+    它們全部重送，輸入 token 會隨對話輪數平方成長。所以 delta 請求只送
+    「鏈裡還沒有的段落」加上新問題；PDF 換了版本則重送新論文的前綴與段落。
+    鏈累積超過 CHAIN_TOKEN_BUDGET 時（段落與論文開頭摘要不掉），同樣改送完整請求。
+
+    Args:
+        session: 這位使用者的 SessionState
+        user_message: 使用者當前輸入（已去除前後空白）
+        full: True 時不接續 previous_response_id，重送完整對話
+        route: 這一輪的路由；None 時由 route_question 自動判斷
+
+    Returns:
+        TurnRequest: 請求參數與這次送出的段落
+    """
+    route = route or route_question(user_message)
+    pdf_state = session.pdf_state
+    chain = None if full else session.last_response_id
+    if chain and session.chained_tokens > CHAIN_TOKEN_BUDGET:
+        print(f"🔗 鏈已累積約 {session.chained_tokens:,} tokens，改送完整請求重新開始")
+        chain = None
+    delta = DELTA_REQUESTS and chain is not None
+    # 新的鏈，或鏈裡還是上一份 PDF：論文開頭要（重新）送一次
+    new_paper = not delta or pdf_state.version != session.chained_pdf_version
+
+    # 同一版 PDF 的 delta 請求只補上還沒送過的段落；寒暄不附段落
+    excerpts = pdf_state.excerpts(user_message) if route.use_pdf else []
+    if not new_paper:
+        excerpts = [chunk for chunk in excerpts if chunk not in session.chained_chunks]
+
+    # === 步驟 1: 固定前綴（system prompt + 論文開頭）===
+    messages: List[Dict[str, str]] = []
+    if not delta:
+        messages.append(SYSTEM_MESSAGE)
+    if new_paper and pdf_state.prefix_message:
+        messages.append(pdf_state.prefix_message)
+
+    # === 步驟 2: 加入對話摘要與歷史（delta 請求由 previous_response_id 提供）===
+    if not delta:
+        if session.history_summary:
+            messages.append({
+                "role": "developer",
+                "content": HISTORY_SUMMARY_TEMPLATE.format(summary=session.history_summary),
+            })
+        messages.extend(session.conversation_history)
+
+    # === 步驟 3: 注入和這次問題相關的論文段落 ===
+    pdf_context = pdf_state.context_message(excerpts)
     if pdf_context:
         messages.append(pdf_context)
 
-    # === 步驟 3: 加入對話歷史 ===
-    # 這裡包含之前所有的 user 和 assistant 訊息
-    messages.extend(conversation_history)
-
     # === 步驟 4: 加入當前使用者訊息 ===
     messages.append({"role": "user", "content": user_message})
 
     # === 步驟 5: 準備 API 請求 ===
     request_payload = {
-        "model": MODEL_NAME,
+        "model": route.model,
         "input": messages,
-        "reasoning": {"effort": "medium"},
-        "text": {"verbosity": "medium"}
+        "reasoning": {"effort": route.effort},
+        "text": {"verbosity": route.verbosity},
+        "prompt_cache_key": pdf_state.prompt_cache_key,
     }
 
     # 如果有上一次的 response_id，加入以維持推理連續性
-    if last_response_id:
-        request_payload["previous_response_id"] = last_response_id
+    if chain:
+        request_payload["previous_response_id"] = chain
+    sent = (pdf_state.prefix_chunks if new_paper else []) + excerpts
+    return TurnRequest(request_payload, delta, pdf_state.version, sent, route)
+
+
+def chain_lost(exc: Exception, turn: TurnRequest) -> bool:
+    """previous_response_id 指向的回應已不存在（過期、被刪除或沒有儲存）"""
+    if "previous_response_id" not in turn.payload:
+        return False
+    if getattr(exc, "code", None) == "previous_response_not_found":
+        return True
+    return isinstance(exc, (BadRequestError, NotFoundError)) and "previous response" in str(exc).lower()
+
 
+def create_response(session: SessionState, user_message: str, turn: TurnRequest,
+                    **kwargs: Any) -> Tuple[TurnRequest, Any]:
+    """
+    送出請求；鏈斷掉時改送完整對話再試一次
+
+    Returns:
+        tuple: (實際送出的 TurnRequest, API 回應或串流)
+    """
     try:
-        # === 步驟 6: 呼叫 OpenAI Response API ===
-        response = client.responses.create(**request_payload)
+        return turn, client.responses.create(**turn.payload, **kwargs)
+    except Exception as exc:
+        if not chain_lost(exc, turn):
+            raise
+        print("🔗 previous_response_id 已失效，改送完整對話")
+        turn = build_request(session, user_message, full=True, route=turn.route)
+        return turn, client.responses.create(**turn.payload, **kwargs)
 
-        # === 步驟 7: 提取回應文字 ===
-        assistant_reply = summarise_outputs(response)
 
-        # 如果沒有文字輸出（罕見但可能發生），提供友善的錯誤訊息
-        if not assistant_reply:
-            assistant_reply = "⚠️ 模型未回傳文字，可再試一次或調整問題。"
+async def create_response_async(session: SessionState, user_message: str, turn: TurnRequest,
+                                **kwargs: Any) -> Tuple[TurnRequest, Any]:
+    """create_response 的非同步版本"""
+    try:
+        return turn, await async_client.responses.create(**turn.payload, **kwargs)
+    except Exception as exc:
+        if not chain_lost(exc, turn):
+            raise
+        print("🔗 previous_response_id 已失效，改送完整對話")
+        turn = build_request(session, user_message, full=True, route=turn.route)
+        return turn, await async_client.responses.create(**turn.payload, **kwargs)
+
+
+@dataclass
+class StreamProgress:
+    """一次串流回應的進度：已收到的文字、完整回應物件與首字延遲"""
+    started: float
+    partial_reply: str = ""
+    response: Any = None
+    first_token_ms: Optional[float] = None
+
+    def apply(self, event: Any) -> bool:
+        """
+        處理一個串流事件
+
+        Returns:
+            bool: 畫面上的文字有增加時回傳 True（呼叫端就 yield 一次）
+        """
+        if event.type == "response.output_text.delta":
+            if self.first_token_ms is None:
+                self.first_token_ms = (time.perf_counter() - self.started) * 1000
+            self.partial_reply += event.delta
+            return True
+        if event.type == "response.completed":
+            # 多個執行緒同時開始串流時，openai SDK 偶爾把 event.response 留成 dict，這裡轉回 Response
+            response = event.response
+            self.response = Response.model_validate(response) if isinstance(response, dict) else response
+        elif event.type == "response.failed":
+            raise RuntimeError(getattr(event.response.error, "message", "模型回應失敗"))
+        elif event.type == "error":
+            raise RuntimeError(event.message)
+        return False
+
+    def reply(self) -> str:
+        """串流結束後取得完整回應文字"""
+        # 沒收到 response.completed 代表串流中途斷線
+        if self.response is None:
+            raise RuntimeError("串流中斷，未收到完整回應")
+        return self.partial_reply or summarise_outputs(self.response)
+
+
+def record_turn(session: SessionState, turn: TurnRequest, user_message: str,
+                assistant_reply: str, response: Any, progress: StreamProgress) -> str:
+    """
+    收到完整回應後更新 session，回傳要顯示的回答
 
+    Args:
+        session: 這位使用者的 SessionState
+        turn: 實際送出的請求
+        user_message: 使用者這一輪的問題
+        assistant_reply: 模型回答（可能是空字串）
+        response: Response API 的完整回應物件
+        progress: 計時資訊（開始時間與首字延遲）
+
+    Returns:
+        str: 要顯示在聊天區的回答
+    """
+    # 如果沒有文字輸出（罕見但可能發生），提供友善的錯誤訊息
+    if not assistant_reply:
+        assistant_reply = "⚠️ 模型未回傳文字，可再試一次或調整問題。"
+
+    route = turn.route
+    print(f"🧭 路由 {route.name}（{route.reason}）：{route.model}，effort {route.effort}，verbosity {route.verbosity}")
+
+    total_ms = (time.perf_counter() - progress.started) * 1000
+    if progress.first_token_ms is not None:
+        print(f"⏱️ 首字延遲 {progress.first_token_ms:,.0f} ms，完整回應 {total_ms:,.0f} ms")
+
+    # 每輪的輸入 token：本地估算實際送出的量、API 計費的量（含鏈裡的內容）與其中命中快取的部分
+    sent_tokens = sum(estimate_tokens(message["content"]) for message in turn.payload["input"])
+    billed_tokens, cached_tokens = prompt_cache_stats.record(getattr(response, "usage", None))
+    billed = f"{billed_tokens:,}" if billed_tokens is not None else "?"
+    cached = f"{cached_tokens:,}" if cached_tokens is not None else "?"
+    print(f"📥 輸入 token：送出約 {sent_tokens:,}，計費 {billed}，快取 {cached}，"
+          f"累計快取率 {prompt_cache_stats.hit_rate()}（{'delta' if turn.delta else '完整'}請求）")
+
+    with session.lock:
         # === 步驟 8: 更新對話歷史（重要！）===
-        # 儲存 user 和 assistant 訊息，這樣下次呼叫時模型才知道之前的對話
-        conversation_history.append({"role": "user", "content": user_message})
-        conversation_history.append({"role": "assistant", "content": assistant_reply})
+        # 儲存 user 和 assistant 訊息；重建完整請求（例如鏈斷掉）時會用到
+        session.conversation_history.append({"role": "user", "content": user_message})
+        session.conversation_history.append({"role": "assistant", "content": assistant_reply})
+
+        # === 步驟 9: 儲存 response_id、鏈裡已有的段落與鏈的估計大小 ===
+        session.last_response_id = getattr(response, "id", None)
+        if not turn.delta or turn.pdf_version != session.chained_pdf_version:
+            session.chained_chunks = set()
+        session.chained_chunks.update(turn.excerpts)
+        session.chained_pdf_version = turn.pdf_version
+        carried = session.chained_tokens if "previous_response_id" in turn.payload else 0
+        session.chained_tokens = carried + sent_tokens + estimate_tokens(assistant_reply)
+
+    # 歷史太長就在背景濃縮，不影響這一輪的回答
+    maybe_compact_history(session)
+    return assistant_reply
+
+
+def observe_turn(request: RequestMetrics, turn: TurnRequest, progress: Optional[StreamProgress],
+                 response: Any = None, error: Optional[Exception] = None) -> None:
+    """
+    把一輪對話的計時與 usage 記進 metrics
+
+    Args:
+        request: 這一輪的 RequestMetrics（已記錄 build_request 等階段）
+        turn: 實際送出的請求
+        progress: 串流進度（還沒送出請求就失敗時為 None）
+        response: 完整回應（失敗時為 None）
+        error: 失敗原因
+    """
+    if progress is not None:
+        if progress.first_token_ms is not None:
+            request.stages_ms["first_token"] = progress.first_token_ms
+        request.stages_ms["response"] = (time.perf_counter() - progress.started) * 1000
+    request.labels.update(
+        mode="delta" if turn.delta else "full",
+        route=turn.route.name,
+        model=turn.payload["model"],
+        stream=STREAM_RESPONSES,
+    )
+    metrics.record(request, "error" if error else "ok", getattr(response, "usage", None), error)
+
+
+def answer_from_cache(session: SessionState, request: RequestMetrics, route: Route,
+                      scope: Optional[Tuple[str, str]], user_message: str) -> Optional[str]:
+    """
+    從答案快取回答（見 8.4），並像一般的一輪對話一樣記進 session
+
+    Args:
+        scope: answer_cache_scope 的結果；None 表示這題不適用快取
+
+    Returns:
+        str: 快取裡的答案；沒有命中時回傳 None
+    """
+    if scope is None:
+        return None
+    with request.stage("cache_lookup"):
+        hit = answer_cache.lookup(scope, user_message)
+    if hit is None:
+        return None
+
+    answer, similarity = hit
+    print(f"💾 答案快取命中（相似度 {similarity:.2f}），累計命中率 {answer_cache.hit_rate()}")
+    with session.lock:
+        session.conversation_history.append({"role": "user", "content": user_message})
+        session.conversation_history.append({"role": "assistant", "content": answer})
+        # 伺服器端的鏈裡沒有這一輪，下一輪改送完整對話
+        session.last_response_id = None
+    maybe_compact_history(session)
+    request.labels.update(mode="cache", route=route.name, model=route.model, stream=STREAM_RESPONSES)
+    metrics.record(request, "cache_hit")
+    return answer
+
+
+def error_reply(exc: Exception) -> str:
+    """把例外轉成聊天區顯示的錯誤訊息"""
+    return f"❌ 發生錯誤：{exc}\n\n請檢查網路連線與 API 設定後再試一次。"
+
+
+def chat_with_paper(message: str, history: Optional[List[List[str]]],
+                    session: Optional[SessionState] = None, answer_mode: str = AUTO_ROUTE):
+    """
+    處理使用者訊息並以串流方式產生回應
 
-        # === 步驟 9: 儲存 response_id ===
-        last_response_id = getattr(response, "id", None)
+    **重要改進**（相較於原本的實作）：
+    1. ✅ 正確儲存 user 和 assistant 訊息到 conversation_history
+    2. ✅ 每次呼叫都重新注入 PDF 內容（支援重新上傳）
+    3. ✅ 每位使用者的狀態各自獨立（session），不會互相干擾
+    4. ✅ 使用 previous_response_id 維護 Response API 的狀態，之後每輪只送新問題
+    5. ✅ 處理 history=None 的邊界情況
+    6. ✅ 處理空白輸出的情況
+    7. ✅ 串流輸出：文字一產生就顯示，不必盯著畫面等 20–60 秒
+
+    支援兩種模式：
+    1. 有 PDF：論文閱讀助手模式
+    2. 無 PDF：一般 AI 助手模式
+
+    這是一個 generator：每收到一段文字就 yield 一次更新後的 history，
+    Gradio 會即時更新聊天區。session 的 conversation_history 和
+    last_response_id 只在收到完整回應後才更新，串流中斷不會留下半套的狀態。
+
+    Args:
+        message: 使用者當前輸入
+        history: Gradio 聊天歷史 [[user_msg, bot_msg], ...]
+        session: 這位使用者的 SessionState（由 gr.State 傳入）
+        answer_mode: 「回答模式」下拉選單的值；AUTO_ROUTE 表示自動判斷（見 8.3）
+
+    Yields:
+        tuple: (更新後的 Gradio 歷史記錄, session)
+    """
+    # 確保 history 和 session 是有效的
+    history = ensure_history(history)
+    session = ensure_session(session)
+
+    # 過濾空白訊息
+    user_message = (message or "").strip()
+    if not user_message:
+        yield history, session
+        return
+
+    # 背景摘要若已完成，先套用再讀取歷史
+    apply_history_summary(session)
+    request = RequestMetrics("chat")
+    route = route_question(user_message, answer_mode)
+
+    # 同一篇論文有人問過幾乎一樣的問題：直接使用快取的答案
+    scope = answer_cache_scope(session, route, user_message)
+    cached = answer_from_cache(session, request, route, scope, user_message)
+    if cached is not None:
+        history.append([user_message, cached])
+        yield history, session
+        return
+
+    # === 步驟 1–5: 建構請求（並記錄花了多久）===
+    with request.stage("build_request"):
+        turn = build_request(session, user_message, route=route)
+
+    # 先顯示使用者的問題，回答欄位之後逐步填入
+    history.append([user_message, ""])
+    yield history, session
+
+    progress = None
+    try:
+        progress = StreamProgress(started=time.perf_counter())
+
+        if STREAM_RESPONSES:
+            # === 步驟 6: 以串流方式呼叫 OpenAI Response API ===
+            turn, stream = create_response(session, user_message, turn, stream=True)
+            for event in stream:
+                if progress.apply(event):
+                    history[-1] = [user_message, progress.partial_reply]
+                    yield history, session
+
+            # === 步驟 7: 取得完整回應文字 ===
+            assistant_reply = progress.reply()
+            response = progress.response
+        else:
+            # 不串流：等完整回應後一次顯示
+            turn, response = create_response(session, user_message, turn)
+            assistant_reply = summarise_outputs(response)
+
+        # === 步驟 8–9: 更新對話歷史與 response_id，記錄指標 ===
+        assistant_reply = record_turn(session, turn, user_message, assistant_reply, response, progress)
+        observe_turn(request, turn, progress, response)
+        # 和對話內容無關的問題：把答案留給之後問同樣問題的同學
+        if scope is not None and assistant_reply.strip() and not assistant_reply.startswith("⚠️"):
+            answer_cache.store(scope, user_message, assistant_reply)
 
         # === 步驟 10: 更新 Gradio 顯示的歷史 ===
-        history.append([user_message, assistant_reply])
-        return history
+        history[-1] = [user_message, assistant_reply]
+        yield history, session
 
     except Exception as exc:
-        # 錯誤處理：同樣回傳 Gradio 格式
-        error_message = f"❌ 發生錯誤：{exc}\n\n請檢查網路連線與 API 設定後再試一次。"
-        history.append([user_message, error_message])
-        return history
+        # 錯誤處理：同樣回傳 Gradio 格式（已顯示的部分文字由錯誤訊息取代）
+        observe_turn(request, turn, progress, error=exc)
+        history[-1] = [user_message, error_reply(exc)]
+        yield history, session
 
 
-def upload_pdf(pdf_file: Optional[str]):
+async def chat_with_paper_async(message: str, history: Optional[List[List[str]]],
+                                session: Optional[SessionState] = None, answer_mode: str = AUTO_ROUTE):
     """
-    處理 PDF 上傳
+    chat_with_paper 的非同步版本（使用 AsyncOpenAI）
+
+    同步版本每個請求要佔用 Gradio 的一條 worker thread，等模型回答的
+    20–60 秒 thread 什麼也不做；非同步版本在同一個 event loop 上等待，
+    幾十位同學同時提問也不需要幾十條 thread。
+
+    同時送出的 API 請求最多 MAX_INFLIGHT_REQUESTS 個（request_slots
+    semaphore），其餘的在這裡排隊，畫面上會先顯示「排隊中」。
+
+    Args:
+        message: 使用者當前輸入
+        history: Gradio 聊天歷史 [[user_msg, bot_msg], ...]
+        session: 這位使用者的 SessionState（由 gr.State 傳入）
+        answer_mode: 「回答模式」下拉選單的值；AUTO_ROUTE 表示自動判斷（見 8.3）
+
+    Yields:
+        tuple: (更新後的 Gradio 歷史記錄, session)
+    """
+    history = ensure_history(history)
+    session = ensure_session(session)
+
+    user_message = (message or "").strip()
+    if not user_message:
+        yield history, session
+        return
+
+    # 背景摘要若已完成，先套用再讀取歷史
+    apply_history_summary(session)
+    request = RequestMetrics("chat")
+    route = route_question(user_message, answer_mode)
+
+    # 快取命中不需要排隊等 API
+    scope = answer_cache_scope(session, route, user_message)
+    cached = answer_from_cache(session, request, route, scope, user_message)
+    if cached is not None:
+        history.append([user_message, cached])
+        yield history, session
+        return
+
+    with request.stage("build_request"):
+        turn = build_request(session, user_message, route=route)
+
+    # 名額已滿時先告訴使用者正在排隊
+    waiting = "⏳ 目前提問的人比較多，排隊中⋯" if request_slots.locked() else ""
+    history.append([user_message, waiting])
+    yield history, session
+
+    progress = None
+    try:
+        # 取得名額後才送出請求；離開 async with 時自動歸還
+        waiting_since = time.perf_counter()
+        async with request_slots:
+            request.stages_ms["queue_wait"] = (time.perf_counter() - waiting_since) * 1000
+            progress = StreamProgress(started=time.perf_counter())
+
+            if STREAM_RESPONSES:
+                turn, stream = await create_response_async(session, user_message, turn, stream=True)
+                async for event in stream:
+                    if progress.apply(event):
+                        history[-1] = [user_message, progress.partial_reply]
+                        yield history, session
+                assistant_reply = progress.reply()
+                response = progress.response
+            else:
+                turn, response = await create_response_async(session, user_message, turn)
+                assistant_reply = summarise_outputs(response)
+
+        assistant_reply = record_turn(session, turn, user_message, assistant_reply, response, progress)
+        observe_turn(request, turn, progress, response)
+        # 和對話內容無關的問題：把答案留給之後問同樣問題的同學
+        if scope is not None and assistant_reply.strip() and not assistant_reply.startswith("⚠️"):
+            answer_cache.store(scope, user_message, assistant_reply)
+        history[-1] = [user_message, assistant_reply]
+        yield history, session
+
+    except Exception as exc:
+        observe_turn(request, turn, progress, error=exc)
+        history[-1] = [user_message, error_reply(exc)]
+        yield history, session
+
+
+def upload_pdf(pdf_file: Optional[str], session: Optional[SessionState] = None):
+    """
+    處理 PDF 上傳（generator：邊讀邊回報進度）
 
     **重要改進**：
     1. ✅ 更新 pdf_state 的版本號，讓模型知道是新的 PDF
     2. ✅ 保留 conversation_history（對話歷史不會因為上傳 PDF 而消失）
     3. ✅ 下次提問時會自動注入新的 PDF 內容
+    4. ✅ 重複上傳的論文直接從快取取出，幾毫秒就完成
+    5. ✅ 在背景讀取（8.5 節），前幾頁讀好就能開始提問
 
     Args:
         pdf_file: Gradio 上傳的檔案路徑
+        session: 這位使用者的 SessionState
 
-    Returns:
-        str: 上傳狀態訊息
+    Yields:
+        tuple: (上傳狀態訊息, session)，每個階段一次
     """
-    global pdf_state
+    session = ensure_session(session)
 
     if pdf_file is None:
-        return "❌ 請選擇 PDF 檔案"
-
-    try:
-        # 提取 PDF 文字
-        content = extract_pdf_text(pdf_file)
-    except ValueError as exc:
-        # 如果提取失敗，重置 PDF 狀態
-        pdf_state = PDFState()
-        return f"❌ {exc}"
-
-    # 更新 PDF 狀態（版本號遞增）
-    pdf_state = PDFState(
-        filename=os.path.basename(pdf_file),
-        content=content,
-        version=pdf_state.version + 1,
-    )
-
-    # 計算統計資訊
-    page_count = content.count("--- Page") or "?"
-    char_count = len(content)
-
-    # 產生友善的成功訊息
-    note = (
-        "✅ PDF 上傳成功！\n\n"
-        f"📄 檔名：{pdf_state.filename}\n"
-        f"📄 版本：{pdf_state.version}\n"
-        f"📄 頁面數：約 {page_count}\n"
-        f"🔤 文字長度：約 {char_count:,} 字元\n\n"
-        "💬 你可以直接提問，我會依據最新的 PDF 回答。"
-    )
+        yield "❌ 請選擇 PDF 檔案", session
+        return
 
-    return note
+    job = start_ingest(pdf_file, session)
+    for note in iter(job.notes.get, None):
+        if job.superseded:
+            return  # 狀態欄交給新上傳的 PDF
+        yield note, session
 
 
-def clear_conversation():
+def clear_conversation(session: Optional[SessionState] = None):
     """
     清除對話歷史，重新開始
 
-    注意：只清除對話歷史，PDF 設定保持不變
+    注意：只清除這位使用者的對話歷史，PDF 設定保持不變
 
     Returns:
-        tuple: (清空的聊天歷史, 狀態訊息)
+        tuple: (清空的聊天歷史, 狀態訊息, session)
     """
-    global conversation_history, last_response_id
+    session = ensure_session(session)
 
-    conversation_history = []
-    last_response_id = None
+    with session.lock:
+        session.conversation_history = []
+        session.last_response_id = None
+        session.chained_chunks = set()
+        session.chained_tokens = 0
+        session.history_summary = ""
+        # 還在背景進行的摘要屬於舊對話，完成後直接丟棄
+        session.pending_summary = None
 
-    return [], "🔄 對話已清除！PDF 設定保持不變。"
+    return [], "🔄 對話已清除！PDF 設定保持不變。", session
 
 # 建立 Gradio 介面
 with gr.Blocks(title="論文閱讀助手", theme=gr.themes.Soft()) as demo:
@@ -430,27 +2171,46 @@ with gr.Blocks(title="論文閱讀助手", theme=gr.themes.Soft()) as demo:
             with gr.Row():
                 submit_btn = gr.Button("📤 送出", variant="primary")
                 clear_btn = gr.Button("🔄 清除對話")
+                # 手動指定推理強度與回答長度，覆蓋自動判斷
+                answer_mode = gr.Dropdown(
+                    choices=ROUTE_CHOICES,
+                    value=AUTO_ROUTE,
+                    label="回答模式",
+                    info="自動判斷會依問題決定推理強度與回答長度"
+                )
+
+    # 每個瀏覽器分頁各自一份 SessionState，第一次事件時由 ensure_session 建立；
+    # 每次事件都回傳 session，閒置計時會重新開始
+    session_state = gr.State(None, time_to_live=SESSION_IDLE_SECONDS)
 
     # 事件綁定
+    # trigger_mode="multiple"：讀取中重新上傳時不必等上一份讀完，舊的工作會自動讓位
     pdf_upload.change(
         fn=upload_pdf,
-        inputs=pdf_upload,
-        outputs=upload_status
+        inputs=[pdf_upload, session_state],
+        outputs=[upload_status, session_state],
+        trigger_mode="multiple",
     )
 
+    # 非同步版本由 request_slots 控制同時請求數，不再受 Gradio worker 數限制
+    chat_handler = chat_with_paper_async if USE_ASYNC_CLIENT else chat_with_paper
+    chat_concurrency = None if USE_ASYNC_CLIENT else "default"
+
     submit_btn.click(
-        fn=chat_with_paper,
-        inputs=[msg_input, chatbot],
-        outputs=chatbot
+        fn=chat_handler,
+        inputs=[msg_input, chatbot, session_state, answer_mode],
+        outputs=[chatbot, session_state],
+        concurrency_limit=chat_concurrency
     ).then(
         lambda: "",  # 清空輸入框
         outputs=msg_input
     )
 
     msg_input.submit(
-        fn=chat_with_paper,
-        inputs=[msg_input, chatbot],
-        outputs=chatbot
+        fn=chat_handler,
+        inputs=[msg_input, chatbot, session_state, answer_mode],
+        outputs=[chatbot, session_state],
+        concurrency_limit=chat_concurrency
     ).then(
         lambda: "",  # 清空輸入框
         outputs=msg_input
@@ -458,7 +2218,8 @@ with gr.Blocks(title="論文閱讀助手", theme=gr.themes.Soft()) as demo:
 
     clear_btn.click(
         fn=clear_conversation,
-        outputs=[chatbot, upload_status]
+        inputs=session_state,
+        outputs=[chatbot, upload_status, session_state]
     )
 
     # 說明區
@@ -476,14 +2237,22 @@ with gr.Blocks(title="論文閱讀助手", theme=gr.themes.Soft()) as demo:
 
     - **模型**：OpenAI GPT-5 (Response API)
     - **推理等級**：Medium (平衡速度與品質)
-    - **PDF 處理**：PyPDF2 (完整文字提取)
+    - **串流輸出**：`stream=True`，回答邊產生邊顯示
+    - **多人同時使用**：`AsyncOpenAI` + 連線池，同時請求數由 semaphore 控制
+    - **提示快取**：固定前綴（system prompt + 論文開頭）+ 每篇論文一個 `prompt_cache_key`
+    - **監控指標**：每個請求的各階段耗時與 token 寫進 JSONL，並提供 Prometheus `/metrics`
+    - **PDF 處理**：PyPDF2 (完整文字提取，背景逐段讀取) + BM25 段落檢索
     - **介面框架**：Gradio 5.x
 
     ---
     *Made with ❤️ for NCCU AI Course*
     """)
 
-# 啟動 Gradio 應用
+# 指標端點（http://127.0.0.1:9464/metrics，只有本機抓得到）與 Gradio 並行
+start_metrics_server()
+
+# 啟動 Gradio 應用（允許多位使用者同時提問，排隊長度上限 QUEUE_MAX_SIZE）
+demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT, max_size=QUEUE_MAX_SIZE)
 demo.launch(share=True, debug=True)
 
 # ❌ 舊版 Chat Completions API
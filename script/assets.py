@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Sidecar image assets for the notebook ↔ markdown round trip
+Images are decoded once into <notebook>_assets/, named by content hash so
+duplicates are stored once, and re-inlined when the notebook is rebuilt.
+Only files with such a name are ours: anything else a user puts in the
+folder is never pruned or inlined
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+
+
+ASSETS_SUFFIX = '_assets'
+
+# Alt text marking an image that was a code cell output, not part of the text
+OUTPUT_IMAGE_ALT = 'Output image'
+
+MIME_EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/bmp': '.bmp',
+    'image/svg+xml': '.svg',
+}
+EXTENSION_MIMES = {ext: mime for mime, ext in MIME_EXTENSIONS.items()}
+EXTENSION_MIMES['.jpeg'] = 'image/jpeg'
+
+# Mime types stored as text in notebooks; everything else is base64
+TEXT_MIMES = {'image/svg+xml'}
+
+# Base64 is decoded in slices of this many characters (a multiple of 4)
+DECODE_CHUNK = 64 * 1024
+
+_BASE64_WHITESPACE = re.compile(r'\s+')
+
+# Names of the files we extract: <sha256 of the content><extension>
+GENERATED_NAME = re.compile(r'[0-9a-f]{64}(\.[a-z]+)')
+
+# ![alt](path) or ![alt](<path with spaces>)
+IMAGE_LINK = re.compile(r'!\[([^\]\n]*)\]\((<[^>\n]+>|[^)\s]+)\)')
+
+
+def is_generated_asset(path):
+    """Whether a file in an assets folder was extracted by us, judged by its name"""
+    path = Path(path)
+    match = GENERATED_NAME.fullmatch(path.name)
+    return (match is not None and path.parent.name.endswith(ASSETS_SUFFIX)
+            and (match.group(1) in EXTENSION_MIMES or match.group(1) == '.bin'))
+
+
+def assets_dir_for(input_file, output_file):
+    """<notebook>_assets/ next to the markdown output"""
+    return Path(output_file).parent / (Path(input_file).stem + ASSETS_SUFFIX)
+
+
+def format_link_target(ref):
+    """Wrap paths with spaces or parentheses in <...> so markdown keeps them whole"""
+    if any(char in ref for char in ' ()'):
+        return f'<{ref}>'
+    return ref
+
+
+def parse_link_target(target):
+    if target.startswith('<') and target.endswith('>'):
+        return target[1:-1]
+    return target
+
+
+class _AssetWriter:
+    """Streams one image into a temp file while hashing it"""
+
+    def __init__(self, store, mime, is_base64):
+        self.store = store
+        self.mime = mime
+        self.is_text = not is_base64
+        self.digest = hashlib.sha256()
+        self.tmp_path = store.directory / f".tmp-{uuid.uuid4().hex}.part"
+        # 0o666 lets the umask decide the mode, like any other file we write
+        fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        self.handle = os.fdopen(fd, 'wb')
+        # Undecoded base64 characters left over from the last feed
+        self.pending = ''
+
+    def _write(self, data):
+        self.digest.update(data)
+        self.handle.write(data)
+
+    def feed(self, text):
+        """Append a piece of the payload: base64 text, or plain text for SVG"""
+        if self.is_text:
+            self._write(text.encode('utf-8'))
+            return
+
+        for offset in range(0, len(text), DECODE_CHUNK):
+            piece = self.pending + _BASE64_WHITESPACE.sub('', text[offset:offset + DECODE_CHUNK])
+            usable = len(piece) - len(piece) % 4
+            if usable:
+                self._write(base64.b64decode(piece[:usable]))
+            self.pending = piece[usable:]
+
+    def close(self):
+        """Finish the image and return its path relative to the markdown file"""
+        try:
+            if self.pending.strip('='):
+                raise binascii.Error("Truncated base64 image payload")
+            self.handle.close()
+            name = self.digest.hexdigest() + MIME_EXTENSIONS.get(self.mime, '.bin')
+            final_path = self.store.directory / name
+            if final_path.exists():
+                # Same content already extracted: keep one copy
+                os.remove(self.tmp_path)
+            else:
+                os.replace(self.tmp_path, final_path)
+                self.store.unique += 1
+        except BaseException:
+            self.abort()
+            raise
+        self.store.count += 1
+        self.store.names.add(name)
+        return f"{self.store.directory.name}/{name}"
+
+    def abort(self):
+        self.handle.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class AssetStore:
+    """Content-addressed image directory for one notebook"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.count = 0
+        self.unique = 0
+        # File names referenced during this conversion
+        self.names = set()
+
+    def open(self, mime, is_base64=None):
+        """Start an image; notebooks store SVG as text and the rest as base64"""
+        if is_base64 is None:
+            is_base64 = mime not in TEXT_MIMES
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return _AssetWriter(self, mime, is_base64)
+
+    def save_chunks(self, mime, chunks, is_base64=None):
+        """Write an image from an iterable of payload pieces; return its ref"""
+        writer = self.open(mime, is_base64)
+        try:
+            for chunk in chunks:
+                writer.feed(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.close()
+
+    def save_slice(self, mime, text, start, end):
+        """Write a base64 data-URI payload text[start:end] without copying it whole"""
+        return self.save_chunks(mime, (text[offset:min(offset + DECODE_CHUNK, end)]
+                                       for offset in range(start, end, DECODE_CHUNK)),
+                                is_base64=True)
+
+    def prune(self):
+        """Delete images extracted by earlier conversions that are no longer referenced
+
+        Files not named like our own (see GENERATED_NAME) are left alone.
+        """
+        if not self.directory.is_dir():
+            return 0
+        removed = 0
+        for path in self.directory.iterdir():
+            if path.is_file() and path.name not in self.names and is_generated_asset(path):
+                path.unlink()
+                removed += 1
+        if not any(self.directory.iterdir()):
+            self.directory.rmdir()
+        return removed
+
+
+def output_image_ref(line):
+    """Return the asset path of an '![Output image](...)' line, or None"""
+    match = IMAGE_LINK.fullmatch(line.strip())
+    if match is None or match.group(1) != OUTPUT_IMAGE_ALT:
+        return None
+    ref = parse_link_target(match.group(2))
+    if not is_generated_asset(ref):
+        return None
+    return ref
+
+
+def resolve_asset(ref, base_dir):
+    """Return the asset file for a markdown link target, or None if it isn't ours"""
+    path = Path(base_dir) / parse_link_target(ref)
+    if not is_generated_asset(path) or path.suffix not in EXTENSION_MIMES:
+        return None
+    if not path.is_file():
+        return None
+    return path
+
+
+def read_asset(path):
+    """Return (mime, payload) as stored in a notebook: base64, or text for SVG"""
+    mime = EXTENSION_MIMES[Path(path).suffix]
+    if mime in TEXT_MIMES:
+        return mime, Path(path).read_text(encoding='utf-8')
+    with open(path, 'rb') as f:
+        return mime, base64.b64encode(f.read()).decode('ascii')
+
+
+def inline_markdown_images(text, base_dir):
+    """Replace links to images we extracted with data URIs again; other links stay links"""
+    if ASSETS_SUFFIX not in text:
+        return text
+
+    def replace(match):
+        path = resolve_asset(match.group(2), base_dir)
+        if path is None:
+            return match.group(0)
+        mime, payload = read_asset(path)
+        if mime in TEXT_MIMES:
+            payload = base64.b64encode(payload.encode('utf-8')).decode('ascii')
+        return f"![{match.group(1)}](data:{mime};base64,{payload})"
+
+    return IMAGE_LINK.sub(replace, text)
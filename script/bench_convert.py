@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the notebook ↔ markdown converters
+Generates synthetic notebooks along several axes (cell count, cell size,
+output volume, embedded image volume), times and memory-profiles
+notebook_to_markdown, markdown_to_notebook and the convert.py dispatch,
+and compares the results against a stored JSON baseline
+(bench_baseline.json, made with --quick on the machine noted in its meta)
+"""
+import argparse
+import base64
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+TARGETS = ['notebook_to_markdown', 'markdown_to_notebook', 'convert']
+TARGET_LABELS = {'notebook_to_markdown': '.ipynb → .md', 'markdown_to_notebook': '.md → .ipynb',
+                 'convert': 'convert.py'}
+
+# Each axis varies one property; the rest stay at these defaults
+DEFAULTS = {'cells': 100, 'lines': 10, 'output_kb': 0, 'image_kb': 0}
+AXES = {
+    'cells': [10, 100, 1_000, 10_000, 100_000],
+    'lines': [1, 10, 100, 1_000],
+    'output_kb': [0, 1, 10, 100],
+    'image_kb': [0, 10, 100, 1_000],
+}
+# --quick drops the largest point of every axis
+QUICK_LIMITS = {'cells': 10_000, 'lines': 100, 'output_kb': 10, 'image_kb': 100}
+
+# Differences below these floors are noise, not regressions
+TIME_FLOOR = 0.02  # seconds
+MEMORY_FLOOR = 2.0  # MB
+
+
+def generate_notebook(path, cells, lines, output_kb, image_kb, seed=0):
+    """Write a synthetic notebook alternating markdown and code cells
+
+    Code cells carry `lines` lines of source, `output_kb` KB of stream
+    output and a PNG-like output of `image_kb` KB of random bytes.
+    """
+    rng = random.Random(seed)
+    notebook_cells = []
+    for index in range(cells):
+        if index % 2 == 0:
+            notebook_cells.append({
+                'cell_type': 'markdown',
+                'metadata': {},
+                'source': [f"## Step {index}\n"] + [f"Some notes about step {index}, line {n}.\n"
+                                                    for n in range(lines - 1)],
+            })
+            continue
+
+        outputs = []
+        if output_kb:
+            log_line = "Epoch {}/20 - loss: {:.4f} - accuracy: {:.4f}\n"
+            text = []
+            size = 0
+            while size < output_kb * 1024:
+                text.append(log_line.format(len(text) % 20 + 1, rng.random(), rng.random()))
+                size += len(text[-1])
+            outputs.append({'output_type': 'stream', 'name': 'stdout', 'text': text})
+        if image_kb:
+            image = rng.getrandbits(image_kb * 8192).to_bytes(image_kb * 1024, 'little')
+            payload = base64.b64encode(image).decode('ascii')
+            outputs.append({
+                'output_type': 'display_data',
+                'metadata': {},
+                'data': {'image/png': payload, 'text/plain': ['<Figure size 640x480 with 1 Axes>']},
+            })
+
+        notebook_cells.append({
+            'cell_type': 'code',
+            'metadata': {},
+            'execution_count': index,
+            'source': [f"value_{index}_{n} = compute({n}, {rng.randint(0, 9999)})\n" for n in range(lines)],
+            'outputs': outputs,
+        })
+
+    notebook = {
+        'cells': notebook_cells,
+        'metadata': {
+            'colab': {'provenance': []},
+            'language_info': {'name': 'python'},
+        },
+        'nbformat': 4,
+        'nbformat_minor': 0,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(notebook, f, indent=1, ensure_ascii=False)
+
+
+def run_target(target, input_file, trace_memory=False):
+    """Run one conversion in this process (the --run-one child)
+
+    With trace_memory, report the peak of Python allocations made during
+    the call (tracemalloc), otherwise its untraced wall time; tracing
+    slows the call down too much to do both in one run.
+    """
+    sys.path.insert(0, str(SCRIPT_DIR))
+    if target == 'notebook_to_markdown':
+        from notebook_to_md import notebook_to_markdown
+        call = lambda: notebook_to_markdown(input_file, quiet=True)
+    elif target == 'markdown_to_notebook':
+        from md_to_notebook import markdown_to_notebook
+        call = lambda: markdown_to_notebook(input_file, quiet=True)
+    else:
+        import convert
+
+        def call():
+            sys.argv = ['convert.py', input_file, '--force']
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                convert.main()
+
+    if trace_memory:
+        tracemalloc.start()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(json.dumps({'peak_mb': peak / (1024 * 1024)}))
+        return
+
+    started = time.perf_counter()
+    call()
+    print(json.dumps({'seconds': time.perf_counter() - started}))
+
+
+def _run_child(target, input_file, *flags):
+    completed = subprocess.run([sys.executable, __file__, '--run-one', target, str(input_file), *flags],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{target} failed on {input_file}:\n{completed.stderr.strip()}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure(target, input_file, repeat):
+    """Best of repeat timed runs plus one traced run for memory, each in a fresh interpreter"""
+    seconds = min(_run_child(target, input_file)['seconds'] for _ in range(repeat))
+    return {
+        'seconds': seconds,
+        'peak_mb': _run_child(target, input_file, '--memory')['peak_mb'],
+        'input_kb': Path(input_file).stat().st_size / 1024,
+    }
+
+
+def iter_cases(axes, quick):
+    for axis in axes:
+        for value in AXES[axis]:
+            if quick and value > QUICK_LIMITS[axis]:
+                continue
+            params = dict(DEFAULTS, **{axis: value})
+            yield f"{axis}={value}", params
+
+
+def run_suite(axes, repeat, quick, workdir):
+    results = {}
+    for name, params in iter_cases(axes, quick):
+        case_dir = Path(workdir) / name.replace('=', '_')
+        case_dir.mkdir()
+        notebook = case_dir / 'bench.ipynb'
+        generate_notebook(notebook, **params)
+
+        # notebook_to_markdown writes bench.md, which the other targets read
+        results[name] = {
+            'notebook_to_markdown': measure('notebook_to_markdown', notebook, repeat),
+            'markdown_to_notebook': measure('markdown_to_notebook', case_dir / 'bench.md', repeat),
+            'convert': measure('convert', notebook, repeat),
+        }
+        print_case(name, results[name])
+    return results
+
+
+def print_case(name, case):
+    cells = '  '.join(f"{case[target]['seconds'] * 1000:9.1f} ms {case[target]['peak_mb']:7.1f} MB"
+                      for target in TARGETS)
+    print(f"  {name:<18} {case['notebook_to_markdown']['input_kb']:>10.0f} KB  {cells}")
+
+
+def compare(results, baseline, threshold):
+    """Print changes against the baseline; return the number of regressions"""
+    regressions = 0
+    print(f"\n📈 Compared with baseline ({baseline['meta'].get('created', 'unknown date')}):")
+    for name, case in results.items():
+        old_case = baseline['results'].get(name)
+        if old_case is None:
+            continue
+        for target in TARGETS:
+            new, old = case[target], old_case.get(target)
+            if old is None:
+                continue
+            for metric, floor in (('seconds', TIME_FLOOR), ('peak_mb', MEMORY_FLOOR)):
+                if metric not in old:
+                    continue  # baseline from an older version of this script
+                if max(new[metric], old[metric]) < floor:
+                    continue
+                ratio = new[metric] / max(old[metric], floor)
+                if ratio > 1 + threshold and new[metric] - old[metric] > floor:
+                    regressions += 1
+                    print(f"  ❌ {name} {target} {metric}: {old[metric]:.3f} → {new[metric]:.3f} ({ratio:.2f}x)")
+                elif ratio < 1 - threshold:
+                    print(f"  ✅ {name} {target} {metric}: {old[metric]:.3f} → {new[metric]:.3f} ({ratio:.2f}x)")
+    if not regressions:
+        print(f"  ✅ No regressions beyond {threshold:.0%}")
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--run-one':
+        run_target(sys.argv[2], sys.argv[3], trace_memory='--memory' in sys.argv[4:])
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the notebook ↔ markdown converters")
+    parser.add_argument('--axis', action='append', choices=list(AXES),
+                        help="axis to benchmark (repeatable; default: all)")
+    parser.add_argument('--quick', action='store_true', help="skip the largest size of every axis")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement (default: 3)")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline',
+                        help="compare against results saved with --output, e.g. bench_baseline.json; "
+                             "timings only compare on the same machine, so save your own first")
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help="relative slowdown or memory growth counted as a regression (default: 0.15)")
+    args = parser.parse_args()
+
+    axes = args.axis or list(AXES)
+    print(f"🧪 Benchmarking {', '.join(axes)} ({args.repeat} runs each, time = best, memory = peak traced allocations)")
+    print(f"  {'case':<18} {'input':>13}  " + '  '.join(f"{TARGET_LABELS[target]:>23}" for target in TARGETS))
+
+    with tempfile.TemporaryDirectory(prefix='bench-convert-') as workdir:
+        results = run_suite(axes, args.repeat, args.quick, workdir)
+
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for notebook_to_md.scrub_markdown
+Times the linear scanner against the original regex pipeline on inputs
+that make the non-greedy patterns backtrack, and checks that the scanner's
+cost grows linearly with input size
+"""
+import math
+import re
+import sys
+import time
+from notebook_to_md import scrub_markdown
+
+
+IMAGE_PATTERN = re.compile(r'!\[.*?\]\(data:image/.*?;base64,.*?\)')
+BADGE_PATTERN = re.compile(r'<a href="https://colab\.research\.google\.com/.*?</a>')
+
+# Stop timing the regex once a single run takes longer than this (seconds)
+REGEX_BUDGET = 0.5
+
+# Log-log slope above which we consider the scanner super-linear
+MAX_SLOPE = 1.25
+
+SIZES = [1_000, 4_000, 16_000, 64_000, 256_000, 1_024_000]
+
+
+def regex_scrub(text):
+    """The patterns clean_markdown_source used before the scanner"""
+    text = IMAGE_PATTERN.sub('[Image omitted]', text)
+    return BADGE_PATTERN.sub('', text)
+
+
+def repeat_to(unit, size):
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+# Each case builds a single-line input of roughly the requested size
+CASES = {
+    # A realistic plot pasted into a markdown cell: one huge valid image
+    'large_image': lambda n: '![plot](data:image/png;base64,' + 'A' * n + ')',
+    # Many image openers and no data URI: every '![' scans to end of line
+    'unclosed_alt_text': lambda n: repeat_to('![a', n),
+    # Data URIs that never close: every match attempt runs to end of line
+    'unterminated_payload': lambda n: repeat_to('![a](data:image/png;base64,AAAA', n),
+    # Colab badge openers without '</a>'
+    'unclosed_badge': lambda n: repeat_to('<a href="https://colab.research.google.com/x">', n),
+}
+
+
+def best_time(func, text, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def log_slope(points):
+    """Least-squares slope of log(time) against log(size)"""
+    xs = [math.log(size) for size, _ in points]
+    ys = [math.log(max(t, 1e-9)) for _, t in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    num = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    den = sum((x - mean_x) ** 2 for x in xs)
+    return num / den
+
+
+def main():
+    all_linear = True
+
+    for name, build in CASES.items():
+        print(f"\n🧪 {name}")
+        print(f"{'chars':>10} {'scanner ms':>11} {'ns/char':>8} {'regex ms':>10} {'speed-up':>9}")
+
+        scanner_points = []
+        regex_enabled = True
+        for size in SIZES:
+            text = build(size)
+            scanner = best_time(scrub_markdown, text)
+            scanner_points.append((size, scanner))
+
+            regex_cell = '-'
+            speedup_cell = '-'
+            if regex_enabled:
+                regex = best_time(regex_scrub, text, repeat=1)
+                if regex_scrub(text) != scrub_markdown(text):
+                    print(f"❌ Output mismatch for {name} at {size} chars")
+                    sys.exit(1)
+                regex_cell = f"{regex * 1000:.2f}"
+                speedup_cell = f"{regex / scanner:.1f}x"
+                regex_enabled = regex < REGEX_BUDGET
+
+            print(f"{size:>10} {scanner * 1000:>11.3f} {scanner / size * 1e9:>8.1f} "
+                  f"{regex_cell:>10} {speedup_cell:>9}")
+
+        slope = log_slope(scanner_points)
+        linear = slope < MAX_SLOPE
+        all_linear &= linear
+        status = '✅ linear' if linear else '❌ super-linear'
+        print(f"{status} (log-log slope {slope:.2f})")
+
+    sys.exit(0 if all_linear else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Round-trip check for md_to_notebook --merge
+Converts a small Colab-style notebook to markdown and back, edits one cell
+in the markdown and merges it into both the plain conversion and the
+original notebook; every cell but the edited one must keep its exact
+bytes, and merging into the plain conversion must give the same notebook
+as converting the edited markdown from scratch
+"""
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from md_to_notebook import markdown_to_notebook
+from notebook_reader import read_notebook_layout
+from notebook_to_md import notebook_to_markdown
+
+
+CELLS = [
+    ('markdown', "## Step 0\n\nLoad the data."),
+    ('code', "import math\nprint(math.pi)"),
+    ('markdown', "## Step 1\n\nSquare it."),
+    ('code', "x = math.pi ** 2\nprint(x)"),
+    ('markdown', "## Step 2\n\nDone."),
+    ('code', "print('bye')"),
+]
+
+# (old, new) text of the one cell the check edits
+EDIT = ("Square it.", "Square it twice.")
+
+
+def write_colab_notebook(path):
+    """A notebook the way Colab saves it: ids, per-cell metadata, outputs, no title"""
+    cells = []
+    for index, (cell_type, source) in enumerate(CELLS):
+        cell = {'cell_type': cell_type, 'id': f"cell{index:04d}", 'metadata': {'id': f"colab{index}"},
+                'source': source.splitlines(keepends=True)}
+        if cell_type == 'code':
+            cell.update(execution_count=index, outputs=[
+                {'name': 'stdout', 'output_type': 'stream', 'text': [f"output {index}\n"]}])
+        cells.append(cell)
+    notebook = {'cells': cells, 'metadata': {'colab': {'provenance': []}}, 'nbformat': 4, 'nbformat_minor': 5}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(notebook, f, indent=1, sort_keys=True, ensure_ascii=False)
+
+
+def cell_texts(path):
+    text = Path(path).read_text(encoding='utf-8')
+    return [text[start:end] for start, end, _ in read_notebook_layout(text)['cells']]
+
+
+def merge(markdown_file, target):
+    """Merge markdown_file into target; returns the number of cells whose bytes changed"""
+    before = cell_texts(target)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        markdown_to_notebook(markdown_file, target, merge=True)
+    after = cell_texts(target)
+    if len(before) != len(after):
+        raise AssertionError(f"{target}: {len(before)} cells before the merge, {len(after)} after")
+    return sum(old != new for old, new in zip(before, after))
+
+
+def main():
+    ok = True
+    with tempfile.TemporaryDirectory(prefix='check-merge-') as workdir:
+        original = os.path.join(workdir, 'nb.ipynb')
+        markdown_file = os.path.join(workdir, 'nb.md')
+        write_colab_notebook(original)
+        notebook_to_markdown(original, markdown_file, quiet=True)
+
+        plain = os.path.join(workdir, 'plain.ipynb')
+        markdown_to_notebook(markdown_file, plain, quiet=True)
+        colab = os.path.join(workdir, 'colab.ipynb')
+        shutil.copyfile(original, colab)
+
+        # Merging the markdown the notebooks came from must not touch them
+        for name, target in (('plain conversion', plain), ('Colab notebook', colab)):
+            changed = merge(markdown_file, target)
+            ok &= changed == 0
+            print(f"{'✅' if changed == 0 else '❌'} unchanged markdown into the {name}: {changed} cells changed")
+
+        text = Path(markdown_file).read_text(encoding='utf-8')
+        Path(markdown_file).write_text(text.replace(*EDIT), encoding='utf-8')
+
+        for name, target in (('plain conversion', plain), ('Colab notebook', colab)):
+            changed = merge(markdown_file, target)
+            ok &= changed == 1
+            print(f"{'✅' if changed == 1 else '❌'} one edited cell into the {name}: {changed} cells changed")
+
+        fresh = os.path.join(workdir, 'fresh.ipynb')
+        markdown_to_notebook(markdown_file, fresh, quiet=True)
+        same = Path(plain).read_bytes() == Path(fresh).read_bytes()
+        ok &= same
+        print(f"{'✅' if same else '❌'} merged plain conversion "
+              f"{'matches' if same else 'differs from'} a fresh conversion")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Content-hash conversion cache
+Remembers which sources were already converted so unchanged files are skipped
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from output_store import store_path_for
+
+
+# Bump whenever the converters change their output, so cached results are redone
+CONVERTER_VERSION = 3
+
+# One manifest per source directory, next to the files it describes
+MANIFEST_NAME = '.convert-manifest.json'
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hash a file in fixed-size chunks without loading it into memory"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def conversion_options(source, extract_images=False, keep_outputs=False, compact=False, merge=False):
+    """Everything besides the source that changes its outputs, as a manifest string"""
+    if Path(source).suffix == '.ipynb':
+        flags = [('assets', extract_images), ('outputs', keep_outputs)]
+        return '+'.join(name for name, enabled in flags if enabled)
+    options = [name for name, enabled in (('compact', compact), ('merge', merge)) if enabled]
+    # A notebook rebuilt from markdown also depends on the saved outputs
+    store = store_path_for(source)
+    if store.exists():
+        options.append('outputs:' + file_sha256(store))
+    return '+'.join(options)
+
+
+class ConversionManifest:
+    """Record of converted sources in a single directory
+
+    Entries are keyed by source file name and store the source hash, the
+    options used and the outputs that were written. The whole manifest is
+    discarded when CONVERTER_VERSION changes.
+    """
+
+    def __init__(self, directory):
+        self.path = Path(directory) / MANIFEST_NAME
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == CONVERTER_VERSION:
+                self.entries = data.get('entries', {})
+            else:
+                # Older converter: every entry is stale
+                self.dirty = True
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def _relative(self, path):
+        return os.path.relpath(Path(path).resolve(), self.path.parent)
+
+    def lookup(self, source, outputs, options):
+        """Return the source hash and whether the recorded outputs are up to date"""
+        source = Path(source)
+        entry = self.entries.get(source.name)
+        size = source.stat().st_size
+
+        # The digest is needed either way: to compare now, or to record later
+        fresh = (entry is not None
+                 and entry.get('size') == size
+                 and entry.get('options') == options
+                 and entry.get('outputs') == [self._relative(o) for o in outputs]
+                 and all(Path(o).exists() for o in outputs))
+
+        digest = file_sha256(source)
+        return digest, fresh and entry.get('sha256') == digest
+
+    def record(self, source, digest, outputs, options):
+        source = Path(source)
+        self.entries[source.name] = {
+            'sha256': digest,
+            'size': source.stat().st_size,
+            'options': options,
+            'outputs': [self._relative(o) for o in outputs],
+        }
+        self.dirty = True
+
+    def prune(self):
+        """Drop entries whose source file no longer exists"""
+        directory = self.path.parent
+        missing = [name for name in self.entries if not (directory / name).exists()]
+        for name in missing:
+            del self.entries[name]
+        if missing:
+            self.dirty = True
+        return len(missing)
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {'version': CONVERTER_VERSION, 'entries': self.entries}
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+class ConversionCache:
+    """Manifests for every directory touched during a conversion run"""
+
+    def __init__(self, force=False):
+        self.force = force
+        self.manifests = {}
+
+    def manifest_for(self, source):
+        directory = Path(source).resolve().parent
+        if directory not in self.manifests:
+            self.manifests[directory] = ConversionManifest(directory)
+        return self.manifests[directory]
+
+    def lookup(self, source, outputs, options=''):
+        """Return (digest, fresh); fresh is always False when forced"""
+        digest, fresh = self.manifest_for(source).lookup(source, outputs, options)
+        return digest, fresh and not self.force
+
+    def record(self, source, digest, outputs, options=''):
+        self.manifest_for(source).record(source, digest, outputs, options)
+
+    def save(self):
+        """Prune deleted sources and write every changed manifest
+
+        Returns the number of pruned entries.
+        """
+        pruned = 0
+        for manifest in self.manifests.values():
+            pruned += manifest.prune()
+            manifest.save()
+        return pruned
@@ -2,43 +2,271 @@
 """
 Bidirectional converter between Jupyter notebooks and Markdown
 Automatically detects file type and converts accordingly
+Directories and glob patterns are converted in parallel (batch mode)
 """
+import argparse
+import glob
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+import json_backend
+from conversion_cache import ConversionCache, conversion_options
+from watch import watch
 from notebook_to_md import notebook_to_markdown
 from md_to_notebook import markdown_to_notebook
 
 
+SUPPORTED_SUFFIXES = ('.ipynb', '.md')
+
+# Output suffix produced for each input suffix
+OUTPUT_SUFFIXES = {'.ipynb': '.md', '.md': '.ipynb'}
+
+
+def print_usage():
+    print("Usage: python convert.py <file.ipynb|file.md> [output_file]")
+    print("       python convert.py <dir|glob> [<dir|glob> ...] [-j N] [--force] [--assets] [--outputs]")
+    print("       python convert.py --watch <dir> [--poll] [--debounce SECONDS]")
+    print("\n🔄 Bidirectional Converter:")
+    print("  • .ipynb → .md : For editing with Claude Code")
+    print("  • .md → .ipynb : For running in Colab")
+    print("\nExamples:")
+    print("  python convert.py notebook.ipynb    # Creates notebook.md")
+    print("  python convert.py notebook.md       # Creates notebook_from_md.ipynb")
+    print("  python convert.py 'HW 1' Week6 -j 8  # Converts every notebook in both folders")
+    print("  python convert.py 'HW */*.md'       # Converts every matching markdown file")
+    print("  python convert.py --watch 'HW 1'    # Reconverts files in 'HW 1' on every save")
+    print("  python convert.py notebook.ipynb --assets  # Saves images to notebook_assets/")
+    print("  python convert.py notebook.ipynb --outputs # Keeps outputs for cells you don't edit")
+    print("  python convert.py notebook.md --merge      # Updates only the edited cells of the notebook")
+    print("\nUnchanged sources are skipped; pass --force to reconvert everything.")
+
+
+def expected_outputs(input_file, output_file=None):
+    """Files a conversion of input_file writes, used to validate the cache"""
+    input_path = Path(input_file)
+    if input_path.suffix == '.ipynb':
+        return [Path(output_file) if output_file else input_path.with_suffix('.md')]
+    return [Path(output_file) if output_file else input_path.parent / (input_path.stem + '_from_md.ipynb'),
+            input_path.with_suffix('.py')]
+
+
+def convert_file(input_file, output_file=None, quiet=False, source_hash=None,
+                 extract_images=False, keep_outputs=False, compact=False, merge=False):
+    """Convert a single file based on its suffix and return the output path"""
+    suffix = Path(input_file).suffix
+    if suffix == '.ipynb':
+        return notebook_to_markdown(str(input_file), output_file, quiet=quiet,
+                                    extract_images=extract_images, keep_outputs=keep_outputs)
+    if suffix == '.md':
+        return markdown_to_notebook(str(input_file), output_file, quiet=quiet,
+                                    source_hash=source_hash, compact=compact, merge=merge)
+    raise ValueError(f"Unsupported file type '{suffix}'")
+
+
+def _convert_for_batch(input_file, source_hash=None, extract_images=False, keep_outputs=False,
+                       compact=False, merge=False):
+    """Process pool worker: convert one file quietly and report the outcome"""
+    started = time.perf_counter()
+    result = {'input': str(input_file), 'output': None, 'error': None,
+              'sha256': source_hash}
+    try:
+        result['output'] = convert_file(input_file, quiet=True, source_hash=source_hash,
+                                        extract_images=extract_images, keep_outputs=keep_outputs,
+                                        compact=compact, merge=merge)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['elapsed'] = time.perf_counter() - started
+    return result
+
+
+def _is_generated_notebook(path):
+    return path.name.endswith('_from_md.ipynb') or '.ipynb_checkpoints' in path.parts
+
+
+def collect_batch_files(patterns):
+    """Expand files, directories and glob patterns into a sorted list of sources
+
+    Directories are searched recursively for notebooks only; notebooks we
+    generated ourselves (*_from_md.ipynb) are skipped so a re-sync does not
+    convert its own output. Use a glob such as 'HW */*.md' to batch Markdown.
+    """
+    files = set()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = [Path(p) for p in glob.glob(pattern, recursive=True)]
+        else:
+            matches = [Path(pattern)]
+
+        for path in matches:
+            if path.is_dir():
+                files.update(p for p in path.rglob('*.ipynb') if not _is_generated_notebook(p))
+            elif path.is_file() and path.suffix in SUPPORTED_SUFFIXES:
+                files.add(path)
+
+    return sorted(files)
+
+
+def run_batch(files, jobs=None, force=False, extract_images=False, keep_outputs=False, compact=False,
+              merge=False):
+    """Convert files over a process pool and print one aggregated summary
+
+    Sources whose content hash matches the conversion manifest are skipped
+    unless force is set. Returns the number of failed conversions.
+    """
+    started = time.perf_counter()
+    cache = ConversionCache(force=force)
+
+    stale = []
+    skipped = 0
+    for f in files:
+        options = conversion_options(f, extract_images, keep_outputs, compact, merge)
+        digest, fresh = cache.lookup(f, expected_outputs(f), options)
+        if fresh:
+            skipped += 1
+        else:
+            stale.append((f, digest, options))
+
+    jobs = jobs or os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(stale)))
+
+    if jobs == 1:
+        results = [_convert_for_batch(f, digest, extract_images, keep_outputs, compact, merge)
+                   for f, digest, _ in stale]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_convert_for_batch, f, digest, extract_images, keep_outputs, compact,
+                                   merge)
+                       for f, digest, _ in stale]
+            results = [future.result() for future in as_completed(futures)]
+
+    options = {str(f): opts for f, _, opts in stale}
+    for r in results:
+        if not r['error']:
+            cache.record(r['input'], r['sha256'], expected_outputs(r['input']), options[r['input']])
+    pruned = cache.save()
+
+    elapsed = time.perf_counter() - started
+    failed = sorted((r for r in results if r['error']), key=lambda r: r['input'])
+    succeeded = [r for r in results if not r['error']]
+    to_markdown = sum(1 for r in succeeded if r['input'].endswith('.ipynb'))
+    to_notebook = len(succeeded) - to_markdown
+
+    print(f"✅ Converted {len(succeeded)}/{len(results)} changed files in {elapsed:.2f}s with {jobs} worker(s)")
+    print(f"📓 .ipynb → .md: {to_markdown}")
+    print(f"📝 .md → .ipynb + .py: {to_notebook}")
+    if skipped:
+        print(f"⏭️  Skipped {skipped} unchanged (use --force to reconvert)")
+    if pruned:
+        print(f"🧹 Pruned {pruned} manifest entries for deleted sources")
+    if failed:
+        print(f"❌ {len(failed)} failed:")
+        for r in failed:
+            print(f"   • {r['input']}: {r['error']}")
+
+    return len(failed)
+
+
+def _is_output_argument(input_path, candidate):
+    """Whether the second positional argument is an explicit output file"""
+    return (input_path.is_file()
+            and not glob.has_magic(candidate)
+            and Path(candidate).suffix == OUTPUT_SUFFIXES.get(input_path.suffix))
+
+
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python convert.py <file.ipynb|file.md> [output_file]")
-        print("\n🔄 Bidirectional Converter:")
-        print("  • .ipynb → .md : For editing with Claude Code")
-        print("  • .md → .ipynb : For running in Colab")
-        print("\nExamples:")
-        print("  python convert.py notebook.ipynb    # Creates notebook.md")
-        print("  python convert.py notebook.md       # Creates notebook_from_md.ipynb")
+        print_usage()
         sys.exit(1)
 
-    input_file = Path(sys.argv[1])
-    output_file = sys.argv[2] if len(sys.argv) > 2 else None
+    parser = argparse.ArgumentParser(usage="%(prog)s <file|dir|glob> [...] [-j N] [--force] [--assets] [--outputs] [--compact] [--merge] [--watch]")
+    parser.add_argument('paths', nargs='+', help="input file, directory or glob pattern")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of worker processes for batch mode (default: CPU count)")
+    parser.add_argument('--force', action='store_true',
+                        help="reconvert even if the source is unchanged since the last run")
+    parser.add_argument('--assets', action='store_true',
+                        help="save notebook images to <notebook>_assets/ and link them from the markdown")
+    parser.add_argument('--outputs', action='store_true',
+                        help="save cell outputs to <name>.outputs.json so unedited cells keep them")
+    parser.add_argument('--compact', action='store_true',
+                        help="write notebooks without indentation (smaller, harder to diff)")
+    parser.add_argument('--merge', action='store_true',
+                        help="update an existing notebook in place, keeping cell ids, metadata and untouched cells")
+    parser.add_argument('--json-backend', choices=json_backend.BACKENDS, default=None,
+                        help="JSON library to use (default: orjson or ujson if installed, else stdlib)")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and reconvert files in the given directories on save")
+    parser.add_argument('--poll', action='store_true',
+                        help="with --watch, poll for changes instead of using inotify")
+    parser.add_argument('--debounce', type=float, default=0.3,
+                        help="with --watch, seconds to wait for a burst of writes to settle")
+    args = parser.parse_args()
+
+    if args.json_backend:
+        try:
+            json_backend.set_backend(args.json_backend)
+        except ValueError as e:
+            print(f"❌ Error: {e}")
+            sys.exit(1)
+
+    paths = args.paths
+    input_file = Path(paths[0])
+
+    if args.watch:
+        for path in paths:
+            if not Path(path).is_dir():
+                print(f"❌ Error: '{path}' is not a directory")
+                sys.exit(1)
+        watch(paths, debounce=args.debounce, polling=args.poll, extract_images=args.assets,
+              keep_outputs=args.outputs, compact=args.compact, merge=args.merge)
+        return
+
+    # Single file mode: convert.py <file> [output_file]
+    if input_file.is_file() and (len(paths) == 1 or
+                                 (len(paths) == 2 and _is_output_argument(input_file, paths[1]))):
+        output_file = paths[1] if len(paths) == 2 else None
 
-    if not input_file.exists():
-        print(f"❌ Error: File '{input_file}' not found")
+        if input_file.suffix not in SUPPORTED_SUFFIXES:
+            print(f"❌ Error: Unsupported file type '{input_file.suffix}'")
+            print("   Supported: .ipynb, .md")
+            sys.exit(1)
+
+        cache = ConversionCache(force=args.force)
+        outputs = expected_outputs(input_file, output_file)
+        options = conversion_options(input_file, args.assets, args.outputs, args.compact, args.merge)
+        digest, fresh = cache.lookup(input_file, outputs, options)
+        if fresh:
+            print(f"⏭️  {input_file} is unchanged since the last conversion (use --force to reconvert)")
+        else:
+            # Detect file type and convert
+            if input_file.suffix == '.ipynb':
+                print(f"📓 Converting notebook to markdown...")
+            else:
+                print(f"📝 Converting markdown to notebook AND Python script...")
+            convert_file(input_file, output_file, source_hash=digest, extract_images=args.assets,
+                         keep_outputs=args.outputs, compact=args.compact, merge=args.merge)
+            cache.record(input_file, digest, outputs, options)
+        cache.save()
+        return
+
+    for path in paths:
+        if not glob.has_magic(path) and not Path(path).exists():
+            print(f"❌ Error: File '{path}' not found")
+            sys.exit(1)
+
+    # Batch mode: directories, globs or several files
+    files = collect_batch_files(paths)
+    if not files:
+        print(f"❌ Error: No .ipynb or .md files matched {', '.join(paths)}")
         sys.exit(1)
 
-    # Detect file type and convert
-    if input_file.suffix == '.ipynb':
-        print(f"📓 Converting notebook to markdown...")
-        notebook_to_markdown(str(input_file), output_file)
-    elif input_file.suffix == '.md':
-        print(f"📝 Converting markdown to notebook AND Python script...")
-        markdown_to_notebook(str(input_file), output_file)
-    else:
-        print(f"❌ Error: Unsupported file type '{input_file.suffix}'")
-        print("   Supported: .ipynb, .md")
+    print(f"🔄 Batch converting {len(files)} files...")
+    if run_batch(files, args.jobs, force=args.force, extract_images=args.assets,
+                 keep_outputs=args.outputs, compact=args.compact, merge=args.merge):
         sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
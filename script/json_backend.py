@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Pluggable JSON backend for the converters
+Uses orjson or ujson when installed and falls back to the stdlib json module
+The stdlib backend with indent=2 is the reference format; orjson matches it
+byte for byte except for the spelling of exponent floats (1e20 vs 1e+20)
+"""
+import json
+import os
+
+
+# Set by set_backend so batch worker processes pick the same backend
+ENV_VAR = 'NOTEBOOK_JSON_BACKEND'
+
+BACKENDS = ('auto', 'orjson', 'ujson', 'stdlib')
+
+
+class StdlibBackend:
+    name = 'stdlib'
+
+    def loads(self, text):
+        return json.loads(text)
+
+    def dumps(self, value, indent=None):
+        """indent=None means compact: no whitespace at all"""
+        if indent is None:
+            return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+        return json.dumps(value, indent=indent, ensure_ascii=False)
+
+
+class OrjsonBackend(StdlibBackend):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, text):
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return self.orjson.loads(text)
+
+    def dumps(self, value, indent=None):
+        if indent is None:
+            return self.orjson.dumps(value).decode('utf-8')
+        if indent == 2:
+            return self.orjson.dumps(value, option=self.orjson.OPT_INDENT_2).decode('utf-8')
+        # orjson only knows two-space indentation
+        return super().dumps(value, indent)
+
+
+class UjsonBackend(StdlibBackend):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def loads(self, text):
+        try:
+            return self.ujson.loads(text)
+        except ValueError as e:
+            # Callers handle the stdlib error type
+            raise json.JSONDecodeError(str(e), text, 0) from e
+
+    def dumps(self, value, indent=None):
+        return self.ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False,
+                                indent=indent or 0)
+
+
+_FACTORIES = {'orjson': OrjsonBackend, 'ujson': UjsonBackend, 'stdlib': StdlibBackend}
+
+_active = None
+
+
+def get_backend(name='auto'):
+    """Create a backend by name; 'auto' picks the fastest one installed"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend '{name}' (choose from {', '.join(BACKENDS)})")
+    if name != 'auto':
+        try:
+            return _FACTORIES[name]()
+        except ImportError:
+            raise ValueError(f"JSON backend '{name}' is not installed")
+    for candidate in ('orjson', 'ujson'):
+        try:
+            return _FACTORIES[candidate]()
+        except ImportError:
+            continue
+    return StdlibBackend()
+
+
+def set_backend(name):
+    """Switch the backend used by loads/dumps, here and in child processes"""
+    global _active
+    _active = get_backend(name)
+    os.environ[ENV_VAR] = name
+    return _active
+
+
+def active_backend():
+    global _active
+    if _active is None:
+        _active = get_backend(os.environ.get(ENV_VAR, 'auto'))
+    return _active
+
+
+def loads(text):
+    return active_backend().loads(text)
+
+
+def dumps(value, indent=None):
+    return active_backend().dumps(value, indent)
@@ -4,181 +4,218 @@ Convert Markdown file back to Jupyter notebook format AND Python script
 Parses markdown and recreates notebook structure with code and markdown cells
 Also generates a clean Python script for local execution
 """
+import contextlib
 import json
+import os
 import sys
 import re
+from collections import Counter
 from pathlib import Path
-
-
-def extract_python_code(markdown_content):
-    """Extract only Python code from markdown, filtering out Colab-specific commands"""
-    python_lines = []
-    lines = markdown_content.split('\n')
-    i = 0
-    in_code_block = False
-
-    while i < len(lines):
-        line = lines[i]
-
-        # Check for code block start
-        if line.startswith('```python'):
-            in_code_block = True
-            i += 1
-            continue
-        elif line.startswith('```') and in_code_block:
-            in_code_block = False
-            python_lines.append('\n')  # Add blank line between code blocks
-            i += 1
+import json_backend
+from assets import inline_markdown_images, output_image_ref, read_asset, resolve_asset
+from conversion_cache import file_sha256
+from notebook_merge import merge_cells
+from output_store import OutputStore, source_key, store_path_for
+
+
+def iter_markdown_lines(handle):
+    """Yield lines from a text handle without their newline, like str.split('\\n')"""
+    line = ''
+    for line in handle:
+        yield line[:-1] if line.endswith('\n') else line
+    # split('\n') yields a trailing empty string when the text ends with a newline
+    if not line or line.endswith('\n'):
+        yield ''
+
+
+def iter_cell_events(lines):
+    """Tokenize markdown lines into cell events in a single pass
+
+    Yields one dict per cell as soon as the cell is complete:
+    - {'type': 'markdown', 'lines': [...]} for text between code blocks
+    - {'type': 'code', 'fence': '```python', 'lines': [...], 'closed': True}
+      for fenced code blocks, where 'fence' is the opening line; extracted
+      '![Output image](...)' lines right after the block are collected in
+      an extra 'outputs' list of asset paths
+
+    Only the current cell is buffered, so memory is bounded by the largest cell.
+    """
+    markdown_lines = None
+    code_event = None
+    # Closed code block that may still collect output images
+    pending_code = None
+    skipping_output = False
+
+    for index, line in enumerate(lines):
+        # Skip output sections: the bare ``` block notebook_to_md writes after
+        # **Output:**, or anything up to the next code block or heading
+        if skipping_output == 'block':
+            if line.startswith('```'):
+                skipping_output = False
             continue
+        if skipping_output:
+            if line == '```':
+                skipping_output = 'block'
+                continue
+            if not (line.startswith('```') or line.startswith('#')):
+                continue
+            skipping_output = False
 
-        # Process code content
-        if in_code_block:
-            # Skip Colab-specific commands
-            if line.strip().startswith('!'):  # Skip shell commands like !pip install
-                python_lines.append(f"# COLAB ONLY: {line}\n")
-            elif line.strip().startswith('%'):  # Skip magic commands like %matplotlib
-                python_lines.append(f"# JUPYTER MAGIC: {line}\n")
-            else:
-                python_lines.append(line + '\n')
-
-        i += 1
-
-    return ''.join(python_lines)
-
-
-def parse_markdown_to_cells(markdown_content):
-    """Parse markdown content and convert to notebook cells"""
-    cells = []
-    lines = markdown_content.split('\n')
-    i = 0
-
-    current_cell = None
-    in_code_block = False
-    code_language = None
-
-    while i < len(lines):
-        line = lines[i]
-
-        # Check for code block start
+        # Check for code block start/end
         if line.startswith('```'):
-            if not in_code_block:
-                # Starting a code block
-                # Save previous cell if exists
-                if current_cell and current_cell['source']:
-                    cells.append(current_cell)
-
-                # Extract language if specified
-                code_language = line[3:].strip() or 'python'
-                in_code_block = True
-                current_cell = {
-                    'cell_type': 'code',
-                    'metadata': {},
-                    'source': [],
-                    'outputs': [],
-                    'execution_count': None
-                }
+            if code_event is None:
+                # Starting a code block, flush the pending cells
+                if pending_code is not None:
+                    yield pending_code
+                    pending_code = None
+                if markdown_lines is not None:
+                    yield {'type': 'markdown', 'lines': markdown_lines}
+                    markdown_lines = None
+                code_event = {'type': 'code', 'fence': line, 'lines': [], 'closed': False}
             else:
                 # Ending a code block
-                in_code_block = False
-                if current_cell:
-                    # Join source lines
-                    current_cell['source'] = ''.join(current_cell['source'])
-                    cells.append(current_cell)
-                    current_cell = None
-                code_language = None
-
-            i += 1
+                code_event['closed'] = True
+                pending_code = code_event
+                code_event = None
             continue
 
-        # Process content based on context
-        if in_code_block:
-            # Add to code cell
-            if current_cell:
-                current_cell['source'].append(line + '\n')
-        else:
-            # Check if this is a "Code Cell" header (from our converter)
-            if line.startswith('## Code Cell'):
-                # Skip this line as it's just metadata from conversion
-                i += 1
-                continue
+        if code_event is not None:
+            code_event['lines'].append(line)
+            continue
 
-            # Check if this line starts output section
-            if line == '**Output:**':
-                # Skip output sections (we don't restore outputs)
-                i += 1
-                # Skip until we find the end of output block
-                while i < len(lines) and not (lines[i].startswith('```') or lines[i].startswith('#')):
-                    i += 1
-                continue
+        # Skip "Code Cell" headers, they are just metadata from conversion
+        if line.startswith('## Code Cell'):
+            continue
 
-            # Regular markdown content
-            if current_cell is None or current_cell['cell_type'] != 'markdown':
-                # Save previous cell if exists
-                if current_cell and current_cell['source']:
-                    cells.append(current_cell)
+        # Skip the text of **Output:** sections (written with keep_outputs);
+        # real outputs come back from the sidecar OutputStore for code cells
+        # whose source is unchanged, and '![Output image]' links below are
+        # turned back into image outputs
+        if line == '**Output:**':
+            skipping_output = True
+            continue
 
-                current_cell = {
-                    'cell_type': 'markdown',
-                    'metadata': {},
-                    'source': []
-                }
+        if pending_code is not None:
+            ref = output_image_ref(line)
+            if ref is not None:
+                pending_code.setdefault('outputs', []).append(ref)
+                continue
+            # Blank lines may separate the images from the code
+            if line.strip():
+                yield pending_code
+                pending_code = None
 
-            # Add line to markdown cell
-            if current_cell:
-                # Skip metadata lines from our converter
-                if not (line.startswith('*This notebook was created') or
-                       line.startswith('*Language:') or
-                       (line == '---' and i < 10)):  # Skip early separator
-                    current_cell['source'].append(line + '\n')
+        if markdown_lines is None:
+            markdown_lines = []
 
-        i += 1
+        # Skip metadata lines from our converter
+        if not (line.startswith('*This notebook was created') or
+                line.startswith('*Language:') or
+                (line == '---' and index < 10)):  # Skip early separator
+            markdown_lines.append(line)
 
     # Don't forget the last cell
-    if current_cell and current_cell['source']:
-        cells.append(current_cell)
-
-    # Clean up cells
-    cleaned_cells = []
-    for cell in cells:
-        # Join source lines and strip extra whitespace
-        if isinstance(cell['source'], list):
-            cell['source'] = ''.join(cell['source']).strip()
-
-        # Only keep non-empty cells
-        if cell['source']:
-            # Split source back into lines for notebook format
-            cell['source'] = cell['source'].split('\n')
-            # Add newline to all lines except the last
-            for j in range(len(cell['source']) - 1):
-                cell['source'][j] += '\n'
-
-            cleaned_cells.append(cell)
+    if pending_code is not None:
+        yield pending_code
+    if code_event is not None:
+        yield code_event
+    elif markdown_lines is not None:
+        yield {'type': 'markdown', 'lines': markdown_lines}
+
+
+def python_lines_from_event(event):
+    """Yield .py lines for a cell event, filtering out Colab-specific commands"""
+    if event['type'] != 'code' or not event['fence'].startswith('```python'):
+        return
+
+    for line in event['lines']:
+        # Skip Colab-specific commands
+        if line.strip().startswith('!'):  # Skip shell commands like !pip install
+            yield f"# COLAB ONLY: {line}\n"
+        elif line.strip().startswith('%'):  # Skip magic commands like %matplotlib
+            yield f"# JUPYTER MAGIC: {line}\n"
+        else:
+            yield line + '\n'
 
-    return cleaned_cells
+    if event['closed']:
+        yield '\n'  # Add blank line between code blocks
 
 
-def markdown_to_notebook(input_file, output_file=None):
-    """Convert Markdown file to Jupyter notebook format AND Python script"""
+def image_outputs(refs, base_dir):
+    """Rebuild display_data outputs from extracted image assets"""
+    outputs = []
+    for ref in refs:
+        path = resolve_asset(ref, base_dir)
+        if path is None:
+            continue
+        mime, payload = read_asset(path)
+        outputs.append({
+            'output_type': 'display_data',
+            'data': {mime: payload},
+            'metadata': {}
+        })
+    return outputs
+
+
+def cell_from_event(event, base_dir=None):
+    """Build a notebook cell from a cell event, or None if the cell is empty
+
+    Given the markdown file's directory, images extracted to <notebook>_assets/
+    are inlined again.
+    """
+    # Join source lines; closed code blocks keep their whitespace verbatim,
+    # everything else is stripped
+    source = ''.join(line + '\n' for line in event['lines'])
+    if event['type'] != 'code' or not event['closed']:
+        source = source.strip()
+    if not source:
+        return None
+
+    if base_dir is not None and event['type'] == 'markdown':
+        source = inline_markdown_images(source, base_dir)
+
+    # Split source back into lines for notebook format,
+    # adding a newline to all lines except the last
+    source_lines = source.split('\n')
+    for j in range(len(source_lines) - 1):
+        source_lines[j] += '\n'
+
+    if event['type'] == 'code':
+        return {
+            'cell_type': 'code',
+            'metadata': {},
+            'source': source_lines,
+            'outputs': image_outputs(event.get('outputs', []), base_dir) if base_dir is not None else [],
+            'execution_count': None
+        }
+    return {
+        'cell_type': 'markdown',
+        'metadata': {},
+        'source': source_lines
+    }
 
-    input_path = Path(input_file)
-    if output_file is None:
-        output_file = str(input_path.parent / (input_path.stem + '_from_md.ipynb'))
 
-    # Also determine Python output file name
-    python_output_file = input_path.with_suffix('.py')
+def extract_python_code(markdown_content):
+    """Extract only Python code from markdown, filtering out Colab-specific commands"""
+    python_lines = []
+    for event in iter_cell_events(markdown_content.split('\n')):
+        python_lines.extend(python_lines_from_event(event))
+    return ''.join(python_lines)
 
-    # Read markdown file
-    with open(input_file, 'r', encoding='utf-8') as f:
-        markdown_content = f.read()
 
-    # Parse markdown to cells for notebook
-    cells = parse_markdown_to_cells(markdown_content)
+def parse_markdown_to_cells(markdown_content):
+    """Parse markdown content and convert to notebook cells"""
+    cells = []
+    for event in iter_cell_events(markdown_content.split('\n')):
+        cell = cell_from_event(event)
+        if cell:
+            cells.append(cell)
+    return cells
 
-    # Extract Python code for .py file
-    python_code = extract_python_code(markdown_content)
 
-    # Create notebook structure
-    notebook = {
+def new_notebook(cells):
+    """Wrap cells in the notebook structure we generate for Colab"""
+    return {
         'cells': cells,
         'metadata': {
             'kernelspec': {
@@ -207,19 +244,127 @@ def markdown_to_notebook(input_file, output_file=None):
         'nbformat_minor': 4
     }
 
-    # Write notebook
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(notebook, f, indent=2, ensure_ascii=False)
 
-    # Write Python script
-    with open(python_output_file, 'w', encoding='utf-8') as f:
-        f.write(f"#!/usr/bin/env python3\n")
-        f.write(f'"""\n')
-        f.write(f'Python script generated from: {input_file}\n')
-        f.write(f'Generated on: {Path(input_file).stat().st_mtime}\n')
-        f.write(f'Note: Colab-specific commands (!pip, %magic) have been commented out\n')
-        f.write(f'"""\n\n')
-        f.write(python_code)
+def notebook_json(notebook, indent=2):
+    """Serialize a whole notebook; indent=None writes compact JSON"""
+    if indent is None:
+        return json.dumps(notebook, ensure_ascii=False, separators=(',', ':'))
+    return json.dumps(notebook, indent=indent, ensure_ascii=False)
+
+
+def notebook_frame(indent=2):
+    """Return the (head, separator, tail) text around the cells of a non-empty notebook
+
+    Together with serialize_cell this reproduces notebook_json output one
+    cell at a time: head, the cells joined by separator, then tail.
+    """
+    placeholder = '"\\u0000"'
+    head, tail = notebook_json(new_notebook(['\x00']), indent).split(placeholder)
+    if indent is None:
+        return head, ',', tail
+    # serialize_cell adds the indentation itself
+    return head[:-2 * indent], ',\n', tail
+
+
+def serialize_cell(cell, indent=2):
+    """Serialize one cell exactly as notebook_json lays it out inside 'cells'"""
+    if indent is None:
+        return json_backend.dumps(cell)
+    # JSON strings never contain raw newlines, so re-indenting by line is safe
+    pad = ' ' * (2 * indent)
+    return pad + json_backend.dumps(cell, indent).replace('\n', '\n' + pad)
+
+
+def python_header(input_file, source_hash):
+    """Header written at the top of the generated Python script"""
+    return (f"#!/usr/bin/env python3\n"
+            f'"""\n'
+            f'Python script generated from: {input_file}\n'
+            f'Source SHA-256: {source_hash}\n'
+            f'Note: Colab-specific commands (!pip, %magic) have been commented out\n'
+            f'"""\n\n')
+
+
+def markdown_to_notebook(input_file, output_file=None, quiet=False, source_hash=None, compact=False,
+                         merge=False):
+    """Convert Markdown file to Jupyter notebook format AND Python script
+
+    Pass quiet=True to suppress the per-file report (used by batch mode).
+    compact=True writes the notebook without indentation.
+    merge=True updates an existing output notebook in place, keeping the
+    ids, metadata and outputs of cells that didn't change.
+    source_hash is the SHA-256 of the input if the caller already computed it;
+    it goes into the .py header instead of a timestamp so reruns don't churn.
+    If notebook_to_md saved a <name>.outputs.json, outputs are restored on
+    every code cell whose source is unchanged.
+    """
+
+    input_path = Path(input_file)
+    if output_file is None:
+        output_file = str(input_path.parent / (input_path.stem + '_from_md.ipynb'))
+
+    # Also determine Python output file name
+    python_output_file = input_path.with_suffix('.py')
+
+    if source_hash is None:
+        source_hash = file_sha256(input_file)
+
+    store = OutputStore.load(store_path_for(input_file))
+    occurrences = Counter()
+    restored = 0
+
+    indent = None if compact else 2
+    head, separator, tail = notebook_frame(indent)
+    cell_counts = {'code': 0, 'markdown': 0}
+
+    # Merging needs every cell up front to align them with the target's
+    merging = merge and Path(output_file).exists()
+    merge_stats = None
+    new_cells = []
+
+    # Single pass over the markdown: every cell event feeds both the
+    # notebook and the Python script, and each cell is written as soon as
+    # it is built, so only one cell is held in memory. The notebook goes
+    # to a temporary file so a failure doesn't leave a truncated one
+    tmp_file = str(output_file) + '.tmp'
+    try:
+        with contextlib.ExitStack() as files:
+            md_file = files.enter_context(open(input_file, 'r', encoding='utf-8'))
+            py_file = files.enter_context(open(python_output_file, 'w', encoding='utf-8'))
+            nb_file = None if merging else files.enter_context(open(tmp_file, 'w', encoding='utf-8'))
+            py_file.write(python_header(input_file, source_hash))
+
+            for event in iter_cell_events(iter_markdown_lines(md_file)):
+                cell = cell_from_event(event, input_path.parent)
+                if cell and store is not None and cell['cell_type'] == 'code':
+                    key = source_key(cell['source'])
+                    restored += store.restore(cell, occurrences[key], input_path.parent)
+                    occurrences[key] += 1
+                if cell and merging:
+                    new_cells.append(cell)
+                elif cell:
+                    nb_file.write(separator if any(cell_counts.values()) else head)
+                    nb_file.write(serialize_cell(cell, indent))
+                if cell:
+                    cell_counts[cell['cell_type']] += 1
+                py_file.writelines(python_lines_from_event(event))
+
+            if merging:
+                merge_stats = merge_cells(output_file, new_cells, title=f"# {input_path.stem}")
+            elif any(cell_counts.values()):
+                nb_file.write(tail)
+            else:
+                # An empty notebook has no frame to fill
+                nb_file.write(notebook_json(new_notebook([]), indent))
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    if not merging:
+        os.replace(tmp_file, output_file)
+
+    if quiet:
+        return str(output_file)
 
     # Print statistics
     input_size = input_path.stat().st_size / 1024  # KB
@@ -232,28 +377,37 @@ def markdown_to_notebook(input_file, output_file=None):
     print(f"🐍 Python: {python_output_file} ({python_size:.1f} KB)")
 
     # Count cells
-    code_cells = sum(1 for c in cells if c['cell_type'] == 'code')
-    md_cells = sum(1 for c in cells if c['cell_type'] == 'markdown')
-    print(f"📊 Created {code_cells} code cells and {md_cells} markdown cells")
+    print(f"📊 Created {cell_counts['code']} code cells and {cell_counts['markdown']} markdown cells")
+    if store is not None:
+        print(f"♻️  Restored outputs of {restored}/{cell_counts['code']} code cells from {store.path}")
+    if merge_stats is not None:
+        print(f"🔀 Merged into existing notebook: {merge_stats['kept']} kept, {merge_stats['updated']} updated, "
+              f"{merge_stats['inserted']} inserted, {merge_stats['deleted']} deleted "
+              f"({merge_stats['written'] / 1024:.1f} KB written)")
     print(f"🚀 Notebook ready for Colab, Python script ready for local execution!")
 
     return str(output_file)
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python md_to_notebook.py <markdown.md> [output.ipynb]")
+    compact = '--compact' in sys.argv[1:]
+    merge = '--merge' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg not in ('--compact', '--merge')]
+    if not args:
+        print("Usage: python md_to_notebook.py <markdown.md> [output.ipynb] [--compact] [--merge]")
         print("\nThis script converts a Markdown file back to Jupyter notebook format.")
         print("- Recreates code and markdown cells")
         print("- Preserves cell structure")
         print("- Creates notebook ready for Colab")
+        print("- With --compact, writes the notebook without indentation")
+        print("- With --merge, updates an existing notebook, keeping unchanged cells' ids and outputs")
         sys.exit(1)
 
-    input_file = sys.argv[1]
-    output_file = sys.argv[2] if len(sys.argv) > 2 else None
+    input_file = args[0]
+    output_file = args[1] if len(args) > 1 else None
 
     try:
-        markdown_to_notebook(input_file, output_file)
+        markdown_to_notebook(input_file, output_file, compact=compact, merge=merge)
     except FileNotFoundError:
         print(f"❌ Error: File '{input_file}' not found")
         sys.exit(1)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Merge rebuilt cells into an existing notebook instead of overwriting it
+Cells are aligned with a sequence diff; unchanged cells keep their exact
+JSON (ids, metadata, outputs) and only edited, inserted or deleted cells
+are rewritten, in the target notebook's own formatting
+"""
+import difflib
+import os
+import uuid
+from pathlib import Path
+import json_backend
+from notebook_reader import read_notebook_layout
+from output_store import source_key
+
+
+def patch_file(path, old_chunks, new_chunks, must_match=False):
+    """Replace a file's content with new_chunks through a temporary file
+
+    old_chunks is what path held when we last wrote or read it. If the file
+    still holds exactly that and the content didn't change, nothing is
+    written. Otherwise the whole file is written to a temporary file and
+    moved over path with os.replace, so a crash never leaves a torn file
+    and an external edit is replaced, never spliced into. With must_match,
+    a file that no longer matches old_chunks raises RuntimeError instead
+    of being overwritten.
+    Returns the number of bytes written.
+    """
+    path = Path(path)
+    data = b''.join(new_chunks)
+    current = path.read_bytes() if path.exists() else None
+    matches = old_chunks is not None and current == b''.join(old_chunks)
+    if must_match and not matches:
+        raise RuntimeError(f"{path} changed on disk since it was read; run again")
+    if current == data:
+        return 0
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    return len(data)
+
+
+def _cell_key(cell):
+    return cell['cell_type'], source_key(cell.get('source', ''))
+
+
+def _sort_keys(value):
+    """Recursively sort dict keys, the way nbformat writes notebooks"""
+    if isinstance(value, dict):
+        return {key: _sort_keys(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [_sort_keys(item) for item in value]
+    return value
+
+
+class _CellStyle:
+    """How the target notebook lays out its cells, learned from the first one"""
+
+    def __init__(self, text, start, end, cells):
+        # Whitespace between '[' and the first cell, e.g. '\n    ' or '\n  '
+        self.lead = text[text.rindex('[', 0, start) + 1:start]
+        self.separator = ',' + self.lead
+        raw = text[start:end]
+        if raw.startswith('{\n'):
+            prefix = len(self.lead) - self.lead.rfind('\n') - 1
+            inner = len(raw) - 2 - len(raw[2:].lstrip(' '))
+            self.indent = max(inner - prefix, 1)
+            self.pad = '\n' + ' ' * prefix
+        else:
+            self.indent = None
+            self.pad = None
+        # nbformat sorts keys; md_to_notebook doesn't
+        self.sort_keys = all(list(cell) == sorted(cell) for cell in cells)
+
+    def serialize(self, cell, is_new=False):
+        """Lay out a cell like its neighbours; edited cells keep their key order"""
+        if is_new and self.sort_keys:
+            cell = _sort_keys(cell)
+        text = json_backend.dumps(cell, self.indent)
+        return text if self.pad is None else text.replace('\n', self.pad)
+
+
+def strip_generated_title(cell, title):
+    """Drop the '# <name>' heading notebook_to_md adds above the first cell
+
+    Returns the cell without it, or None if nothing else was in the cell.
+    """
+    text = ''.join(cell['source'])
+    if text != title and not text.startswith(title + '\n'):
+        return cell
+    text = text[len(title):].strip()
+    if not text:
+        return None
+    source_lines = text.split('\n')
+    for j in range(len(source_lines) - 1):
+        source_lines[j] += '\n'
+    return dict(cell, source=source_lines)
+
+
+def merge_cells(target_file, new_cells, title=None):
+    """Update target_file so its cells match new_cells, touching only what changed
+
+    Cells are matched on (cell_type, stripped source). Matching cells keep
+    their JSON byte for byte. An edited cell keeps its metadata and id but
+    takes the new source; code cells also lose their now stale outputs.
+    title is the heading notebook_to_md put above the first cell. A plain
+    conversion keeps it, a notebook from Colab never had it, so new_cells
+    follow whichever the target does and an unchanged first cell is kept.
+    Returns counts of kept, updated, inserted and deleted cells and the
+    number of bytes written.
+    """
+    target_path = Path(target_file)
+    # Bytes, not read_text: the text must match the file exactly for patch_file
+    text = target_path.read_bytes().decode('utf-8')
+    layout = read_notebook_layout(text)
+    old = layout['cells']
+    stats = {'kept': 0, 'updated': 0, 'inserted': 0, 'deleted': 0, 'written': 0}
+
+    if title and old and new_cells and new_cells[0]['cell_type'] == 'markdown':
+        first = old[0][2]
+        if first['cell_type'] != 'markdown' or strip_generated_title(first, title) is first:
+            stripped = strip_generated_title(new_cells[0], title)
+            new_cells = ([stripped] if stripped else []) + list(new_cells[1:])
+
+    if not old:
+        # No cell to learn the layout from: rewrite, keeping the top-level
+        # metadata and guessing the indentation from the first key
+        notebook = json_backend.loads(text)
+        notebook['cells'] = new_cells
+        indent = len(text) - 2 - len(text[2:].lstrip(' ')) if text.startswith('{\n') else None
+        data = json_backend.dumps(notebook, indent).encode('utf-8')
+        written = patch_file(target_path, [text.encode('utf-8')], [data], must_match=True)
+        stats.update(inserted=len(new_cells), written=written)
+        return stats
+
+    style = _CellStyle(text, old[0][0], old[0][1], [cell for _, _, cell in old])
+    needs_ids = (layout['nbformat_minor'] or 0) >= 5
+    used_ids = {cell.get('id') for _, _, cell in old}
+
+    def new_cell(cell):
+        cell = dict(cell)
+        if needs_ids:
+            cell_id = uuid.uuid4().hex[:8]
+            while cell_id in used_ids:
+                cell_id = uuid.uuid4().hex[:8]
+            used_ids.add(cell_id)
+            cell['id'] = cell_id
+        stats['inserted'] += 1
+        return style.serialize(cell, is_new=True)
+
+    def updated_cell(index, cell):
+        start, end, _ = old[index]
+        merged = json_backend.loads(text[start:end])
+        merged['source'] = cell['source']
+        if merged['cell_type'] == 'code':
+            merged['outputs'] = cell.get('outputs', [])
+            merged['execution_count'] = cell.get('execution_count')
+        stats['updated'] += 1
+        return style.serialize(merged)
+
+    matcher = difflib.SequenceMatcher(None, [_cell_key(cell) for _, _, cell in old],
+                                      [_cell_key(cell) for cell in new_cells], autojunk=False)
+    merged_cells = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            merged_cells.extend(text[start:end] for start, end, _ in old[i1:i2])
+            stats['kept'] += i2 - i1
+            continue
+        # Pair up replaced cells of the same type as edits, the rest are
+        # deletions and insertions
+        pairs = min(i2 - i1, j2 - j1) if tag == 'replace' else 0
+        for offset in range(pairs):
+            if old[i1 + offset][2]['cell_type'] == new_cells[j1 + offset]['cell_type']:
+                merged_cells.append(updated_cell(i1 + offset, new_cells[j1 + offset]))
+            else:
+                merged_cells.append(new_cell(new_cells[j1 + offset]))
+                stats['deleted'] += 1
+        merged_cells.extend(new_cell(cell) for cell in new_cells[j1 + pairs:j2])
+        stats['deleted'] += (i2 - i1) - pairs
+
+    # Chunks line up with the file: head, cell, separator, cell, ..., tail
+    old_chunks = [text[:old[0][0]]]
+    for index, (start, end, _) in enumerate(old):
+        if index:
+            old_chunks.append(text[old[index - 1][1]:start])
+        old_chunks.append(text[start:end])
+    old_chunks.append(text[old[-1][1]:])
+
+    if merged_cells:
+        new_chunks = [old_chunks[0]]
+        for index, cell_text in enumerate(merged_cells):
+            if index:
+                new_chunks.append(style.separator)
+            new_chunks.append(cell_text)
+        new_chunks.append(old_chunks[-1])
+    else:
+        # Every cell was deleted: close the empty array right after '['
+        new_chunks = [old_chunks[0][:len(old_chunks[0]) - len(style.lead)], old_chunks[-1].lstrip()]
+
+    # Someone may have saved the notebook (e.g. from Jupyter) while we merged
+    stats['written'] = patch_file(target_path, [chunk.encode('utf-8') for chunk in old_chunks],
+                                  [chunk.encode('utf-8') for chunk in new_chunks], must_match=True)
+    return stats
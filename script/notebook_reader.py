@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Streaming Jupyter notebook reader
+Walks cells one at a time with a small incremental JSON parser, skipping
+embedded image payloads without ever holding them in memory
+"""
+import binascii
+import io
+import json
+import re
+import json_backend
+from assets import MIME_EXTENSIONS
+
+
+_STRUCTURAL = re.compile(r'["{}\[\]]')
+_SCALAR = re.compile(r'[^,\]}\s]*')
+_NON_WHITESPACE = re.compile(r'[^ \t\n\r]')
+
+
+class JSONStream:
+    """Pull parser over a text handle, read in fixed-size chunks
+
+    Values can be parsed (decoded with json_backend) or skipped.
+    Skipped values are scanned chunk by chunk and never accumulated, so a
+    multi-megabyte base64 string costs a scan, not a copy.
+    """
+
+    def __init__(self, handle, chunk_size=64 * 1024):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        # Start of the value being captured by parse_value, kept across refills
+        self.mark = None
+        # Characters discarded from the front of buf, so offset + pos is absolute
+        self.offset = 0
+
+    def _fill(self):
+        """Read the next chunk, discarding consumed text. Returns False at EOF"""
+        if self.eof:
+            return False
+        keep_from = self.pos if self.mark is None else self.mark
+        if keep_from:
+            self.buf = self.buf[keep_from:]
+            self.pos -= keep_from
+            self.offset += keep_from
+            if self.mark is not None:
+                self.mark = 0
+        chunk = self.handle.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self.buf, self.pos)
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it"""
+        while True:
+            match = _NON_WHITESPACE.search(self.buf, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self._fill():
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self._error(f"Expecting '{char}'")
+        self.pos += 1
+
+    def _skip_string_body(self):
+        """Advance past a string whose opening quote was already consumed"""
+        # Position of the next '"' in the buffer: -1 if there is none,
+        # None if unknown. Cached so strings with many escapes stay linear.
+        quote = None
+        while True:
+            # str.find is much faster than a regex over long base64 runs
+            if quote is None or 0 <= quote < self.pos:
+                quote = self.buf.find('"', self.pos)
+            end = quote if quote >= 0 else len(self.buf)
+            backslash = self.buf.find('\\', self.pos, end)
+
+            if backslash >= 0:
+                # Skip the backslash and the escaped character, which may be
+                # in the next chunk
+                if backslash + 1 == len(self.buf):
+                    self.pos = backslash
+                    quote = None
+                    if not self._fill():
+                        raise self._error("Unterminated string")
+                    continue
+                self.pos = backslash + 2
+            elif quote >= 0:
+                self.pos = quote + 1
+                return
+            else:
+                self.pos = len(self.buf)
+                quote = None
+                if not self._fill():
+                    raise self._error("Unterminated string")
+
+    def skip_value(self):
+        """Consume the next value without materializing it"""
+        char = self.peek()
+        if char is None:
+            raise self._error("Expecting value")
+
+        if char == '"':
+            self.pos += 1
+            self._skip_string_body()
+            return
+
+        if char not in '{[':
+            # Number, true, false or null; make sure it isn't cut by the chunk end
+            while True:
+                match = _SCALAR.match(self.buf, self.pos)
+                if match.end() < len(self.buf) or not self._fill():
+                    break
+            if match.end() == self.pos:
+                raise self._error("Expecting value")
+            self.pos = match.end()
+            return
+
+        depth = 0
+        while True:
+            match = _STRUCTURAL.search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+                if not self._fill():
+                    raise self._error("Unterminated container")
+                continue
+            self.pos = match.end()
+            char = match.group()
+            if char == '"':
+                self._skip_string_body()
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def iter_string_chunks(self):
+        """Consume a string value, yielding its decoded text piece by piece
+
+        Pieces are slices of the read buffer, so a long string is never
+        held in memory as a whole.
+        """
+        self.expect('"')
+        # Cached like in _skip_string_body
+        quote = None
+        while True:
+            if quote is None or 0 <= quote < self.pos:
+                quote = self.buf.find('"', self.pos)
+            end = quote if quote >= 0 else len(self.buf)
+            backslash = self.buf.find('\\', self.pos, end)
+            stop = backslash if backslash >= 0 else end
+            if stop > self.pos:
+                yield self.buf[self.pos:stop]
+                self.pos = stop
+
+            if backslash >= 0:
+                # Longest escape is a \uXXXX\uXXXX surrogate pair
+                if len(self.buf) - self.pos < 12:
+                    quote = None
+                    while len(self.buf) - self.pos < 12 and self._fill():
+                        pass
+                length = 2
+                if self.buf.startswith('u', self.pos + 1):
+                    length = 6
+                    # High surrogate (\uD800-\uDBFF) followed by its low half
+                    high = self.buf[self.pos + 2:self.pos + 4].lower()
+                    if high[:1] == 'd' and high[1:] in '89ab' and self.buf.startswith('\\u', self.pos + 6):
+                        length = 12
+                escape = self.buf[self.pos:self.pos + length]
+                if len(escape) < length:
+                    raise self._error("Unterminated string")
+                yield json.loads(f'"{escape}"')
+                self.pos += length
+            elif quote >= 0:
+                self.pos = quote + 1
+                return
+            else:
+                quote = None
+                if not self._fill():
+                    raise self._error("Unterminated string")
+
+    def parse_value(self):
+        """Consume the next value and decode it with the active JSON backend"""
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            raw = self.buf[self.mark:self.pos]
+        finally:
+            self.mark = None
+        return json_backend.loads(raw)
+
+    def _close(self, closing):
+        """Consume ',' or the closing bracket; return True when closed"""
+        char = self.peek()
+        self.pos += 1
+        if char == closing:
+            return True
+        if char != ',':
+            raise self._error(f"Expecting ',' or '{closing}'")
+        return False
+
+    def iter_object(self):
+        """Yield the keys of an object; the caller must consume each value"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise self._error("Expecting property name enclosed in double quotes")
+            key = self.parse_value()
+            self.expect(':')
+            yield key
+            if self._close('}'):
+                return
+
+    def iter_array(self):
+        """Yield once per element of an array; the caller must consume it"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self._close(']'):
+                return
+
+
+def _iter_text_chunks(stream):
+    """Text of a notebook string field, which may also be a list of strings"""
+    if stream.peek() == '[':
+        for _ in stream.iter_array():
+            yield from stream.iter_string_chunks()
+    else:
+        yield from stream.iter_string_chunks()
+
+
+def _save_image(stream, assets, mime):
+    """Decode an image payload into the asset store; None if it is corrupt"""
+    chunks = _iter_text_chunks(stream)
+    try:
+        return assets.save_chunks(mime, chunks)
+    except binascii.Error:
+        # Finish consuming the value so parsing can carry on
+        for _ in chunks:
+            pass
+        return None
+
+
+def _read_image_bundle(stream, assets):
+    """Consume a {mime: payload} bundle, returning the asset refs of its images"""
+    refs = []
+    for mime in stream.iter_object():
+        if assets is not None and mime in MIME_EXTENSIONS and not refs:
+            ref = _save_image(stream, assets, mime)
+            if ref is not None:
+                refs.append(ref)
+        else:
+            stream.skip_value()
+    return refs
+
+
+def _read_output(stream, skip_images, assets=None):
+    output = {}
+    for key in stream.iter_object():
+        if key == 'data' and skip_images:
+            data = {}
+            for mime in stream.iter_object():
+                if not mime.startswith('image/'):
+                    data[mime] = stream.parse_value()
+                elif assets is not None and mime in MIME_EXTENSIONS:
+                    ref = _save_image(stream, assets, mime)
+                    if ref is not None:
+                        output.setdefault('image_refs', {})[mime] = ref
+                else:
+                    stream.skip_value()
+            output['data'] = data
+        else:
+            output[key] = stream.parse_value()
+    return output
+
+
+def _read_cell(stream, skip_images, assets=None):
+    cell = {}
+    for key in stream.iter_object():
+        if key == 'outputs' and skip_images:
+            cell['outputs'] = [_read_output(stream, skip_images, assets) for _ in stream.iter_array()]
+        elif key == 'attachments' and skip_images:
+            # Pasted images in markdown cells are base64 payloads too
+            attachments = {}
+            for name in stream.iter_object():
+                refs = _read_image_bundle(stream, assets)
+                if refs:
+                    attachments[name] = refs[0]
+            if attachments:
+                cell['attachment_assets'] = attachments
+        else:
+            cell[key] = stream.parse_value()
+    return cell
+
+
+def read_notebook_metadata(input_file):
+    """Read the top-level notebook metadata, skipping over the cells
+
+    Jupyter writes 'cells' before 'metadata', so the cells are scanned
+    without being decoded.
+    """
+    with open(input_file, 'r', encoding='utf-8') as f:
+        stream = JSONStream(f)
+        for key in stream.iter_object():
+            if key == 'metadata':
+                return stream.parse_value()
+            stream.skip_value()
+    return {}
+
+
+def iter_notebook_cells(input_file, skip_images=True, assets=None):
+    """Yield notebook cells one at a time
+
+    With skip_images, outputs[*].data['image/*'] and cell attachments are
+    dropped while parsing, so memory scales with the largest cell's text.
+    Given an AssetStore, those images are decoded straight into it instead:
+    their refs go in output['image_refs'] ({mime: ref}) and
+    cell['attachment_assets'] ({name: ref}).
+    """
+    with open(input_file, 'r', encoding='utf-8') as f:
+        stream = JSONStream(f)
+        for key in stream.iter_object():
+            if key != 'cells':
+                stream.skip_value()
+                continue
+            for _ in stream.iter_array():
+                yield _read_cell(stream, skip_images, assets)
+        if stream.peek() is not None:
+            raise stream._error("Extra data")
+
+
+def read_notebook_layout(text):
+    """Locate every cell of a notebook held in memory
+
+    Returns {'cells': [(start, end, cell), ...], 'nbformat_minor': n} where
+    text[start:end] is the cell's exact JSON. Cells are read with images
+    skipped; parse the span when the full cell is needed.
+    """
+    layout = {'cells': [], 'nbformat_minor': None}
+    stream = JSONStream(io.StringIO(text))
+    for key in stream.iter_object():
+        if key == 'cells':
+            for _ in stream.iter_array():
+                stream.peek()
+                start = stream.offset + stream.pos
+                cell = _read_cell(stream, skip_images=True)
+                layout['cells'].append((start, stream.offset + stream.pos, cell))
+        elif key == 'nbformat_minor':
+            layout['nbformat_minor'] = stream.parse_value()
+        else:
+            stream.skip_value()
+    if stream.peek() is not None:
+        raise stream._error("Extra data")
+    return layout
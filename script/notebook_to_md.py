@@ -3,24 +3,125 @@
 Convert Jupyter notebook to clean Markdown format
 Removes outputs, converts cells to proper markdown with code blocks
 """
+import binascii
 import json
+import os
 import sys
-import re
 from pathlib import Path
+from assets import MIME_EXTENSIONS, OUTPUT_IMAGE_ALT, AssetStore, assets_dir_for, format_link_target
+from notebook_reader import iter_notebook_cells, read_notebook_metadata
+from output_store import OutputStore, store_path_for
 
 
-def clean_markdown_source(source):
-    """Convert notebook markdown source to clean markdown text"""
+IMAGE_PLACEHOLDER = '[Image omitted]'
+
+# Markers for ![alt](data:image/...;base64,...) and Colab badge links
+_IMAGE_START = '!['
+_DATA_IMAGE = '](data:image/'
+_BASE64 = ';base64,'
+_COLAB_BADGE = '<a href="https://colab.research.google.com/'
+_ANCHOR_END = '</a>'
+
+
+def _extract_data_image(line, start, uri, payload, end, assets):
+    """Decode one data-URI image into the asset store and link to it instead"""
+    mime = 'image/' + line[uri + len(_DATA_IMAGE):payload]
+    if mime not in MIME_EXTENSIONS:
+        return IMAGE_PLACEHOLDER
+    try:
+        ref = assets.save_slice(mime, line, payload + len(_BASE64), end)
+    except binascii.Error:
+        return IMAGE_PLACEHOLDER
+    alt = line[start + len(_IMAGE_START):uri]
+    return f"![{alt}]({format_link_target(ref)})"
+
+
+def _scrub_data_images(line, assets=None):
+    """Replace inline base64 images on one line, scanning it once
+
+    Each marker is searched from where the previous one ended, so the line
+    is never rescanned. If any marker is missing, no later image on the line
+    can match either and the rest of the line is kept as is.
+    With an AssetStore the images are extracted rather than omitted.
+    """
+    pieces = []
+    pos = 0
+    while True:
+        start = line.find(_IMAGE_START, pos)
+        if start < 0:
+            break
+        uri = line.find(_DATA_IMAGE, start + len(_IMAGE_START))
+        if uri < 0:
+            break
+        payload = line.find(_BASE64, uri + len(_DATA_IMAGE))
+        if payload < 0:
+            break
+        end = line.find(')', payload + len(_BASE64))
+        if end < 0:
+            break
+        pieces.append(line[pos:start])
+        if assets is None:
+            pieces.append(IMAGE_PLACEHOLDER)
+        else:
+            pieces.append(_extract_data_image(line, start, uri, payload, end, assets))
+        pos = end + 1
+
+    if not pieces:
+        return line
+    pieces.append(line[pos:])
+    return ''.join(pieces)
+
+
+def _scrub_colab_badges(line):
+    """Remove Colab badge links on one line, scanning it once"""
+    pieces = []
+    pos = 0
+    while True:
+        start = line.find(_COLAB_BADGE, pos)
+        if start < 0:
+            break
+        end = line.find(_ANCHOR_END, start + len(_COLAB_BADGE))
+        if end < 0:
+            break
+        pieces.append(line[pos:start])
+        pos = end + len(_ANCHOR_END)
+
+    if not pieces:
+        return line
+    pieces.append(line[pos:])
+    return ''.join(pieces)
+
+
+def scrub_markdown(text, assets=None):
+    """Strip inline data-URI images and Colab badges in linear time
+
+    Equivalent to re.sub(r'!\[.*?\]\(data:image/.*?;base64,.*?\)', ...) followed
+    by re.sub(r'<a href="https://colab\.research\.google\.com/.*?</a>', ...),
+    without the quadratic backtracking those patterns hit on long lines.
+    Neither pattern can cross a newline, so lines are scrubbed independently.
+    """
+    if _IMAGE_START not in text and _COLAB_BADGE not in text:
+        return text
+    return '\n'.join(_scrub_colab_badges(_scrub_data_images(line, assets))
+                     for line in text.split('\n'))
+
+
+def clean_markdown_source(source, assets=None, attachments=None):
+    """Convert notebook markdown source to clean markdown text
+
+    With an AssetStore, inline images are extracted to it, and attachments
+    (already extracted, name -> ref) are linked by path.
+    """
     if isinstance(source, list):
         text = ''.join(source)
     else:
         text = source
 
-    # Remove base64 encoded images
-    text = re.sub(r'!\[.*?\]\(data:image/.*?;base64,.*?\)', '[Image omitted]', text)
+    # Remove base64 encoded images and Colab badges
+    text = scrub_markdown(text, assets)
 
-    # Remove Colab badges
-    text = re.sub(r'<a href="https://colab\.research\.google\.com/.*?</a>', '', text)
+    for name, ref in (attachments or {}).items():
+        text = text.replace(f'](attachment:{name})', f']({format_link_target(ref)})')
 
     return text.strip()
 
@@ -32,15 +133,88 @@ def clean_code_source(source):
     return source.strip()
 
 
-def notebook_to_markdown(input_file, output_file=None):
-    """Convert Jupyter notebook to clean Markdown format"""
+def cell_to_markdown_lines(cell, lang='python', assets=None):
+    """Render one notebook cell as a list of markdown lines"""
+    markdown_lines = []
+    cell_type = cell['cell_type']
+
+    if cell_type == 'markdown':
+        content = clean_markdown_source(cell.get('source', ''), assets,
+                                        cell.get('attachment_assets'))
+        if content:
+            markdown_lines.append(f"\n{content}\n")
+
+    elif cell_type == 'code':
+        source = clean_code_source(cell.get('source', ''))
+        if source:
+            # Add blank line before code block for readability
+            markdown_lines.append("\n")
+
+            # Add code block
+            markdown_lines.append(f"```{lang}")
+            markdown_lines.append(source)
+            markdown_lines.append("```\n")
+
+            # Extracted output images go right under the code so
+            # md_to_notebook can attach them back to this cell. Other mimes
+            # of the same output are renderings of the same image
+            image_refs = []
+            if assets is not None:
+                image_refs = [next(iter(output['image_refs'].values()))
+                              for output in cell.get('outputs', []) if output.get('image_refs')]
+            for ref in image_refs:
+                markdown_lines.append(f"![{OUTPUT_IMAGE_ALT}]({format_link_target(ref)})")
+            if image_refs:
+                markdown_lines.append("")
+
+            # Add outputs if they're text (not images or complex objects)
+            if cell.get('outputs'):
+                has_text_output = False
+                for output in cell['outputs']:
+                    if 'text' in output:
+                        if not has_text_output:
+                            markdown_lines.append("**Output:**")
+                            markdown_lines.append("```")
+                            has_text_output = True
+                        markdown_lines.append(''.join(output['text']))
+                    elif 'data' in output and 'text/plain' in output['data']:
+                        if not has_text_output:
+                            markdown_lines.append("**Output:**")
+                            markdown_lines.append("```")
+                            has_text_output = True
+                        markdown_lines.append(''.join(output['data']['text/plain']))
+
+                if has_text_output:
+                    markdown_lines.append("```\n")
+
+    return markdown_lines
+
+
+def notebook_to_markdown(input_file, output_file=None, quiet=False, extract_images=False,
+                         keep_outputs=False):
+    """Convert Jupyter notebook to clean Markdown format
+
+    Pass quiet=True to suppress the per-file report (used by batch mode).
+    With extract_images, images are written to <notebook>_assets/ next to
+    the output and linked, instead of being dropped.
+    With keep_outputs, code cell outputs are saved to <name>.outputs.json
+    so md_to_notebook can restore them on cells that weren't edited.
+    """
 
     input_path = Path(input_file)
     if output_file is None:
         output_file = input_path.with_suffix('.md')
 
-    with open(input_file, 'r', encoding='utf-8') as f:
-        notebook = json.load(f)
+    # Stored outputs keep their images in the assets folder too
+    assets = None
+    if extract_images or keep_outputs:
+        assets = AssetStore(assets_dir_for(input_file, output_file))
+    markdown_assets = assets if extract_images else None
+    store = OutputStore(store_path_for(output_file)) if keep_outputs else None
+
+    # Metadata first: Jupyter stores it after the cells, so this scans past
+    # them without decoding, then the cells are streamed one at a time
+    metadata = read_notebook_metadata(input_file)
 
     markdown_lines = []
 
@@ -48,63 +222,48 @@ def notebook_to_markdown(input_file, output_file=None):
     markdown_lines.append(f"# {input_path.stem}\n")
 
     # Add metadata if present
-    if 'metadata' in notebook:
-        if 'colab' in notebook['metadata']:
-            markdown_lines.append("*This notebook was created for Google Colab*\n")
-        if 'language_info' in notebook['metadata']:
-            lang = notebook['metadata']['language_info'].get('name', 'unknown')
-            markdown_lines.append(f"*Language: {lang}*\n")
+    if 'colab' in metadata:
+        markdown_lines.append("*This notebook was created for Google Colab*\n")
+    if 'language_info' in metadata:
+        lang = metadata['language_info'].get('name', 'unknown')
+        markdown_lines.append(f"*Language: {lang}*\n")
 
     markdown_lines.append("---\n")
 
-    # Process cells
-    for i, cell in enumerate(notebook['cells'], 1):
-        cell_type = cell['cell_type']
-
-        if cell_type == 'markdown':
-            content = clean_markdown_source(cell.get('source', ''))
-            if content:
-                markdown_lines.append(f"\n{content}\n")
-
-        elif cell_type == 'code':
-            source = clean_code_source(cell.get('source', ''))
-            if source:
-                # Add blank line before code block for readability
-                markdown_lines.append("\n")
-
-                # Determine language for syntax highlighting
-                lang = 'python'  # default
-                if 'metadata' in notebook and 'language_info' in notebook['metadata']:
-                    lang = notebook['metadata']['language_info'].get('name', 'python')
-
-                # Add code block
-                markdown_lines.append(f"```{lang}")
-                markdown_lines.append(source)
-                markdown_lines.append("```\n")
-
-                # Add outputs if they're text (not images or complex objects)
-                if cell.get('outputs'):
-                    has_text_output = False
-                    for output in cell['outputs']:
-                        if 'text' in output:
-                            if not has_text_output:
-                                markdown_lines.append("**Output:**")
-                                markdown_lines.append("```")
-                                has_text_output = True
-                            markdown_lines.append(''.join(output['text']))
-                        elif 'data' in output and 'text/plain' in output['data']:
-                            if not has_text_output:
-                                markdown_lines.append("**Output:**")
-                                markdown_lines.append("```")
-                                has_text_output = True
-                            markdown_lines.append(''.join(output['data']['text/plain']))
-
-                    if has_text_output:
-                        markdown_lines.append("```\n")
-
-    # Write output
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(markdown_lines))
+    # Determine language for syntax highlighting
+    lang = 'python'  # default
+    if 'language_info' in metadata:
+        lang = metadata['language_info'].get('name', 'python')
+
+    # Process cells, writing each one as soon as it is parsed. Write to a
+    # temporary file so a malformed notebook doesn't leave a truncated .md
+    cell_counts = {'code': 0, 'markdown': 0}
+    tmp_file = str(output_file) + '.tmp'
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(markdown_lines))
+            for cell in iter_notebook_cells(input_file, assets=assets):
+                cell_type = cell['cell_type']
+                if cell_type in cell_counts:
+                    cell_counts[cell_type] += 1
+                if store is not None and cell_type == 'code':
+                    store.add(cell)
+                for line in cell_to_markdown_lines(cell, lang, markdown_assets):
+                    f.write('\n')
+                    f.write(line)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, output_file)
+
+    if store is not None:
+        store.save()
+    if assets is not None:
+        # Only once the markdown is written: a failed run keeps the old images
+        assets.prune()
+
+    if quiet:
+        return str(output_file)
 
     # Print statistics
     original_size = input_path.stat().st_size / 1024  # KB
@@ -116,27 +275,35 @@ def notebook_to_markdown(input_file, output_file=None):
     print(f"📉 Size reduction: {((original_size - output_size) / original_size * 100):.1f}%")
 
     # Count cells
-    code_cells = sum(1 for c in notebook['cells'] if c['cell_type'] == 'code')
-    md_cells = sum(1 for c in notebook['cells'] if c['cell_type'] == 'markdown')
-    print(f"📊 Converted {code_cells} code cells and {md_cells} markdown cells")
+    print(f"📊 Converted {cell_counts['code']} code cells and {cell_counts['markdown']} markdown cells")
+    if assets is not None and assets.count:
+        print(f"🖼️  Extracted {assets.count} images ({assets.unique} unique) to {assets.directory}/")
+    if store is not None:
+        print(f"💾 Saved outputs of {cell_counts['code']} code cells to {store.path}")
 
     return str(output_file)
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python notebook_to_md.py <notebook.ipynb> [output.md]")
+    extract_images = '--assets' in sys.argv[1:]
+    keep_outputs = '--outputs' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg not in ('--assets', '--outputs')]
+    if not args:
+        print("Usage: python notebook_to_md.py <notebook.ipynb> [output.md] [--assets] [--outputs]")
         print("\nThis script converts a Jupyter notebook to clean Markdown format.")
         print("- Removes cell outputs and embedded images")
         print("- Formats code cells with proper syntax highlighting")
         print("- Creates readable markdown suitable for documentation")
+        print("- With --assets, saves images to <notebook>_assets/ instead of dropping them")
+        print("- With --outputs, saves cell outputs so md_to_notebook can restore them")
         sys.exit(1)
 
-    input_file = sys.argv[1]
-    output_file = sys.argv[2] if len(sys.argv) > 2 else None
+    input_file = args[0]
+    output_file = args[1] if len(args) > 1 else None
 
     try:
-        notebook_to_markdown(input_file, output_file)
+        notebook_to_markdown(input_file, output_file, extract_images=extract_images,
+                             keep_outputs=keep_outputs)
     except FileNotFoundError:
         print(f"❌ Error: File '{input_file}' not found")
         sys.exit(1)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Sidecar store for code cell outputs
+notebook_to_md saves each code cell's outputs keyed by the hash of its
+source; md_to_notebook puts them back on every cell whose source is
+unchanged, so only edited cells have to be run again
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from assets import read_asset, resolve_asset
+
+
+STORE_SUFFIX = '.outputs.json'
+STORE_VERSION = 1
+
+
+def store_path_for(markdown_file):
+    """<name>.outputs.json next to the markdown file"""
+    markdown_file = Path(markdown_file)
+    return markdown_file.with_name(markdown_file.stem + STORE_SUFFIX)
+
+
+def source_key(source):
+    """Hash of a cell's source, ignoring surrounding whitespace
+
+    The Markdown round trip adds and drops blank lines around code, so
+    stripping keeps the key stable for cells nobody edited.
+    """
+    if isinstance(source, list):
+        source = ''.join(source)
+    return hashlib.sha256(source.strip().encode('utf-8')).hexdigest()
+
+
+class OutputStore:
+    """Outputs of each code cell, keyed by source hash
+
+    Cells with identical source are stored in order of appearance and
+    restored by occurrence. Images are kept as refs into <notebook>_assets/
+    instead of base64, so the store stays small.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.cells = {}
+
+    @classmethod
+    def load(cls, path):
+        """Read a saved store; None if there isn't a usable one"""
+        store = cls(path)
+        try:
+            with open(store.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if data.get('version') != STORE_VERSION:
+            return None
+        store.cells = data.get('cells', {})
+        return store
+
+    def add(self, cell):
+        """Remember a code cell read by iter_notebook_cells with an AssetStore"""
+        outputs = []
+        for output in cell.get('outputs', []):
+            entry = {key: value for key, value in output.items() if key != 'image_refs'}
+            if output.get('image_refs'):
+                entry['images'] = output['image_refs']
+            outputs.append(entry)
+        if not outputs and cell.get('execution_count') is None:
+            # Nothing worth restoring, but keep occurrences of duplicates aligned
+            outputs = None
+        self.cells.setdefault(source_key(cell.get('source', '')), []).append(
+            None if outputs is None else {'execution_count': cell.get('execution_count'),
+                                          'outputs': outputs})
+
+    def restore(self, cell, occurrence, base_dir):
+        """Reattach stored outputs to a rebuilt code cell; True if it had any
+
+        occurrence counts earlier cells with the same source key.
+        """
+        entries = self.cells.get(source_key(cell['source']), [])
+        # A copy pasted beyond the stored occurrences is a new cell
+        entry = entries[occurrence] if occurrence < len(entries) else None
+        if entry is None:
+            return False
+
+        outputs = []
+        for stored in entry['outputs']:
+            output = {key: value for key, value in stored.items() if key != 'images'}
+            if stored.get('images'):
+                data = dict(output.get('data', {}))
+                for mime, ref in stored['images'].items():
+                    path = resolve_asset(ref, base_dir)
+                    if path is not None:
+                        data[mime] = read_asset(path)[1]
+                output['data'] = data
+            outputs.append(output)
+
+        cell['outputs'] = outputs
+        cell['execution_count'] = entry['execution_count']
+        return True
+
+    def save(self):
+        """Write compact JSON atomically"""
+        data = {'version': STORE_VERSION, 'cells': self.cells}
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+        os.replace(tmp_path, self.path)
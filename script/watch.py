@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Watch mode: reconvert .md ↔ .ipynb as soon as a file is saved
+Uses inotify on Linux and falls back to polling elsewhere
+Markdown edits only re-serialize the cells that changed, and outputs
+whose content didn't change are not rewritten; with merge, the rebuilt
+cells are merged into the existing notebook like md_to_notebook --merge
+"""
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import os
+import select
+import struct
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from conversion_cache import ConversionCache, conversion_options
+from md_to_notebook import (cell_from_event, iter_cell_events, iter_markdown_lines,
+                            new_notebook, notebook_frame, notebook_json, python_header,
+                            python_lines_from_event, serialize_cell)
+from notebook_merge import merge_cells, patch_file
+from notebook_to_md import notebook_to_markdown
+from output_store import OutputStore, source_key, store_path_for
+
+
+# inotify event masks (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+IGNORED_DIRS = {'.git', '.ipynb_checkpoints', '__pycache__', '.venv', 'venv'}
+
+
+def _is_candidate(path):
+    """Whether a changed path is something we might convert"""
+    path = Path(path)
+    if path.suffix not in ('.md', '.ipynb'):
+        return False
+    if path.name.endswith('_from_md.ipynb'):
+        return False
+    return not any(part in IGNORED_DIRS or part.startswith('.') for part in path.parts[:-1]
+                   if part not in ('.', '..'))
+
+
+def _iter_dirs(root):
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS and not d.startswith('.')]
+        yield dirpath
+
+
+class PollingWatcher:
+    """Portable watcher that compares file mtimes every interval seconds"""
+
+    def __init__(self, roots, interval=1.0):
+        self.roots = [str(r) for r in roots]
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root in self.roots:
+            for dirpath in _iter_dirs(root):
+                try:
+                    for entry in os.scandir(dirpath):
+                        if entry.is_file() and _is_candidate(entry.path):
+                            stat = entry.stat()
+                            snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except FileNotFoundError:
+                    # The directory or file was removed between listing and stat
+                    continue
+        return snapshot
+
+    def poll(self, timeout):
+        """Return the set of changed paths, waiting up to timeout seconds"""
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = {path for path, stamp in snapshot.items() if self.snapshot.get(path) != stamp}
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Linux watcher built on inotify through ctypes (no extra dependencies)"""
+
+    _header = struct.Struct('iIII')
+
+    def __init__(self, roots):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        for root in roots:
+            for dirpath in _iter_dirs(root):
+                self._add_watch(dirpath)
+
+    def _add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.watches[wd] = directory
+
+    def poll(self, timeout):
+        """Return the set of changed paths, waiting up to timeout seconds"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = self._header.unpack_from(data, offset)
+            offset += self._header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                print("⚠️  inotify queue overflowed, some saves may have been missed")
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and name not in IGNORED_DIRS:
+                    for dirpath in _iter_dirs(path):
+                        self._add_watch(dirpath)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and _is_candidate(path):
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(roots, polling=False):
+    """Prefer inotify on Linux, otherwise poll"""
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            print(f"⚠️  inotify unavailable ({e}), falling back to polling")
+    return PollingWatcher(roots)
+
+
+class IncrementalMarkdownConverter:
+    """Keeps the serialized cells of each watched Markdown file between saves
+
+    Each save re-tokenizes the Markdown, but only cells whose events changed
+    are serialized again; the outputs are then written with patch_file,
+    which skips files whose content didn't change. With merge, an existing
+    notebook is updated with merge_cells instead, so its cell ids, metadata
+    and outputs survive from the first save on.
+    """
+
+    def __init__(self, compact=False, merge=False):
+        self.state = {}
+        self.indent = None if compact else 2
+        self.merge = merge
+        self.head, self.separator, self.tail = (part.encode('utf-8')
+                                                for part in notebook_frame(self.indent))
+
+    def convert(self, input_file):
+        input_path = Path(input_file)
+        notebook_path = input_path.parent / (input_path.stem + '_from_md.ipynb')
+        python_path = input_path.with_suffix('.py')
+
+        data = input_path.read_bytes()
+        source_hash = hashlib.sha256(data).hexdigest()
+        previous = self.state.get(input_path, {})
+        fragments = previous.get('fragments', {})
+
+        # Stored outputs are part of a code cell's fragment, so fragments
+        # are only reused while the store file is unchanged
+        store_path = store_path_for(input_path)
+        store = OutputStore.load(store_path)
+        store_stamp = None
+        if store is not None:
+            stat = store_path.stat()
+            store_stamp = (stat.st_mtime_ns, stat.st_size)
+        occurrences = Counter()
+
+        # Reuse serialized cells for events we've already seen
+        new_fragments = {}
+        cells = []
+        cell_fragments = []
+        python_chunks = [python_header(input_file, source_hash).encode('utf-8')]
+        regenerated = 0
+        text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+        for event in iter_cell_events(iter_markdown_lines(text)):
+            key = (event['type'], event.get('fence'), event.get('closed'), tuple(event['lines']),
+                   tuple(event.get('outputs', ())))
+            occurrence = None
+            if store is not None and event['type'] == 'code':
+                cell_key = source_key(''.join(line + '\n' for line in event['lines']))
+                occurrence = occurrences[cell_key]
+                occurrences[cell_key] += 1
+                key += (store_stamp, occurrence)
+
+            if key in new_fragments:
+                fragment = new_fragments[key]
+            elif key in fragments:
+                fragment = fragments[key]
+            else:
+                cell = cell_from_event(event, input_path.parent)
+                if cell and occurrence is not None:
+                    store.restore(cell, occurrence, input_path.parent)
+                fragment = (cell, serialize_cell(cell, self.indent).encode('utf-8') if cell else None,
+                            ''.join(python_lines_from_event(event)).encode('utf-8'))
+                # Events that only feed the Python script aren't cells
+                regenerated += cell is not None
+            new_fragments[key] = fragment
+
+            cell, cell_bytes, python_bytes = fragment
+            if cell is not None:
+                cells.append(cell)
+                cell_fragments.append(cell_bytes)
+            python_chunks.append(python_bytes)
+
+        if self.merge and notebook_path.exists():
+            # merge_cells reads the notebook itself and writes only what changed
+            notebook_chunks = None
+            written = merge_cells(notebook_path, cells, title=f"# {input_path.stem}")['written']
+        elif cell_fragments:
+            notebook_chunks = ([self.head + cell_fragments[0]]
+                               + [self.separator + fragment for fragment in cell_fragments[1:]]
+                               + [self.tail])
+        else:
+            # An empty notebook has no frame to patch into
+            notebook_chunks = [notebook_json(new_notebook([]), self.indent).encode('utf-8')]
+        if notebook_chunks is not None:
+            written = patch_file(notebook_path, previous.get('notebook'), notebook_chunks)
+        written += patch_file(python_path, previous.get('python'), python_chunks)
+
+        self.state[input_path] = {
+            'fragments': new_fragments,
+            'notebook': notebook_chunks,
+            'python': python_chunks,
+        }
+        return {
+            'outputs': [notebook_path, python_path],
+            'sha256': source_hash,
+            'cells': len(cell_fragments),
+            'regenerated': regenerated,
+            'written': written,
+        }
+
+
+def _has_sibling_notebook(md_path):
+    """Only Markdown that belongs to a notebook is converted (not READMEs)"""
+    return (md_path.with_suffix('.ipynb').exists()
+            or (md_path.parent / (md_path.stem + '_from_md.ipynb')).exists())
+
+
+class Watcher:
+    """Debounced conversion loop over one or more directories"""
+
+    def __init__(self, roots, debounce=0.3, polling=False, extract_images=False, keep_outputs=False,
+                 compact=False, merge=False):
+        self.roots = [Path(r) for r in roots]
+        self.debounce = debounce
+        self.extract_images = extract_images
+        self.keep_outputs = keep_outputs
+        self.watcher = create_watcher(self.roots, polling=polling)
+        self.compact = compact
+        self.merge = merge
+        self.markdown = IncrementalMarkdownConverter(compact, merge)
+        self.cache = ConversionCache()
+        # Files we wrote ourselves, so their events don't trigger conversions
+        self.own_writes = {}
+
+    def _remember_writes(self, paths):
+        for path in paths:
+            stat = Path(path).stat()
+            self.own_writes[str(Path(path).resolve())] = (stat.st_mtime_ns, stat.st_size)
+
+    def _is_own_write(self, path):
+        stamp = self.own_writes.get(str(Path(path).resolve()))
+        if stamp is None:
+            return False
+        stat = Path(path).stat()
+        return stamp == (stat.st_mtime_ns, stat.st_size)
+
+    def handle(self, path):
+        path = Path(path)
+        if not path.exists() or self._is_own_write(path):
+            return
+        stamp = time.strftime('%H:%M:%S')
+
+        if path.suffix == '.md':
+            if not _has_sibling_notebook(path):
+                return
+            started = time.perf_counter()
+            result = self.markdown.convert(path)
+            elapsed = (time.perf_counter() - started) * 1000
+            self.cache.record(path, result['sha256'], result['outputs'],
+                              conversion_options(path, compact=self.compact, merge=self.merge))
+            self._remember_writes(result['outputs'])
+            print(f"📝 [{stamp}] {path} → {result['outputs'][0].name} + {result['outputs'][1].name} "
+                  f"({result['regenerated']}/{result['cells']} cells regenerated, "
+                  f"{result['written'] / 1024:.1f} KB written, {elapsed:.0f} ms)")
+        else:
+            output = path.with_suffix('.md')
+            options = conversion_options(path, self.extract_images, self.keep_outputs)
+            digest, fresh = self.cache.lookup(path, [output], options)
+            if fresh:
+                return
+            notebook_to_markdown(str(path), quiet=True, extract_images=self.extract_images,
+                                 keep_outputs=self.keep_outputs)
+            self.cache.record(path, digest, [output], options)
+            self._remember_writes([output])
+            print(f"📓 [{stamp}] {path} → {output.name}")
+
+        self.cache.save()
+
+    def run(self):
+        kind = 'inotify' if isinstance(self.watcher, InotifyWatcher) else 'polling'
+        print(f"👀 Watching {', '.join(str(r) for r in self.roots)} ({kind}). Press Ctrl+C to stop.")
+        try:
+            while True:
+                pending = self.watcher.poll(timeout=1.0)
+                if not pending:
+                    continue
+
+                # Debounce: editors often write a file several times per save
+                while True:
+                    more = self.watcher.poll(timeout=self.debounce)
+                    if not more:
+                        break
+                    pending |= more
+
+                for path in sorted(pending):
+                    try:
+                        self.handle(path)
+                    except Exception as e:
+                        print(f"❌ {path}: {type(e).__name__}: {e}")
+        except KeyboardInterrupt:
+            print("\n👋 Stopped watching")
+        finally:
+            self.watcher.close()
+
+
+def watch(roots, debounce=0.3, polling=False, extract_images=False, keep_outputs=False,
+          compact=False, merge=False):
+    Watcher(roots, debounce=debounce, polling=polling, extract_images=extract_images,
+            keep_outputs=keep_outputs, compact=compact, merge=merge).run()